@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+from ScrapeTime import ScrapeTime
+
+import logging
+import time
+
+
+class SeriesAccumulator:
+    # This class keeps the state required to aggregate one series of values
+    # within one window. Adding a value is O(1) and the state does not grow
+    # with the number of values added.
+
+    # The aggregation modes supported by result():
+    MODES = ["mean", "min", "max", "first", "last", "sum", "integral"]
+
+    __slots__ = [
+        "count",
+        "sum",
+        "min",
+        "max",
+        "first",
+        "last",
+        "integral",
+        "last_time",
+    ]
+
+    def __init__(self, carry_value=None, carry_time=None):
+        # carry_value and carry_time are the last value and timestamp of the
+        # previous window, if any. They allow to integrate over the gap
+        # between the last value of the previous window and the first value
+        # of this window.
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.first = None
+        self.last = carry_value
+        self.integral = 0
+        self.last_time = carry_time
+
+    def add(self, value, timestamp):
+        # Add a value to the receiver. timestamp is in seconds since the
+        # epoch. Non numeric values are only remembered as first / last
+        # value.
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if self.last_time is not None and isinstance(self.last, (int, float)):
+                # Trapezoidal rule, the integral is in value * hours (e.g. Wh
+                # for a value in W):
+                self.integral += (
+                    (self.last + value) / 2 * (timestamp - self.last_time) / 3600
+                )
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+        if self.count == 0:
+            self.first = value
+        self.count += 1
+        self.last = value
+        self.last_time = timestamp
+
+    def get_state(self):
+        # Return the state of the receiver as a list, see set_state().
+        return [getattr(self, name) for name in self.__slots__]
+
+    def set_state(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def result(self, mode):
+        # Return the aggregated value of the receiver for the aggregation
+        # mode. If the values are not numeric the last value is returned
+        # regardless of the mode.
+        if self.count == 0:
+            return None
+        if mode == "last":
+            return self.last
+        if mode == "first":
+            return self.first
+        if self.min is None:
+            return self.last
+        if mode == "mean":
+            return self.sum / self.count
+        if mode == "min":
+            return self.min
+        if mode == "max":
+            return self.max
+        if mode == "sum":
+            return self.sum
+        if mode == "integral":
+            return self.integral
+        return None
+
+
+class AggregationStage:
+    # An AggregationStage aggregates the values of subsequent scrapes over a
+    # time window and emits the aggregated values only when a window is
+    # complete. Windows are aligned to multiples of the window length, e.g. a
+    # window of 60 seconds always starts at a full minute.
+
+    def __init__(self, window, default_mode="mean", modes=None):
+        # window: the length of a window in seconds. default_mode: the
+        # aggregation mode for all series not listed in modes. modes: a
+        # dictionary with series names as keys and aggregation modes as
+        # values.
+        self.window = window
+        self.default_mode = default_mode
+        self.modes = modes if modes is not None else {}
+
+        # Index of the currently open window, None if no value has been added
+        # yet.
+        self.window_index = None
+
+        # The timestamp of the last value added to the current window.
+        self.window_last_time = None
+
+        # The timestamp of the last value of the latest completed window.
+        self.completed_last_time = None
+
+        self.accumulators = {}
+
+    @classmethod
+    def from_config(cls, config):
+        # Create an AggregationStage from a configuration section
+        # ´aggregation` of an export. Return None if the configuration is
+        # invalid.
+        window = config.get("window", 60)
+        default_mode = config.get("mode", "mean")
+        modes = config.get("registers", {})
+        for mode in [default_mode, *modes.values()]:
+            if mode not in SeriesAccumulator.MODES:
+                logging.error(
+                    f"Unknown aggregation mode ´{mode}`, valid modes are {SeriesAccumulator.MODES}."
+                )
+                return None
+        if window <= 0:
+            logging.error(f"Aggregation window must be positive, got ´{window}`.")
+            return None
+        return cls(window, default_mode=default_mode, modes=modes)
+
+    def add(self, values, timestamp):
+        # Add a dictionary of values with a common timestamp (in seconds since
+        # the epoch). If this completes a window, return a dictionary with the
+        # aggregated values of the completed window, otherwise return None.
+        index = int(timestamp // self.window)
+        result = None
+        if self.window_index is not None and index != self.window_index:
+            self.completed_last_time = self.window_last_time
+            result = self.close_window()
+        self.window_index = index
+        self.window_last_time = timestamp
+
+        accumulators = self.accumulators
+        for name, value in values.items():
+            acc = accumulators.get(name)
+            if acc is None:
+                acc = accumulators[name] = SeriesAccumulator()
+            acc.add(value, timestamp)
+        return result
+
+    def close_window(self):
+        # Return the aggregated values of the current window and start a new,
+        # empty window. Series without values in the window are omitted.
+        result = {}
+        carried = {}
+        for name, acc in self.accumulators.items():
+            if acc.count > 0:
+                result[name] = acc.result(self.modes.get(name, self.default_mode))
+            carried[name] = SeriesAccumulator(acc.last, acc.last_time)
+        self.accumulators = carried
+        return result
+
+    def get_window_end(self):
+        # Return the end of the current window in seconds since the epoch.
+        if self.window_index is None:
+            return None
+        return (self.window_index + 1) * self.window
+
+    def get_state(self):
+        # Return the state of the current window, see StateCheckpoint.
+        return {
+            "window": self.window,
+            "window_index": self.window_index,
+            "window_last_time": self.window_last_time,
+            "accumulators": {
+                name: acc.get_state() for name, acc in self.accumulators.items()
+            },
+        }
+
+    def set_state(self, state, now=None):
+        # Restore the state returned by get_state(). The window is restored
+        # only if it is the current or the previous window (which will be
+        # completed by the next value added).
+        if now is None:
+            now = time.time()
+        if state["window"] != self.window or state["window_index"] is None:
+            return
+        if state["window_index"] < int(now // self.window) - 1:
+            logging.debug("Aggregation window of checkpoint is outdated, ignoring it.")
+            return
+        self.window_index = state["window_index"]
+        self.window_last_time = state["window_last_time"]
+        self.accumulators = {}
+        for name, acc_state in state["accumulators"].items():
+            acc = self.accumulators[name] = SeriesAccumulator()
+            acc.set_state(acc_state)
+
+
+class AggregatedInverterView:
+    # An AggregatedInverterView replaces the values of the latest scrape of an
+    # inverter by aggregated values. Everything else is delegated to the
+    # inverter, so it can be passed to export.publish() instead of the
+    # inverter itself.
+
+    def __init__(self, inverter, values, snapshot_cache):
+        self._inverter = inverter
+        self.latest_scrape = values
+        self.snapshot_cache = snapshot_cache
+        snapshot_cache.publish(values)
+
+    def __getattr__(self, name):
+        return getattr(self._inverter, name)
+
+    def validateLatestScrape(self, check_register):
+        return check_register in self.latest_scrape
+
+    def getRegisterValue(self, check_register):
+        return self.latest_scrape.get(check_register, False)
+
+
+class AggregatingExport:
+    # This class wraps an export and passes aggregated values to it. The
+    # wrapped export is published only when an aggregation window is
+    # complete. Scraping continues at the configured scan interval.
+
+    def __init__(self, export, stage, name):
+        self.export = export
+        self.stage = stage
+        self.name = name
+        self.snapshot_cache = None
+
+        # Rollup periods completed since the last publish, see
+        # SungrowClientCore.completed_rollups:
+        self.pending_rollups = []
+
+    def __getattr__(self, name):
+        return getattr(self.export, name)
+
+    def get_state(self):
+        state = {"aggregation": self.stage.get_state()}
+        get_export_state = getattr(self.export, "get_state", None)
+        if get_export_state is not None:
+            state["export"] = get_export_state()
+        return state
+
+    def set_state(self, state):
+        self.stage.set_state(state["aggregation"])
+        set_export_state = getattr(self.export, "set_state", None)
+        if set_export_state is not None and "export" in state:
+            set_export_state(state["export"])
+
+    def publish(self, inverter):
+        aggregated = self.stage.add(inverter.latest_scrape, inverter.scrape_time.seconds)
+        self.pending_rollups.extend(getattr(inverter, "completed_rollups", []))
+        if aggregated is None:
+            logging.debug(
+                f"Aggregation for export ´{self.name}`: values added to current window."
+            )
+            return True
+        if self.snapshot_cache is None:
+            self.snapshot_cache = inverter.snapshot_cache.derive()
+        logging.debug(
+            f"Aggregation for export ´{self.name}`: window complete, publishing {len(aggregated)} values."
+        )
+        view = AggregatedInverterView(inverter, aggregated, self.snapshot_cache)
+        # The aggregated values are published with the time of the last
+        # scrape of the window:
+        view.scrape_time = ScrapeTime.from_seconds(self.stage.completed_last_time)
+        view.completed_rollups = self.pending_rollups
+        self.pending_rollups = []
+        return self.export.publish(view)
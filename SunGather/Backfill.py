@@ -0,0 +1,506 @@
+#!/usr/bin/python3
+
+from FieldPostProcessor import AggregatingFieldExpression, FieldExpression, FieldStatement
+
+import ast
+import csv
+import logging
+import time
+
+from datetime import datetime
+
+# NumPy is optional. Without NumPy all custom fields are evaluated row by row.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def parse_cell(text):
+    # Convert the text of a CSV cell to an int, a float or a string. Empty
+    # cells are returned as None, i.e. the field is not available.
+    if text == "":
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def parse_timestamp(value):
+    # Convert the value of a timestamp cell to a datetime. The value is either
+    # a number (seconds since the epoch) or a string like
+    # ´2024-6-1 12:00:05`.
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+    if isinstance(value, str):
+        for fmt in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M"]:
+            try:
+                return datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        return datetime.fromisoformat(value)
+    raise ValueError(f"invalid timestamp ´{value}`")
+
+
+class NotVectorizable(Exception):
+    # Raised if an expression cannot be evaluated by VectorEvaluator.
+    pass
+
+
+class VectorEvaluator:
+    # This class evaluates an elementwise arithmetic expression for all rows
+    # of a Backfill at once using NumPy. Rows for which the result might
+    # differ from evaluating the expression in Python (missing values,
+    # division by zero, overflow, results which are not finite) are marked
+    # as invalid, they must be evaluated row by row.
+
+    # Supported operators, pow is supported for floats only:
+    BINARY_OPERATORS = {
+        ast.Add: "add",
+        ast.Sub: "subtract",
+        ast.Mult: "multiply",
+        ast.Div: "true_divide",
+        ast.FloorDiv: "floor_divide",
+        ast.Mod: "remainder",
+        ast.Pow: "power",
+    }
+    COMPARE_OPERATORS = {
+        ast.Lt: "less",
+        ast.LtE: "less_equal",
+        ast.Gt: "greater",
+        ast.GtE: "greater_equal",
+        ast.Eq: "equal",
+        ast.NotEq: "not_equal",
+    }
+
+    # Integer results beyond this limit are evaluated row by row, because
+    # they may overflow in NumPy.
+    INT_LIMIT = 2**62
+
+    @classmethod
+    def parse(cls, source):
+        # Return the syntax tree of source if it is supported, raise
+        # NotVectorizable otherwise.
+        try:
+            tree = ast.parse(source, mode="eval")
+        except Exception:
+            raise NotVectorizable()
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Expression, ast.Load, ast.Name, ast.UnaryOp)):
+                continue
+            if isinstance(node, (ast.USub, ast.UAdd)):
+                continue
+            if type(node) in cls.BINARY_OPERATORS or type(node) in cls.COMPARE_OPERATORS:
+                continue
+            if isinstance(node, ast.BinOp):
+                continue
+            if isinstance(node, ast.Compare) and len(node.ops) == 1:
+                continue
+            if (
+                isinstance(node, ast.Constant)
+                and type(node.value) in (int, float)
+                and abs(node.value) < cls.INT_LIMIT
+            ):
+                continue
+            if (
+                isinstance(node, ast.Call)
+                and isinstance(node.func, ast.Name)
+                and node.func.id == "abs"
+                and len(node.args) == 1
+                and not node.keywords
+            ):
+                continue
+            raise NotVectorizable()
+        return tree
+
+    def __init__(self, backfill):
+        self.backfill = backfill
+        # Rows which must be evaluated row by row:
+        self.invalid = numpy.zeros(backfill.length, dtype=bool)
+
+    def evaluate(self, tree):
+        # Return the result of the expression for all rows as an array and
+        # its kind, either "int", "float" or "bool".
+        value, kind, _ = self.visit(tree.body)
+        return numpy.broadcast_to(value, (self.backfill.length,)), kind
+
+    def visit(self, node):
+        # Return the value, the kind and for kind "int" a float shadow value
+        # of node. The shadow value is used to detect overflows.
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, int):
+                return node.value, "int", float(node.value)
+            return node.value, "float", None
+        if isinstance(node, ast.Name):
+            if node.id == "abs" and node.id not in self.backfill.columns:
+                raise NotVectorizable()
+            array, kind, missing = self.backfill.get_array(node.id)
+            self.invalid |= missing
+            return array, kind, array.astype(float) if kind == "int" else None
+        if isinstance(node, ast.UnaryOp):
+            value, kind, shadow = self.visit(node.operand)
+            if kind == "bool":
+                raise NotVectorizable()
+            if isinstance(node.op, ast.USub):
+                return -value, kind, -shadow if kind == "int" else None
+            return value, kind, shadow
+        if isinstance(node, ast.Call):
+            if "abs" in self.backfill.columns:
+                # A field named abs takes precedence over the function.
+                raise NotVectorizable()
+            value, kind, shadow = self.visit(node.args[0])
+            if kind == "bool":
+                raise NotVectorizable()
+            return numpy.abs(value), kind, numpy.abs(shadow) if kind == "int" else None
+        if isinstance(node, ast.BinOp):
+            left, left_kind, left_shadow = self.visit(node.left)
+            right, right_kind, right_shadow = self.visit(node.right)
+            op = type(node.op)
+            if isinstance(node.op, (ast.Div, ast.FloorDiv, ast.Mod)):
+                # Python raises ZeroDivisionError:
+                self.invalid |= numpy.asarray(right) == 0
+            function = getattr(numpy, self.BINARY_OPERATORS[op])
+            if left_kind == "int" and right_kind == "int":
+                if op is ast.Pow:
+                    raise NotVectorizable()
+                if op is ast.Div:
+                    return function(left, right), "float", None
+                value = function(left, right)
+                shadow = function(left_shadow, right_shadow)
+                self.invalid |= numpy.abs(shadow) >= self.INT_LIMIT
+                return value, "int", shadow
+            if left_kind == "bool" or right_kind == "bool":
+                raise NotVectorizable()
+            value = function(
+                numpy.asarray(left, dtype=float), numpy.asarray(right, dtype=float)
+            )
+            # Python raises OverflowError or returns a complex number:
+            self.invalid |= ~numpy.isfinite(value)
+            return value, "float", None
+        if isinstance(node, ast.Compare):
+            left, left_kind, _ = self.visit(node.left)
+            right, right_kind, _ = self.visit(node.comparators[0])
+            if left_kind == "bool" or right_kind == "bool":
+                raise NotVectorizable()
+            function = getattr(numpy, self.COMPARE_OPERATORS[type(node.ops[0])])
+            return function(left, right), "bool", None
+        raise NotVectorizable()
+
+
+class Backfill:
+    # A Backfill evaluates the custom field definitions of a
+    # FieldPostProcessor over recorded values, e.g. to calculate a new custom
+    # field for past data. The values are read from a CSV file with one row
+    # per scrape and one column per field, including a column with the
+    # timestamp of the scrape. Aggregated fields are reset daily according to
+    # these timestamps.
+
+    # Expressions which are elementwise arithmetic are evaluated for all rows
+    # at once using NumPy, if available. All other definitions are evaluated
+    # row by row in their usual order. Note that ´datetime` still refers to
+    # the current time, not the time of the row.
+
+    def __init__(self, field_post_processor, time_column="timestamp"):
+        self.processor = field_post_processor
+        self.time_column = time_column
+
+        # The values by field name, one list per field with one entry per row
+        # (None if the field is not available in the row):
+        self.columns = {}
+        self.length = 0
+
+        # The timestamp of each row as datetime, see get_times():
+        self._times = None
+
+        # NumPy arrays of the columns by field name, see get_array():
+        self._arrays = {}
+
+        # Number of definitions evaluated for all rows at once and row by
+        # row:
+        self.vectorized = 0
+        self.row_by_row = 0
+
+    def get_required_fields(self):
+        # Return the set of fields which are used by the custom field
+        # definitions or None, if all fields may be used.
+        names = set()
+        for e in self.processor.expressions:
+            if isinstance(e, FieldStatement):
+                # Statements may access any field via ´results`.
+                return None
+            names |= e.get_input_names() | e.get_output_names()
+        return names
+
+    def read_csv(self, filename):
+        # Read the recorded values from a CSV file with a header row
+        # containing the field names. Only fields used by the custom field
+        # definitions are kept.
+        required = self.get_required_fields()
+        with open(filename, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            if self.time_column not in header:
+                raise ValueError(
+                    f"Column ´{self.time_column}` missing in ´{filename}`."
+                )
+            indexes = [
+                i
+                for i, name in enumerate(header)
+                if required is None or name in required or name == self.time_column
+            ]
+            texts = {header[i]: [] for i in indexes}
+            appenders = [(i, texts[header[i]].append) for i in indexes]
+            for row in reader:
+                for i, append in appenders:
+                    append(row[i] if i < len(row) else "")
+        self.columns = {
+            name: self.parse_column(column)
+            for name, column in texts.items()
+            if name != self.time_column
+        }
+        # The timestamps are kept as text and only parsed if required:
+        self.columns[self.time_column] = [
+            text if text != "" else None for text in texts[self.time_column]
+        ]
+        self.length = len(self.columns[self.time_column])
+        self._times = None
+        self._arrays = {}
+        logging.info(f"Read {self.length} rows from ´{filename}`.")
+
+    @staticmethod
+    def parse_column(texts):
+        # Return the list of values for the CSV cells in texts. Columns
+        # containing integers only are converted at once, which is much
+        # faster than converting each cell with parse_cell().
+        try:
+            return [int(text) if text != "" else None for text in texts]
+        except ValueError:
+            pass
+        # Texts with a decimal point are never converted to an int:
+        if all("." in text or text == "" for text in texts):
+            try:
+                return [float(text) if text != "" else None for text in texts]
+            except ValueError:
+                pass
+        return [parse_cell(text) for text in texts]
+
+    def get_times(self):
+        # Return the timestamp of each row as datetime.
+        if self._times is None:
+            self._times = self.parse_timestamps(self.columns[self.time_column])
+        return self._times
+
+    @staticmethod
+    def parse_timestamps(values):
+        # Return the list of datetimes for the timestamp cells in values.
+        # Timestamps like ´2024-6-1 12:00:05` are split into date and time
+        # without strptime, because this is much faster. The dates are cached,
+        # they are identical for thousands of rows.
+        dates = {}
+        times = []
+        for value in values:
+            if value is None:
+                raise ValueError(f"timestamp missing in row {len(times) + 1}")
+            try:
+                date_part, time_part = value.split(" ")
+                date = dates.get(date_part)
+                if date is None:
+                    year, month, day = date_part.split("-")
+                    date = dates[date_part] = (int(year), int(month), int(day))
+                hour, minute, second = time_part.split(":")
+                times.append(datetime(*date, int(hour), int(minute), int(second)))
+            except (AttributeError, ValueError):
+                times.append(parse_timestamp(parse_cell(value)))
+        return times
+
+    def write_csv(self, filename):
+        # Write the timestamps and the fields written by the custom field
+        # definitions to a CSV file.
+        names = [self.time_column]
+        for e in self.processor.expressions:
+            for name in e.get_output_names():
+                if name in self.columns and name not in names:
+                    names.append(name)
+        columns = [self.columns[name] for name in names]
+        with open(filename, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(names)
+            # None is written as an empty cell:
+            writer.writerows(zip(*columns))
+        logging.info(f"Wrote {self.length} rows to ´{filename}`.")
+
+    def run(self):
+        # Evaluate all custom field definitions for all rows.
+        start = time.perf_counter()
+        group = []
+        for e in self.processor.evaluation_order:
+            tree = guard_tree = None
+            if numpy is not None and type(e) is FieldExpression and e.code is not None:
+                try:
+                    tree = VectorEvaluator.parse(e.source)
+                    if e.guard is not None:
+                        guard_tree = VectorEvaluator.parse(e.guard.source)
+                except NotVectorizable:
+                    tree = None
+            if tree is None:
+                group.append(e)
+                continue
+            # Definitions evaluated row by row must be completed first:
+            self.evaluate_rows(group)
+            group = []
+            try:
+                self.evaluate_vectorized(e, tree, guard_tree)
+            except NotVectorizable:
+                self.evaluate_rows([e])
+        self.evaluate_rows(group)
+        logging.info(
+            f"Evaluated {self.vectorized} definitions for all rows at once and "
+            + f"{self.row_by_row} row by row in {time.perf_counter() - start:.2f} seconds."
+        )
+
+    def get_array(self, name):
+        # Return the column ´name` as NumPy array, its kind ("int" or "float")
+        # and a boolean array indicating missing values. Raise
+        # NotVectorizable if the column does not contain only ints or only
+        # floats.
+        cached = self._arrays.get(name)
+        if cached is not None:
+            return cached
+        column = self.columns.get(name)
+        if column is None:
+            column = [None] * self.length
+        types = set(map(type, column))
+        types.discard(type(None))
+        if types == {float}:
+            kind = "float"
+        elif types == {int} or not types:
+            kind = "int"
+        else:
+            raise NotVectorizable()
+        objects = numpy.array(column, dtype=object)
+        missing = numpy.equal(objects, None)
+        objects[missing] = 0
+        try:
+            array = objects.astype(float if kind == "float" else numpy.int64)
+        except OverflowError:
+            raise NotVectorizable()
+        if kind == "int" and numpy.any(numpy.abs(array) >= VectorEvaluator.INT_LIMIT):
+            raise NotVectorizable()
+        self._arrays[name] = (array, kind, missing)
+        return self._arrays[name]
+
+    def set_values(self, name, indexes, values):
+        # Write values (a list) to the rows with the indexes in column name.
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = [None] * self.length
+        if len(indexes) == self.length:
+            self.columns[name] = values
+        else:
+            for i in indexes:
+                column[i] = values[i]
+        self._arrays.pop(name, None)
+
+    def evaluate_vectorized(self, e, tree, guard_tree):
+        # Evaluate the FieldExpression e for all rows at once. Rows which
+        # cannot be evaluated this way are evaluated row by row.
+        with numpy.errstate(all="ignore"):
+            evaluator = VectorEvaluator(self)
+            value, kind = evaluator.evaluate(tree)
+            invalid = evaluator.invalid
+            allowed = numpy.ones(self.length, dtype=bool)
+            invalid_guard = numpy.zeros(self.length, dtype=bool)
+            if guard_tree is not None:
+                guard_evaluator = VectorEvaluator(self)
+                guard, _ = guard_evaluator.evaluate(guard_tree)
+                invalid_guard = guard_evaluator.invalid
+                allowed &= guard.astype(bool)
+        column = self.columns.get(e.name)
+        if e.write_mode is not None:
+            if column is None:
+                exists = numpy.zeros(self.length, dtype=bool)
+            else:
+                exists = numpy.fromiter(
+                    (v is not None for v in column), dtype=bool, count=self.length
+                )
+            allowed &= exists if e.write_mode == "replace_only" else ~exists
+        # Rows with an invalid guard are evaluated row by row as a whole:
+        row_by_row = invalid_guard | (allowed & invalid)
+        write = allowed & ~row_by_row
+        self.set_values(e.name, numpy.flatnonzero(write), value.tolist())
+        indexes = numpy.flatnonzero(row_by_row)
+        if len(indexes) > 0:
+            self.evaluate_rows([e], indexes)
+        else:
+            self.vectorized += 1
+
+    def evaluate_rows(self, group, indexes=None):
+        # Evaluate the definitions in group in their order for each row (or
+        # for the rows with the given indexes only).
+        if not group:
+            return
+        if indexes is None:
+            indexes = range(self.length)
+            self.row_by_row += len(group)
+        else:
+            self.vectorized += 1
+        names = set()
+        for e in group:
+            if isinstance(e, FieldStatement):
+                names = None
+                break
+            names |= e.get_input_names() | e.get_output_names()
+        columns = [
+            (name, column)
+            for name, column in self.columns.items()
+            if names is None or name in names
+        ]
+
+        # Timestamps are only required by aggregated fields and the rolling
+        # window functions:
+        aggregating = [e for e in group if isinstance(e, AggregatingFieldExpression)]
+        rolling_functions = [e for e in group if e.uses_rolling_functions()]
+        times = None
+        if aggregating or rolling_functions:
+            times = self.get_times()
+        now = [None]
+        for e in aggregating:
+            e.clock = lambda: now[0]
+            e.restart(times[0])
+        # The rolling window functions are fed with the rows of this group
+        # only, each row is added once per series:
+        rolling = self.processor.rolling_functions
+        rolling.series = {}
+        rolling.updated = {}
+
+        # Failing evaluations are logged by the definitions for each row,
+        # which would flood the log:
+        logging.disable(logging.WARNING)
+        try:
+            for i in indexes:
+                row = {}
+                for name, column in columns:
+                    if column[i] is not None:
+                        row[name] = column[i]
+                if times is not None:
+                    now[0] = times[i]
+                    rolling.begin(row, now=now[0].timestamp())
+                for e in group:
+                    e.evaluate(row)
+                for name in row.keys() | {name for name, _ in columns}:
+                    column = self.columns.get(name)
+                    if column is None:
+                        column = self.columns[name] = [None] * self.length
+                        columns.append((name, column))
+                    column[i] = row.get(name)
+        finally:
+            logging.disable(logging.NOTSET)
+            for e in aggregating:
+                e.clock = datetime.now
+        for name in names if names is not None else list(self._arrays):
+            self._arrays.pop(name, None)
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+
+import logging
+import os
+import random
+import threading
+import time
+
+from collections import deque
+
+
+class WriteRejected(Exception):
+    # Raised by the send function of a BatchWriter if the receiver rejected
+    # the data itself (e.g. a malformed line). Such a batch is dropped
+    # instead of being retried.
+    pass
+
+
+class DiskSpool:
+    # A DiskSpool keeps batches which could not be written in files in a
+    # directory, one file per batch. The batches survive restarts and are
+    # returned oldest first. If the total size exceeds max_bytes, the oldest
+    # batches are deleted. A DiskSpool can be used from several threads.
+
+    # File names are ´<time in ns>-<number of lines>.lp`.
+    SUFFIX = ".lp"
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # (file name, number of lines, size) of the spooled batches, oldest
+        # first:
+        self.files = deque()
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                count = int(name[: -len(self.SUFFIX)].split("-")[1])
+                size = os.path.getsize(os.path.join(directory, name))
+            except (IndexError, ValueError, OSError):
+                logging.warning(f"Ignoring unexpected file ´{name}` in spool ´{directory}`.")
+                continue
+            self.files.append((name, count, size))
+        # Total size and number of lines of the spooled batches:
+        self.size = sum(size for name, count, size in self.files)
+        self.lines = sum(count for name, count, size in self.files)
+        self._lock = threading.Lock()
+        if self.files:
+            logging.info(
+                f"Spool ´{directory}` contains {self.lines} lines not written yet."
+            )
+
+    def append(self, lines):
+        # Write a batch of lines to the spool. Return the number of lines of
+        # older batches deleted to keep the size limit.
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        name = f"{time.time_ns():020d}-{len(lines)}{self.SUFFIX}"
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            # Batches are written to a temporary file and renamed, so a
+            # crash never leaves a partial batch:
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+            self.files.append((name, len(lines), len(data)))
+            self.size += len(data)
+            self.lines += len(lines)
+            evicted = 0
+            while self.size > self.max_bytes and len(self.files) > 1:
+                evicted += self._remove_oldest()
+        return evicted
+
+    def peek(self):
+        # Return the name and the lines of the oldest batch, (None, None) if
+        # the spool is empty.
+        with self._lock:
+            while self.files:
+                name = self.files[0][0]
+                try:
+                    with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                        return name, f.read().splitlines()
+                except OSError as err:
+                    logging.warning(f"Dropping unreadable spool file ´{name}`: {err}")
+                    self._remove_oldest()
+        return None, None
+
+    def remove(self, name):
+        # Delete the batch returned by peek() as name, if it still exists.
+        with self._lock:
+            if self.files and self.files[0][0] == name:
+                self._remove_oldest()
+
+    def _remove_oldest(self):
+        # Delete the oldest batch. Return its number of lines.
+        name, count, size = self.files.popleft()
+        self.size -= size
+        self.lines -= count
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+        return count
+
+
+class BatchWriter:
+    # A BatchWriter collects lines (e.g. InfluxDB line protocol) and writes
+    # them in batches from a background thread, so a slow or unavailable
+    # server does not delay scraping. A batch is written when batch_size lines
+    # are queued or flush_interval seconds have passed.
+
+    # Failed writes are retried with an exponential backoff from
+    # retry_interval up to max_retry_interval seconds. The delays are
+    # randomized (between half and the full delay), so several clients do
+    # not hit a recovering server at the same time.
+
+    # At most max_queued lines are kept in memory. With a DiskSpool, batches
+    # which failed and lines exceeding this limit are moved to the spool and
+    # written after the server is available again. Without a spool the
+    # oldest lines are dropped.
+
+    def __init__(
+        self,
+        name,
+        send,
+        batch_size=1000,
+        flush_interval=5,
+        max_queued=10000,
+        retry_interval=5,
+        max_retry_interval=300,
+        spool=None,
+    ):
+        self.name = name
+        # The function writing a list of lines, raising an exception on
+        # failure:
+        self.send = send
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.spool = spool
+
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        # Number of failed writes in a row and the time of the next retry
+        # (time.monotonic()):
+        self._failures = 0
+        self._retry_at = 0
+
+        # Counters for get_metrics():
+        self.written = 0
+        self.dropped = 0
+        self.failed_writes = 0
+        self.last_flush_latency = None
+        self.max_flush_latency = 0.0
+        self.last_error = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, lines):
+        # Queue lines for writing. Never blocks on the server.
+        with self._condition:
+            self._queue.extend(lines)
+            excess = len(self._queue) - self.max_queued
+            if excess > 0 and self.spool is None:
+                for _ in range(excess):
+                    self._queue.popleft()
+                self.dropped += excess
+                logging.warning(
+                    f"{self.name}: queue full, dropped {excess} oldest lines."
+                )
+            if len(self._queue) >= self.batch_size or excess > 0:
+                self._condition.notify()
+
+    def get_metrics(self):
+        with self._condition:
+            metrics = {
+                "queued": len(self._queue),
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed_writes": self.failed_writes,
+                "last_flush_latency": self.last_flush_latency,
+                "max_flush_latency": self.max_flush_latency,
+                "last_error": self.last_error,
+            }
+            if self.spool is not None:
+                metrics["spooled"] = self.spool.lines
+                metrics["spooled_bytes"] = self.spool.size
+        return metrics
+
+    def close(self, timeout=10):
+        # Write the queued lines, waiting at most timeout seconds. Lines
+        # which could not be written are moved to the spool, if any.
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._condition:
+            remaining = list(self._queue)
+            self._queue.clear()
+        if not remaining:
+            return
+        if self.spool is not None:
+            self.spool_lines(remaining)
+            logging.info(f"{self.name}: spooled {len(remaining)} lines on exit.")
+        else:
+            self.dropped += len(remaining)
+            logging.warning(f"{self.name}: {len(remaining)} lines not written on exit.")
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    if self.spool is not None and len(self._queue) > self.max_queued:
+                        break
+                    now = time.monotonic()
+                    if now >= self._retry_at and (
+                        now >= next_flush or len(self._queue) >= self.batch_size
+                    ):
+                        break
+                    self._condition.wait(max(self._retry_at, next_flush) - now)
+                stopping = self._stopping
+                overflow = []
+                if self.spool is not None:
+                    while len(self._queue) > self.max_queued:
+                        overflow.append(self._queue.popleft())
+            if overflow:
+                # The server is not available for a while, free the memory:
+                self.spool_lines(overflow)
+                continue
+            if stopping:
+                # Write what is queued, unless the server is failing:
+                while self._queue and self._failures == 0:
+                    self.flush()
+                return
+            next_flush = time.monotonic() + self.flush_interval
+            self.flush()
+
+    def flush(self):
+        # Write one batch from the queue, then older batches from the spool.
+        with self._condition:
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+        if batch and not self.write(batch):
+            if self.spool is not None:
+                self.spool_lines(batch)
+            else:
+                with self._condition:
+                    # Retry with the next batch, keeping the order of lines:
+                    self._queue.extendleft(reversed(batch))
+                    excess = len(self._queue) - self.max_queued
+                    for _ in range(max(0, excess)):
+                        self._queue.popleft()
+                    if excess > 0:
+                        self.dropped += excess
+            return
+        while self.spool is not None and self.spool.files and not self._stopping:
+            name, spooled = self.spool.peek()
+            if spooled is None:
+                break
+            if not self.write(spooled):
+                break
+            self.spool.remove(name)
+            logging.info(f"{self.name}: wrote {len(spooled)} spooled lines.")
+
+    def write(self, batch):
+        # Send a batch. Return True if it was written or rejected by the
+        # server (and dropped), False if it should be retried.
+        start = time.monotonic()
+        try:
+            self.send(batch)
+        except WriteRejected as err:
+            self.dropped += len(batch)
+            self.last_error = str(err)
+            logging.error(f"{self.name}: dropped {len(batch)} lines rejected by the server: {err}")
+            return True
+        except Exception as err:
+            self.failed_writes += 1
+            self._failures += 1
+            delay = min(
+                self.max_retry_interval,
+                self.retry_interval * 2 ** (self._failures - 1),
+            )
+            delay = random.uniform(delay / 2, delay)
+            self._retry_at = time.monotonic() + delay
+            self.last_error = str(err)
+            logging.warning(
+                f"{self.name}: writing {len(batch)} lines failed, retrying in {delay:.1f} seconds: {err}"
+            )
+            return False
+        latency = time.monotonic() - start
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.written += len(batch)
+        if self._failures:
+            logging.info(f"{self.name}: writing succeeded again.")
+        self._failures = 0
+        self._retry_at = 0
+        logging.debug(f"{self.name}: wrote {len(batch)} lines in {latency:.3f} seconds.")
+        return True
+
+    def spool_lines(self, lines):
+        try:
+            evicted = self.spool.append(lines)
+        except OSError as err:
+            self.dropped += len(lines)
+            logging.error(f"{self.name}: could not spool {len(lines)} lines: {err}")
+            return
+        if evicted:
+            self.dropped += evicted
+            logging.warning(
+                f"{self.name}: spool full, dropped {evicted} oldest spooled lines."
+            )
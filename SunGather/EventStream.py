@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+import threading
+
+from collections import deque
+
+
+class Subscriber:
+    # A Subscriber buffers the events of an EventStream for one client until
+    # the client has sent them. The buffer is bounded: a client not keeping
+    # up is dropped by the EventStream instead of buffering without limit.
+
+    def __init__(self, kind, max_buffered):
+        # The kind of frames the client receives, see EventStream.broadcast():
+        self.kind = kind
+        self.max_buffered = max_buffered
+        self.closed = False
+        self._queue = deque()
+        self._condition = threading.Condition()
+
+    def offer(self, event):
+        # Buffer an event, return False if the buffer is full.
+        with self._condition:
+            if len(self._queue) >= self.max_buffered:
+                return False
+            self._queue.append(event)
+            self._condition.notify()
+        return True
+
+    def get(self, timeout):
+        # Return the next event as (sequence, frame), None on timeout or if
+        # the subscriber has been closed.
+        with self._condition:
+            if not self._queue and not self.closed:
+                self._condition.wait(timeout)
+            if self.closed or not self._queue:
+                return None
+            return self._queue.popleft()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._queue.clear()
+            self._condition.notify()
+
+
+class EventStream:
+    # An EventStream fans out events to any number of subscribers. Every
+    # event is encoded once per kind of frame (e.g. the whole snapshot or
+    # only the changed fields), the same bytes are buffered for all
+    # subscribers of that kind.
+
+    def __init__(self, max_buffered=10):
+        self.max_buffered = max_buffered
+        self.dropped = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, kind):
+        subscriber = Subscriber(kind, self.max_buffered)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+        subscriber.close()
+
+    def get_kinds(self):
+        # Return the set of kinds of frames subscribed to, so only these
+        # need to be encoded.
+        with self._lock:
+            return {subscriber.kind for subscriber in self._subscribers}
+
+    def count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def broadcast(self, sequence, frames):
+        # Buffer an event for all subscribers. ´frames` is a dictionary of
+        # the encoded frame by kind. Subscribers with a full buffer are
+        # dropped.
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            frame = frames.get(subscriber.kind)
+            if frame is not None and not subscriber.offer((sequence, frame)):
+                with self._lock:
+                    self._subscribers.discard(subscriber)
+                    self.dropped += 1
+                subscriber.close()
+
+    def close(self):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._subscribers.clear()
+        for subscriber in subscribers:
+            subscriber.close()
@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+from Aggregation import AggregationStage, AggregatingExport
+
+import importlib
+import logging
+import threading
+import time
+
+
+class ExportManager:
+    # The ExportManager loads and configures the exports. Every export is
+    # set up in a thread of its own, so slow exports (e.g. exports contacting
+    # a server during configuration) do not delay each other or the first
+    # scrape. Exports failing to configure with an exception (e.g. a server
+    # not reachable) are retried in the background. Exports whose
+    # configure() returns False (e.g. because of an invalid configuration)
+    # are disabled. Only exports which are successfully configured are
+    # published.
+
+    # Seconds to wait for all exports to be configured before scraping
+    # starts. Exports not configured within this time will be added as soon
+    # as they are ready.
+    SETUP_TIMEOUT = 5
+
+    # Seconds to wait before retrying to configure a failed export. The
+    # interval is doubled after each failure up to MAX_RETRY_INTERVAL.
+    RETRY_INTERVAL = 30
+    MAX_RETRY_INTERVAL = 900
+
+    def __init__(self, inverter):
+        self.inverter = inverter
+
+        # Configured exports in the order of the configuration. An entry is
+        # None as long as the export is not (yet) configured.
+        self._exports = []
+        self._names = []
+        self._lock = threading.Lock()
+        self._threads = []
+        # Slots of exports which failed permanently, e.g. because of an
+        # invalid configuration:
+        self._failed = set()
+
+        # Restored states of exports by name, which are not yet configured.
+        # See set_state().
+        self._pending_states = {}
+
+        # For every export name: [publishes, failed publishes, total seconds,
+        # seconds of the last publish], see publish().
+        self._publish_metrics = {}
+
+    def start(self, export_configs):
+        # Start setting up all enabled exports and wait at most SETUP_TIMEOUT
+        # seconds for them to be configured. Return the number of exports
+        # which are enabled and not failed permanently, i.e. configured or
+        # still being configured.
+        logging.info("Start loading exports ...")
+        for exportconfig in export_configs:
+            logging.debug(f"Checking enablement of export ´{exportconfig.get('name')}` ...")
+            if not exportconfig.get("enabled", False):
+                logging.debug(f"... Export ´{exportconfig.get('name')}` is not enabled.")
+                continue
+            logging.debug(f"... Export ´{exportconfig.get('name')}` is enabled.")
+            self._start_one(exportconfig)
+
+        deadline = time.monotonic() + self.SETUP_TIMEOUT
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+        pending = [t.name for t in self._threads if t.is_alive()]
+        if pending:
+            logging.warning(
+                f"Exports not ready yet, continuing in the background: {pending}"
+            )
+        with self._lock:
+            return len(self._threads) - len(self._failed)
+
+    def _start_one(self, exportconfig):
+        with self._lock:
+            slot = len(self._exports)
+            self._exports.append(None)
+            self._names.append(exportconfig.get("name"))
+        thread = threading.Thread(
+            target=self._setup_loop,
+            args=(exportconfig, slot),
+            name=exportconfig.get("name"),
+        )
+        # A daemon thread will not prevent the application from exiting:
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+
+    def _setup_loop(self, exportconfig, slot):
+        # Import the export module, then try to configure the export until it
+        # succeeds or fails permanently. Runs in a thread of its own.
+        name = exportconfig.get("name")
+        module = self._import_export(name)
+        if module is None:
+            self._set_failed(slot)
+            return
+        stage = None
+        if exportconfig.get("aggregation") is not None:
+            stage = AggregationStage.from_config(exportconfig.get("aggregation"))
+            if stage is None:
+                logging.error(f"Invalid aggregation configured for export ´{name}`.")
+                self._set_failed(slot)
+                return
+        retry_interval = self.RETRY_INTERVAL
+        while True:
+            export_loaded = self._configure_export(module, exportconfig)
+            if export_loaded is False:
+                self._set_failed(slot)
+                return
+            if export_loaded is not None:
+                break
+            logging.warning(
+                f"Retrying to configure export ´{name}` in {retry_interval} seconds."
+            )
+            time.sleep(retry_interval)
+            retry_interval = min(2 * retry_interval, self.MAX_RETRY_INTERVAL)
+        if stage is not None:
+            logging.info(
+                f"Export ´{name}` publishes values aggregated over {stage.window} seconds."
+            )
+            export_loaded = AggregatingExport(export_loaded, stage, name)
+        if hasattr(export_loaded, "set_export_manager"):
+            # Exports reporting about the other exports, e.g. prometheus:
+            export_loaded.set_export_manager(self)
+        with self._lock:
+            state = self._pending_states.pop(name, None)
+            if state is not None:
+                self._restore_export_state(export_loaded, name, state)
+            self._exports[slot] = export_loaded
+
+    def _import_export(self, name):
+        try:
+            logging.info(f"Loading module ´exports/{name}.py`.")
+            module = importlib.import_module("exports." + name)
+            logging.debug(f"Module ´{name}` imported successfully.")
+        except Exception as err:
+            logging.error(
+                f"Failed loading export ´{name}`: {err}"
+                + f". Please make sure ´{name}.py` exists in the exports folder."
+            )
+            return None
+        return module
+
+    def _set_failed(self, slot):
+        with self._lock:
+            self._failed.add(slot)
+
+    def _configure_export(self, module, exportconfig):
+        # Return the configured export, None if configuring failed with an
+        # exception and is retried, False if configure() returned False.
+        name = exportconfig.get("name")
+        try:
+            export_loaded = getattr(module, "export_" + name)()
+            if export_loaded.configure(exportconfig, self.inverter) is False:
+                logging.error(
+                    f"Failed configuring export ´{name}`, please check its configuration. The export is disabled."
+                )
+                return False
+            logging.info(f"Configured export ´{name}`.")
+        except Exception as err:
+            logging.error(f"Failed configuring export ´{name}`: {err}")
+            return None
+        return export_loaded
+
+    def get_state(self):
+        # Return the states of all configured exports keeping state between
+        # scrapes by export name, see StateCheckpoint.
+        state = {}
+        with self._lock:
+            for name, export in zip(self._names, self._exports):
+                if export is not None and hasattr(export, "get_state"):
+                    state[name] = export.get_state()
+            # Exports not configured yet keep their restored state:
+            for name, pending in self._pending_states.items():
+                state.setdefault(name, pending)
+        return state
+
+    def set_state(self, state):
+        # Restore the states of the exports. Exports which are not yet
+        # configured are restored as soon as they are configured.
+        with self._lock:
+            configured = {}
+            for name, export in zip(self._names, self._exports):
+                if export is not None:
+                    configured[name] = export
+            for name, export_state in state.items():
+                if name in configured:
+                    self._restore_export_state(configured[name], name, export_state)
+                else:
+                    self._pending_states[name] = export_state
+
+    def _restore_export_state(self, export, name, state):
+        if not hasattr(export, "set_state"):
+            return
+        try:
+            export.set_state(state)
+            logging.info(f"Restored state of export ´{name}`.")
+        except Exception as err:
+            logging.warning(f"Failed to restore state of export ´{name}`: {err}")
+
+    def publish(self, inverter):
+        # Publish the latest scrape to all configured exports and record the
+        # time every export takes.
+        for name, export in self._get_named_exports():
+            if export is None:
+                continue
+            start = time.perf_counter()
+            try:
+                success = export.publish(inverter) is not False
+            except Exception as e:
+                logging.exception("Failed to export: %s", e)
+                success = False
+            duration = time.perf_counter() - start
+            with self._lock:
+                entry = self._publish_metrics.get(name)
+                if entry is None:
+                    entry = self._publish_metrics[name] = [0, 0, 0.0, 0.0]
+                entry[0] += 1
+                if not success:
+                    entry[1] += 1
+                entry[2] += duration
+                entry[3] = duration
+
+    def get_metrics(self):
+        # Return the metrics of all configured exports by export name: the
+        # time taken by publishing and the metrics provided by the export
+        # itself, if any (e.g. the queue of a background writer).
+        metrics = {}
+        for name, export in self._get_named_exports():
+            if export is None:
+                continue
+            with self._lock:
+                publishes, failures, seconds, last_seconds = self._publish_metrics.get(name, [0, 0, 0.0, 0.0])
+            metrics[name] = {
+                "publishes": publishes,
+                "publish_failures": failures,
+                "publish_seconds": seconds,
+                "last_publish_seconds": last_seconds,
+            }
+            if hasattr(export, "get_metrics"):
+                metrics[name].update(export.get_metrics())
+        return metrics
+
+    def close(self):
+        # Give exports writing in the background the chance to finish, called
+        # on exit.
+        for name, export in self._get_named_exports():
+            if export is None or not hasattr(export, "close"):
+                continue
+            try:
+                export.close()
+            except Exception as err:
+                logging.warning(f"Failed to close export ´{name}`: {err}")
+
+    def _get_named_exports(self):
+        # Return (name, export) in the order of the configuration, the
+        # export is None if not configured yet.
+        with self._lock:
+            return list(zip(self._names, self._exports))
+
+    def get_exports(self):
+        # Return the list of exports which are configured and ready to be
+        # published.
+        with self._lock:
+            return [e for e in self._exports if e is not None]
@@ -5,31 +5,51 @@ import yaml
 import re
 import sys
 from JSONSchemaValidator import JSONSchemaValidator
+from RegisterCatalogCache import RegisterCatalogCache
+
+# Use the much faster C implementation of the yaml loader, if available:
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
 class FieldConfigurator:
-    def __init__(self, registers_filename, register_patch_config=None):
+    def __init__(
+        self, registers_filename, register_patch_config=None, cache_filename=None
+    ):
         # Filename of the yaml file to read register definitions from
         self._registers_filename = registers_filename
 
         # part of the configuration containing register patches
         self._patches = register_patch_config
 
+        # The cache for the loaded, validated and patched register
+        # configuration, None if caching is disabled.
+        self._cache = None
+        if cache_filename:
+            self._cache = RegisterCatalogCache(cache_filename)
+
         # The contents of the registers configuration file
         self.registers = None
 
     def get_register_config(self):
         # Return a fully configured lits of registers to read from the
         # inverter.  This includes reading the register definitions from a
-        # configuration file, then applying the register patches.
-        self._load_registers()
-        self._patch_registers()
+        # configuration file, then applying the register patches. If a valid
+        # cache file exists, the result is read from the cache instead.
+        if self._cache is not None:
+            key = self._cache.compute_key(self._registers_filename, self._patches)
+            self.registers = self._cache.load(key)
+        if self.registers is None:
+            self._load_registers()
+            self._patch_registers()
+            if self._cache is not None:
+                self._cache.store(key, self.registers)
         self.print_register_list()
         return self.registers
 
     def _load_registers(self):
         try:
-            regs = yaml.safe_load(open(self._registers_filename, encoding="utf-8"))
+            with open(self._registers_filename, encoding="utf-8") as f:
+                regs = yaml.load(f, Loader=YamlLoader)
             logging.info(
                 f"Loaded {self._registers_filename}, file version: {regs.get('version','UNKNOWN')}"
             )
@@ -78,8 +98,15 @@ class FieldConfigurator:
             *self.registers["registers"][1]["hold"],
         ]
 
+        # Index of all registers by name. Patches with a plain register name
+        # (the vast majority) are applied by looking up the name in the index
+        # instead of matching every register against the name.
+        index = {}
+        for reg in allregs:
+            index.setdefault(reg.get("name"), []).append(reg)
+
         for patch in self._patches:
-            self._apply_single_patch(patch, allregs)
+            self._apply_single_patch(patch, allregs, index)
 
         for reg in allregs:
             # only new registers have a type (assuming that no one tries to change the type of an attribute ...)
@@ -89,20 +116,61 @@ class FieldConfigurator:
                 self.registers["registers"][1]["hold"].append(reg)
         logging.info("... finished applying patches to register definitions.")
 
-    def _apply_single_patch(self, patch, allregs):
+    def _apply_single_patch(self, patch, allregs, index):
         # Apply one patch. A patch contains one or more attributes with
         # values to add or change in one or more registers.
         reg_name = patch.get("name")
         if reg_name is None:
             logging.error(f"´name` attribute missing, ignoring entry: {patch}.")
             return
-        for attribute_name in list(patch):
-            if attribute_name == "name":
-                # value of attribute ´name` is for matching the register,
-                # it doesn't contain a value for patching.
-                continue
-            attribute_value = patch.get(attribute_name)
-            self._patch_attribute(reg_name, attribute_name, attribute_value, allregs)
+        # value of attribute ´name` is for matching the register, it doesn't
+        # contain a value for patching:
+        attributes = [
+            (attribute_name, attribute_value)
+            for attribute_name, attribute_value in patch.items()
+            if attribute_name != "name"
+            and self._check_patch_value(attribute_name, attribute_value)
+        ]
+        if not attributes:
+            return
+
+        matches = self._find_matching_registers(reg_name, allregs, index)
+        if matches is None:
+            return
+
+        # If there was no match for an existing register, then this entry is
+        # intended to create a new register!
+        if not matches:
+            newreg = {}
+            newreg["name"] = reg_name
+            logging.debug(f"Adding new register ´{reg_name}`.")
+            allregs.append(newreg)
+            index.setdefault(reg_name, []).append(newreg)
+            # This still needs to be added to the ´read` or ´hold` register lists later!
+            matches = [newreg]
+
+        for reg in matches:
+            for attribute_name, attribute_value in attributes:
+                old_name = reg.get("name")
+                self._patch_register(reg, attribute_name, attribute_value)
+                if reg.get("name") != old_name:
+                    # The register was renamed, keep the index up to date:
+                    index[old_name].remove(reg)
+                    index.setdefault(reg.get("name"), []).append(reg)
+
+    def _find_matching_registers(self, reg_name, allregs, index):
+        # Return the list of registers whose name matches reg_name, which is
+        # either a plain register name or a regular expression. Return None
+        # if reg_name is not a valid regular expression.
+        if re.escape(reg_name) == reg_name:
+            # A plain name without any special characters matches only itself:
+            return list(index.get(reg_name, []))
+        try:
+            p = re.compile(reg_name)
+        except re.error:
+            logging.error(f"´{reg_name}` is not a valid ´name`!")
+            return None
+        return [reg for reg in allregs if p.fullmatch(reg.get("name"))]
 
     def _check_patch_value(self, attribute_name, attribute_value):
         # Check whether the type of attribute_value is allowed for
@@ -137,34 +205,6 @@ class FieldConfigurator:
             return False
         return True
 
-    def _patch_attribute(self, reg_name, attribute_name, attribute_value, allregs):
-        # Patch one attribute in all registers which match reg_name.
-        if not self._check_patch_value(attribute_name, attribute_value):
-            return False
-        try:
-            p = re.compile(reg_name)
-        except re.error:
-            logging.error(f"´{reg_name}` is not a valid ´name`!")
-            return False
-
-        # Try to find matches (may be more than one) and execute the patch:
-        pattern_did_match = False
-        for reg in allregs:
-            if p.fullmatch(reg.get("name")):
-                pattern_did_match = True
-                self._patch_register(reg, attribute_name, attribute_value)
-
-        # If there was no match for an existing register, then this entry is
-        # intended to create a new register!
-        if not pattern_did_match:
-            newreg = {}
-            newreg["name"] = reg_name
-            logging.debug(f"Adding new register ´{reg_name}`.")
-            self._patch_register(newreg, attribute_name, attribute_value)
-            allregs.append(newreg)
-            # This still needs to be added to the ´read` or ´hold` register lists later!
-        return True
-
     def _patch_register(self, reg, attribute_name, attribute_value):
         # Add or change one attribute (named attribute_name) to the value
         # attribute_value in one register (reg).
@@ -1,9 +1,67 @@
 #!/usr/bin/python3
 
+import ast
+import builtins
+import heapq
 import logging
+import time
 
 from datetime import datetime
 from datetime import date
+from FieldStatistics import FieldStatistics
+from RollingWindow import RollingFunctions
+
+# Names which make the result of an expression depend on the time of
+# evaluation, not only on the values of the fields it refers to. Expressions
+# referring to any of these are evaluated on every call.
+TIME_DEPENDENT_NAMES = {
+    "datetime",
+    "seconds_since_last_update",
+    "avg",
+    "rate",
+    "integral",
+}
+
+# Names of the rolling window functions. These refer to fields by a string
+# constant, e.g. ´avg("load_power", 300)`. min() and max() are time dependent
+# only if used this way.
+ROLLING_FUNCTION_NAMES = set(RollingFunctions.NAMES)
+
+# The names available in expressions and statements in addition to the
+# values and the builtins, see AbstractCode.set_namespace().
+DEFAULT_NAMESPACE = {"datetime": datetime}
+
+# Placeholder for fields not available in the values.
+_MISSING = object()
+
+
+def referenced_names(code):
+    # Return the set of global names referred to by a compiled code object,
+    # including names referred to by nested code objects (e.g. comprehensions
+    # and lambdas). Attribute names are included as well, which may add some
+    # names which are not actually field names. This is harmless.
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, "co_names"):
+            names |= referenced_names(const)
+    return names
+
+
+def raise_name_error(name):
+    # Raise the same error as referring to an undefined variable.
+    raise NameError(f"name '{name}' is not defined")
+
+
+def string_constants(code):
+    # Return the set of all string constants of a compiled code object and
+    # its nested code objects.
+    strings = set()
+    for const in code.co_consts:
+        if isinstance(const, str):
+            strings.add(const)
+        elif hasattr(const, "co_consts"):
+            strings |= string_constants(const)
+    return strings
 
 
 class AbstractCode:
@@ -30,6 +88,18 @@ class AbstractCode:
         # or "seconds".
         self.unit = unit
 
+        # Names available to the code in addition to the values. The values
+        # take precedence over these names.
+        self.namespace = DEFAULT_NAMESPACE
+
+        # Counters about the evaluation of the receiver, see
+        # FieldPostProcessor.get_statistics(). Failed evaluations are logged
+        # through the statistics to suppress repeated messages.
+        self.statistics = FieldStatistics(name)
+
+    def set_namespace(self, namespace):
+        self.namespace = namespace
+
     def evaluate(self, values):
         # Evaluate the expression or statement represented by the receiver. Any
         # variables referenced by the source must be provided in the values
@@ -51,7 +121,9 @@ class AbstractCode:
             # warning, because not all fields are always required to be
             # available in the result.  every time. So this is logged at level
             # INFO.
-            logging.warning(f"Entry ´{self.name}` not evaluated: {error}.")
+            self.statistics.record_exception(
+                f"Entry ´{self.name}` not evaluated: {error}."
+            )
             return self.do_fallback(values)
         return None
 
@@ -71,6 +143,54 @@ class AbstractCode:
         # subclasses.
         pass
 
+    def get_input_names(self):
+        # Return the set of field names the result of evaluating the receiver
+        # may depend on.
+        if self.code is None:
+            return set()
+        names = referenced_names(self.code)
+        if self.uses_rolling_functions():
+            # Rolling window functions refer to fields by string constants:
+            names |= string_constants(self.code)
+        return names
+
+    def uses_rolling_functions(self):
+        # Return True if the receiver calls a rolling window function with a
+        # field name.
+        if self.code is None:
+            return False
+        names = referenced_names(self.code)
+        return not ROLLING_FUNCTION_NAMES.isdisjoint(names) and bool(
+            string_constants(self.code)
+        )
+
+    def get_output_names(self):
+        # Return the set of field names the receiver may write on evaluation.
+        return {self.name}
+
+    def is_always_dirty(self):
+        # Return True if the receiver must be evaluated on every call, even if
+        # none of its input fields changed since the last evaluation.
+        return self.uses_rolling_functions() or not TIME_DEPENDENT_NAMES.isdisjoint(
+            self.get_input_names()
+        )
+
+    def get_state(self):
+        # Return a dictionary with the state the receiver keeps between
+        # evaluations, None if there is no such state. See StateCheckpoint.
+        return None
+
+    def set_state(self, state):
+        # Restore the state returned by get_state(). The behavior is defined
+        # by subclasses.
+        pass
+
+    def generate(self, builder):
+        # Add the code for evaluating the receiver to the function built by
+        # builder (see FieldFunctionBuilder). By default the receiver is
+        # evaluated by calling evaluate().
+        builder.add(f"{builder.bind(self)}.evaluate(_fpp_v)")
+
     def as_list_entry(self):
         entry = {"name": self.name}
         if self.unit is not None:
@@ -110,6 +230,31 @@ class FieldStatement(AbstractCode):
     def get_source_kind(self):
         return "exec"
 
+    def get_input_names(self):
+        # Statements may access fields by name via ´results`, so string
+        # constants are considered field names as well.
+        if self.code is None:
+            return set()
+        return referenced_names(self.code) | string_constants(self.code)
+
+    def get_output_names(self):
+        # Statements may write or delete any field in ´results`. This assumes
+        # the names of these fields appear as string constants.
+        if self.code is None:
+            return set()
+        return string_constants(self.code)
+
+    def is_always_dirty(self):
+        # Statements may have side effects and keep state in
+        # previous_results, they are evaluated every time.
+        return True
+
+    def get_state(self):
+        return {"previous_results": self.previous_results}
+
+    def set_state(self, state):
+        self.previous_results = state["previous_results"]
+
     def do_evaluate(self, values):
         # The values dictionary is added to the global scope with the name
         # ´results`. The code fragment is responsible to store any relevant
@@ -123,7 +268,7 @@ class FieldStatement(AbstractCode):
             {
                 "results": values,
                 "previous_results": self.previous_results,
-                "datetime": datetime,
+                **self.namespace,
                 **values,
             },
         )
@@ -138,7 +283,7 @@ class SimpleExpression(AbstractCode):
         return eval(
             self.code,
             {
-                "datetime": datetime,
+                **self.namespace,
                 **values,
             },
         )
@@ -174,10 +319,38 @@ class FieldExpression(SimpleExpression):
         self.guard = None
         if guard_expression is not None:
             self.guard = GuardExpression(field, guard_expression)
+            # Failures of the guard are counted for the receiver:
+            self.guard.statistics = self.statistics
 
         self.fallback = None
         if fallback_expression is not None:
             self.fallback = SimpleExpression(field, fallback_expression)
+            self.fallback.statistics = self.statistics
+
+    def set_namespace(self, namespace):
+        super().set_namespace(namespace)
+        if self.guard is not None:
+            self.guard.set_namespace(namespace)
+        if self.fallback is not None:
+            self.fallback.set_namespace(namespace)
+
+    def uses_rolling_functions(self):
+        return (
+            super().uses_rolling_functions()
+            or (self.guard is not None and self.guard.uses_rolling_functions())
+            or (self.fallback is not None and self.fallback.uses_rolling_functions())
+        )
+
+    def get_input_names(self):
+        # The result depends on the guard and the fallback as well. The
+        # current value of the field itself is always an input, because the
+        # write_mode depends on it and a field not written keeps its value.
+        names = super().get_input_names() | {self.name}
+        if self.guard is not None:
+            names |= self.guard.get_input_names()
+        if self.fallback is not None:
+            names |= self.fallback.get_input_names()
+        return names
 
     def write_mode_allows_writing(self, values):
         # Return True if the receiver should evaluate and write a result.
@@ -193,12 +366,13 @@ class FieldExpression(SimpleExpression):
 
     def do_evaluate(self, values):
         if self.guard and not self.guard.evaluate(values):
+            self.statistics.guard_skips += 1
             return None
         if self.write_mode_allows_writing(values):
             result = eval(
                 self.code,
                 {
-                    "datetime": datetime,
+                    **self.namespace,
                     **values,
                 },
             )
@@ -206,9 +380,105 @@ class FieldExpression(SimpleExpression):
             return result
         return None
 
+    def generate(self, builder):
+        # Add code behaving exactly like evaluate(), but reading the values
+        # directly from the values dictionary instead of copying them into a
+        # new dictionary for every expression, guard and fallback.
+        if self.code is None:
+            # evaluate() never has any effect in this case.
+            builder.add("pass")
+            return
+        if self.guard and self.guard.code is None:
+            # The guard never allows evaluating the expression.
+            builder.add(f"{builder.bind(self.statistics, 'stats')}.guard_skips += 1")
+            return
+        source = builder.rewrite(self.source, self.get_name_overrides(builder))
+        guard_source = None
+        if self.guard is not None:
+            guard_source = builder.rewrite(self.guard.source)
+        has_fallback_code = self.fallback is not None and self.fallback.code is not None
+        fallback_source = None
+        if has_fallback_code:
+            fallback_source = builder.rewrite(self.fallback.source)
+        if (
+            source is None
+            or (self.guard is not None and guard_source is None)
+            or (has_fallback_code and fallback_source is None)
+        ):
+            # The expression cannot be rewritten, evaluate it as usual:
+            super().generate(builder)
+            return
+
+        name = builder.bind(self.name, "name")
+        stats = builder.bind(self.statistics, "stats")
+        builder.add("try:")
+        with builder.indented():
+            if guard_source is not None:
+                builder.add("try:")
+                with builder.indented():
+                    builder.add(f"_fpp_ok = {guard_source}")
+                builder.add("except Exception as _fpp_error:")
+                with builder.indented():
+                    builder.add(
+                        f'{stats}.record_exception(f"Guard expression ´{{{name}}}` not evaluated: {{_fpp_error}}.")'
+                    )
+                    builder.add("_fpp_ok = False")
+                builder.add("if _fpp_ok:")
+                with builder.indented():
+                    self.generate_write(builder, source)
+                builder.add("else:")
+                with builder.indented():
+                    builder.add(f"{stats}.guard_skips += 1")
+            else:
+                self.generate_write(builder, source)
+        builder.add("except Exception as _fpp_error:")
+        with builder.indented():
+            builder.add(
+                f'{stats}.record_exception(f"Entry ´{{{name}}}` not evaluated: {{_fpp_error}}.")'
+            )
+            if self.fallback is None:
+                builder.add(f'logging.debug(f"no fallback for ´{{{name}}}` ...")')
+            else:
+                builder.add(f'logging.debug(f"evaluating fallback for ´{{{name}}}` ...")')
+                builder.add(f"{stats}.fallbacks += 1")
+                builder.add("_fpp_f = None")
+                if fallback_source is not None:
+                    builder.add("try:")
+                    with builder.indented():
+                        builder.add(f"_fpp_f = {fallback_source}")
+                    builder.add("except Exception as _fpp_error:")
+                    with builder.indented():
+                        builder.add(
+                            f'{stats}.record_exception(f"Entry ´{{{name}}}` not evaluated: {{_fpp_error}}.")'
+                        )
+                builder.add("if _fpp_f is not None:")
+                with builder.indented():
+                    builder.add(f"_fpp_v[{name}] = _fpp_f")
+
+    def get_name_overrides(self, builder):
+        # Return a dictionary of names in the expression which are not looked
+        # up in the values, with the source to use instead as values.
+        return {}
+
+    def generate_write(self, builder, source):
+        # Add the code for writing the result of the expression.
+        name = builder.bind(self.name, "name")
+        if self.write_mode is None:
+            builder.add(f"_fpp_v[{name}] = {source}")
+            return
+        if self.write_mode == "replace_only":
+            builder.add(f"if _fpp_v.get({name}) is not None:")
+        elif self.write_mode == "new_only":
+            builder.add(f"if _fpp_v.get({name}) is None:")
+        else:
+            builder.add("if False:")
+        with builder.indented():
+            builder.add(f"_fpp_v[{name}] = {source}")
+
     def do_fallback(self, values):
         if self.fallback is not None:
             logging.debug(f"evaluating fallback for ´{self.name}` ...")
+            self.statistics.fallbacks += 1
             fallback_result = self.fallback.evaluate(values)
             if fallback_result is not None:
                 values[self.name] = fallback_result
@@ -250,6 +520,11 @@ class AggregatingFieldExpression(FieldExpression):
             unit=unit,
         )
 
+        # A function returning the current time as datetime. It can be
+        # replaced to evaluate values with other timestamps, e.g. recorded
+        # data.
+        self.clock = datetime.now
+
         # Remember the previous value to make it available when evaluating the
         # receiver. This is always a numeric value, the default is 0.
         self.previous_value = 0
@@ -264,37 +539,72 @@ class AggregatingFieldExpression(FieldExpression):
         # basis.
         self.reset_daily = aggregation_mode == "daily"
 
+    def restart(self, now):
+        # Reset the receiver as if it was created at now (a datetime).
+        self.previous_value = 0
+        self.last_update = datetime.combine(now.date(), datetime.min.time())
+
+    def is_always_dirty(self):
+        # The result is added to a running total on every evaluation.
+        return True
+
+    def get_state(self):
+        return {"previous_value": self.previous_value, "last_update": self.last_update}
+
+    def set_state(self, state):
+        # A daily value of a previous day is reset on the next evaluation, see
+        # reset_previous_value_if_required().
+        self.previous_value = state["previous_value"]
+        self.last_update = state["last_update"]
+
     def seconds_since_last_update(self):
         # Return the number of seconds since self.last_update. This method is
         # made available to the local scope in evaluation of the receiver, so
         # that expressions can use it.
-        return (datetime.now() - self.last_update).total_seconds()
+        return (self.clock() - self.last_update).total_seconds()
 
     def do_evaluate(self, values):
         # reset self.previous_value to 0 if the last update was yesterday and
         # daily reset is configured.
         if self.guard and not self.guard.evaluate(values):
+            self.statistics.guard_skips += 1
             return None
         self.reset_previous_value_if_required()
         # Now evaluate the receiver
         result = eval(
             self.code,
             {
-                "datetime": datetime,
+                **self.namespace,
                 **values,
             },
             {
                 "seconds_since_last_update": self.seconds_since_last_update,
             },
         )
+        self.add_to_total(values, result)
+
+    def add_to_total(self, values, result):
         # store result by adding to the previous result:
         values[self.name] = self.previous_value + result
         # remember value and timestamp for next evaluation:
         self.previous_value = self.previous_value + result
-        self.last_update = datetime.now()
+        self.last_update = self.clock()
+
+    def get_name_overrides(self, builder):
+        # seconds_since_last_update() is provided in the local scope in
+        # do_evaluate(), so it takes precedence over any value of that name.
+        return {
+            "seconds_since_last_update": f"{builder.bind(self)}.seconds_since_last_update"
+        }
+
+    def generate_write(self, builder, source):
+        # The write_mode is ignored for aggregated fields, see do_evaluate().
+        me = builder.bind(self)
+        builder.add(f"{me}.reset_previous_value_if_required()")
+        builder.add(f"{me}.add_to_total(_fpp_v, {source})")
 
     def reset_previous_value_if_required(self):
-        last_update_was_yesterday = datetime.now().date() > self.last_update.date()
+        last_update_was_yesterday = self.clock().date() > self.last_update.date()
         if self.reset_daily and last_update_was_yesterday:
             self.previous_value = 0
 
@@ -309,15 +619,202 @@ class GuardExpression(SimpleExpression):
             return eval(
                 self.code,
                 {
-                    "datetime": datetime,
+                    **self.namespace,
                     **values,
                 },
             )
         except Exception as error:
-            logging.warning(f"Guard expression ´{self.name}` not evaluated: {error}.")
+            self.statistics.record_exception(
+                f"Guard expression ´{self.name}` not evaluated: {error}."
+            )
             return False
 
 
+class ExpressionRewriter(ast.NodeTransformer):
+    # This class rewrites the syntax tree of an expression, so that every
+    # variable is looked up in the dictionary of values ´_fpp_v` first. This
+    # resolves names exactly like evaluating the expression with the values
+    # as globals. Names bound within the expression (by lambdas and
+    # comprehensions) are left alone.
+
+    # Prefix of all names used by the generated code. Expressions using names
+    # with this prefix are not rewritten.
+    PREFIX = "_fpp_"
+
+    def __init__(self, functions, overrides=None):
+        # Names available in addition to the values (like ´datetime`) with
+        # the names they are bound to in the generated code:
+        self.functions = functions
+        # Names to replace by a fixed source instead of a lookup:
+        self.overrides = overrides if overrides is not None else {}
+        # Stack of sets of names bound in the nested scopes:
+        self.bound = []
+        self.supported = True
+
+    def rewrite(self, source):
+        # Return the rewritten source of the expression or None if it cannot
+        # be rewritten.
+        try:
+            tree = ast.parse(source, mode="eval")
+        except Exception:
+            return None
+        for node in ast.walk(tree):
+            if isinstance(node, ast.NamedExpr):
+                # Assignments within expressions are not supported.
+                return None
+            identifier = getattr(node, "id", None) or getattr(node, "arg", None)
+            if isinstance(identifier, str) and identifier.startswith(self.PREFIX):
+                return None
+        tree = self.visit(tree)
+        if not self.supported:
+            return None
+        return "(" + ast.unparse(tree.body) + ")"
+
+    def is_bound(self, name):
+        for names in self.bound:
+            if name in names:
+                return True
+        return False
+
+    def lookup(self, name):
+        # Return the syntax tree for looking up name.
+        if name in self.overrides:
+            default = self.overrides[name]
+            return ast.parse(default, mode="eval").body
+        if name in self.functions:
+            default = self.functions[name]
+        elif hasattr(builtins, name):
+            default = name
+        else:
+            default = f"_fpp_raise_name_error({name!r})"
+        return ast.parse(
+            f"(_fpp_v[{name!r}] if {name!r} in _fpp_v else {default})", mode="eval"
+        ).body
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            # Only comprehension targets are assigned in expressions.
+            return node
+        if self.is_bound(node.id):
+            return node
+        return ast.copy_location(self.lookup(node.id), node)
+
+    def visit_Lambda(self, node):
+        # Defaults are evaluated in the enclosing scope:
+        node.args = self.visit(node.args)
+        args = node.args
+        names = {a.arg for a in [*args.posonlyargs, *args.args, *args.kwonlyargs]}
+        if args.vararg is not None:
+            names.add(args.vararg.arg)
+        if args.kwarg is not None:
+            names.add(args.kwarg.arg)
+        self.bound.append(names)
+        node.body = self.visit(node.body)
+        self.bound.pop()
+        return node
+
+    def visit_comprehension_node(self, node, fields):
+        # The iterable of the first generator is evaluated in the enclosing
+        # scope, everything else in the scope of the comprehension.
+        generators = node.generators
+        names = set()
+        generators[0].iter = self.visit(generators[0].iter)
+        self.bound.append(names)
+        for i, generator in enumerate(generators):
+            if i > 0:
+                generator.iter = self.visit(generator.iter)
+            for target in ast.walk(generator.target):
+                if isinstance(target, ast.Name):
+                    names.add(target.id)
+            generator.ifs = [self.visit(condition) for condition in generator.ifs]
+        for field in fields:
+            setattr(node, field, self.visit(getattr(node, field)))
+        self.bound.pop()
+        return node
+
+    def visit_ListComp(self, node):
+        return self.visit_comprehension_node(node, ["elt"])
+
+    def visit_SetComp(self, node):
+        return self.visit_comprehension_node(node, ["elt"])
+
+    def visit_GeneratorExp(self, node):
+        return self.visit_comprehension_node(node, ["elt"])
+
+    def visit_DictComp(self, node):
+        return self.visit_comprehension_node(node, ["key", "value"])
+
+
+class FieldFunctionBuilder:
+    # This class generates the source of one Python function evaluating all
+    # custom field definitions and compiles it. Objects the generated code
+    # refers to (e.g. field names or the expression objects) are bound to
+    # names in the globals of the function.
+
+    def __init__(self):
+        self.lines = []
+        self.level = 1
+        self.namespace = {
+            "datetime": datetime,
+            "logging": logging,
+            "_fpp_M": _MISSING,
+            "_fpp_raise_name_error": raise_name_error,
+            "_fpp_perf_counter": time.perf_counter,
+        }
+        # Names of the bound objects by their id:
+        self._bound_names = {}
+
+        # Names of the bound functions available to expressions by their
+        # names in expressions, see set_functions():
+        self.functions = {}
+
+    def set_functions(self, namespace):
+        # Make the objects in namespace available to expressions under their
+        # names in namespace.
+        self.functions = {
+            name: self.bind(obj, "fn_" + name) for name, obj in namespace.items()
+        }
+
+    def add(self, line):
+        self.lines.append("    " * self.level + line)
+
+    def indented(self):
+        return _Indentation(self)
+
+    def bind(self, obj, hint="obj"):
+        # Make obj available to the generated code and return its name.
+        key = (id(obj), hint)
+        name = self._bound_names.get(key)
+        if name is None:
+            name = f"_fpp_{hint}{len(self._bound_names)}"
+            self._bound_names[key] = name
+            self.namespace[name] = obj
+        return name
+
+    def rewrite(self, source, overrides=None):
+        return ExpressionRewriter(self.functions, overrides).rewrite(source)
+
+    def build(self, name="_fpp_evaluate", arguments="_fpp_v"):
+        # Compile the generated code and return the function.
+        source = f"def {name}({arguments}):\n" + "\n".join(self.lines or ["    pass"])
+        logging.debug(f"Generated code for custom fields:\n{source}")
+        exec(compile(source, "<customfields>", "exec"), self.namespace)
+        return self.namespace[name]
+
+
+class _Indentation:
+    # Context manager for indenting the code added to a FieldFunctionBuilder.
+
+    def __init__(self, builder):
+        self.builder = builder
+
+    def __enter__(self):
+        self.builder.level += 1
+
+    def __exit__(self, *args):
+        self.builder.level -= 1
+
+
 class CodeObjectFactory:
     # The responsibility of this class is to create an instance of a suitable
     # class for a custom field definition entry. It has only one class method.
@@ -389,6 +886,12 @@ class CodeObjectFactory:
 
 
 class FieldPostProcessor:
+    # The FieldPostProcessor evaluates the custom field definitions. The
+    # definitions are evaluated in an order where every field is calculated
+    # before any field referring to it. Definitions are evaluated only if the
+    # values of their input fields changed since their last evaluation,
+    # otherwise their previous result is written again.
+
     def __init__(self, cf_definitions):
         self.expressions = []
         if cf_definitions is not None:
@@ -400,13 +903,308 @@ class FieldPostProcessor:
         if len(self.expressions) == 0:
             logging.info("No custom fields configured.")
 
-    def evaluate(self, values):
+        # The rolling window functions, e.g. ´avg("load_power", 300)`, and
+        # all other names available to expressions and statements:
+        self.rolling_functions = RollingFunctions()
+        self.namespace = {
+            **DEFAULT_NAMESPACE,
+            **self.rolling_functions.get_functions(),
+        }
+        for e in self.expressions:
+            e.set_namespace(self.namespace)
+
+        # The expressions in the order of evaluation:
+        self.evaluation_order = self.sort_by_dependencies(self.expressions)
+
+        # For every expression in evaluation order: the names of its input
+        # fields (None if it is always evaluated), the values of these inputs
+        # and the value of the field after its last evaluation.
+        self._input_names = [
+            None if e.is_always_dirty() else tuple(e.get_input_names())
+            for e in self.evaluation_order
+        ]
+        self._last_inputs = [None] * len(self.evaluation_order)
+        self._last_results = [_MISSING] * len(self.evaluation_order)
+
+        # One function evaluating all expressions, see build_function():
+        self._function = None
+        try:
+            self._function = self.build_function()
+        except Exception:
+            logging.exception(
+                "Failed generating code for custom fields, evaluating them one by one."
+            )
+
+    @staticmethod
+    def sort_by_dependencies(expressions):
+        # Return the expressions sorted topologically by their dependencies.
+        # An expression reading a field depends on the expressions writing
+        # this field before it in the configuration. If there is no such
+        # expression, it depends on all expressions writing the field after it
+        # in the configuration, so it does not read a stale or missing value.
+        # Apart from this the configured order is preserved. If the
+        # dependencies are cyclic the configured order is used.
+        n = len(expressions)
+        writers = {}
+        for i, e in enumerate(expressions):
+            for name in e.get_output_names():
+                writers.setdefault(name, []).append(i)
+
+        successors = [set() for _ in range(n)]
+        for i, e in enumerate(expressions):
+            for name in e.get_input_names():
+                name_writers = [w for w in writers.get(name, []) if w != i]
+                earlier = [w for w in name_writers if w < i]
+                if earlier or name in e.get_output_names():
+                    # Fields written by the expression itself only depend on
+                    # earlier writers, see below.
+                    dependencies = earlier
+                else:
+                    # Statements write fields only as a side effect, they are
+                    # not moved before earlier readers:
+                    dependencies = [
+                        w
+                        for w in name_writers
+                        if not isinstance(expressions[w], FieldStatement)
+                    ]
+                for w in dependencies:
+                    successors[w].add(i)
+            # Expressions writing the same field keep their order:
+            for name in e.get_output_names():
+                for w in writers[name]:
+                    if w > i:
+                        successors[i].add(w)
+
+        in_degree = [0] * n
+        for i in range(n):
+            for j in successors[i]:
+                in_degree[j] += 1
+        # Kahn's algorithm, always picking the first expression in
+        # configuration order among all expressions ready for evaluation:
+        ready = [i for i in range(n) if in_degree[i] == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            i = heapq.heappop(ready)
+            order.append(i)
+            for j in successors[i]:
+                in_degree[j] -= 1
+                if in_degree[j] == 0:
+                    heapq.heappush(ready, j)
+
+        if len(order) < n:
+            cyclic = [expressions[i].name for i in range(n) if in_degree[i] > 0]
+            logging.warning(
+                f"Cyclic dependencies between custom fields {cyclic}, evaluating in configured order."
+            )
+            return list(expressions)
+        if order != list(range(n)):
+            logging.info(
+                "Custom fields are evaluated in order of their dependencies: "
+                + f"{[expressions[i].name for i in order]}."
+            )
+        return [expressions[i] for i in order]
+
+    def build_function(self):
+        # Generate and compile one function evaluating all expressions in
+        # evaluation order. The function has the same effect as
+        # evaluate_one_by_one(), but avoids copying the values into a new
+        # dictionary for each expression, guard and fallback. The function
+        # returns the number of expressions skipped because their inputs did
+        # not change. The time of every evaluation is recorded in the
+        # statistics of the expression.
+        builder = FieldFunctionBuilder()
+        builder.namespace["_fpp_same"] = self.same_values
+        builder.set_functions(self.namespace)
+        builder.add("_fpp_skipped = 0")
+        for i, e in enumerate(self.evaluation_order):
+            builder.add(f"# {e.__class__.__name__} {e.name!r}")
+            input_names = self._input_names[i]
+            stats = builder.bind(e.statistics, "stats")
+            if input_names is None:
+                self.generate_timed(builder, e, stats)
+                continue
+            name = builder.bind(e.name, "name")
+            inputs = "".join(f"_fpp_v.get({n!r}, _fpp_M), " for n in input_names)
+            builder.add(f"_fpp_in = ({inputs})")
+            builder.add(f"_fpp_li = _fpp_last_inputs[{i}]")
+            builder.add("if _fpp_li is not None and _fpp_same(_fpp_in, _fpp_li):")
+            with builder.indented():
+                builder.add(f"_fpp_r = _fpp_last_results[{i}]")
+                builder.add("if _fpp_r is not _fpp_M:")
+                with builder.indented():
+                    builder.add(f"_fpp_v[{name}] = _fpp_r")
+                builder.add("_fpp_skipped += 1")
+                builder.add(f"{stats}.skipped += 1")
+            builder.add("else:")
+            with builder.indented():
+                self.generate_timed(builder, e, stats)
+                builder.add(f"_fpp_last_inputs[{i}] = _fpp_in")
+                builder.add(f"_fpp_last_results[{i}] = _fpp_v.get({name}, _fpp_M)")
+        builder.add("return _fpp_skipped")
+        return builder.build(
+            arguments="_fpp_v, _fpp_last_inputs, _fpp_last_results"
+        )
+
+    @staticmethod
+    def generate_timed(builder, e, stats):
+        # Add the code of expression e, recording the time taken in stats.
+        builder.add("_fpp_t = _fpp_perf_counter()")
+        e.generate(builder)
+        builder.add(f"{stats}.record_time(_fpp_perf_counter() - _fpp_t)")
+
+    def evaluate(self, values, now=None):
         # Calculate all expressions using the values and storing the results in values.
+        # now is the time of the values in seconds since the epoch, used by
+        # the sliding window functions (the current time if None).
+        if self._function is None:
+            return self.evaluate_one_by_one(values, now)
         logging.info("Start evaluating custom field definitions ...")
+        self.rolling_functions.begin(values, now=now)
+        skipped = self._function(values, self._last_inputs, self._last_results)
+        logging.info(
+            f"... finished evaluating custom field definitions ({skipped} unchanged)."
+        )
+        # Formatted only if logged, formatting decodes all values of a
+        # LazyScrape:
+        logging.debug("values after evaluating custom field definitions: %s", values)
+
+    def evaluate_one_by_one(self, values, now=None):
+        # Calculate all expressions by calling evaluate() for each of them.
+        logging.info("Start evaluating custom field definitions ...")
+        self.rolling_functions.begin(values, now=now)
+        skipped = 0
+        for i, e in enumerate(self.evaluation_order):
+            input_names = self._input_names[i]
+            if input_names is None:
+                self.evaluate_timed(e, values)
+                continue
+            inputs = tuple(values.get(name, _MISSING) for name in input_names)
+            last_inputs = self._last_inputs[i]
+            if last_inputs is not None and self.same_values(inputs, last_inputs):
+                # Nothing changed, the result would be the same as before:
+                if self._last_results[i] is not _MISSING:
+                    values[e.name] = self._last_results[i]
+                skipped += 1
+                e.statistics.skipped += 1
+                continue
+            self.evaluate_timed(e, values)
+            self._last_inputs[i] = inputs
+            self._last_results[i] = values.get(e.name, _MISSING)
+        logging.info(
+            f"... finished evaluating custom field definitions ({skipped} unchanged)."
+        )
+        # Formatted only if logged, formatting decodes all values of a
+        # LazyScrape:
+        logging.debug("values after evaluating custom field definitions: %s", values)
+
+    @staticmethod
+    def evaluate_timed(e, values):
+        # Evaluate expression e, recording the time taken in its statistics.
+        start = time.perf_counter()
+        e.evaluate(values)
+        e.statistics.record_time(time.perf_counter() - start)
+
+    def get_state(self):
+        # Return a dictionary with the state of all entries keeping state
+        # between evaluations, see StateCheckpoint.
+        state = {}
+        for key, e in self.get_state_keys():
+            entry_state = e.get_state()
+            if entry_state is not None:
+                state[key] = entry_state
+        return state
+
+    def set_state(self, state):
+        # Restore the state returned by get_state(). Entries not found in
+        # state keep their initial state.
+        for key, e in self.get_state_keys():
+            if key in state:
+                try:
+                    e.set_state(state[key])
+                except Exception as err:
+                    logging.warning(f"Failed to restore state of entry ´{e.name}`: {err}")
+
+    def get_state_keys(self):
+        # Return a list of (key, entry) pairs. The key is the name of the
+        # entry, followed by the number of the entry if several entries have
+        # the same name (e.g. ´power#2`).
+        keys = []
+        counts = {}
         for e in self.expressions:
-            e.evaluate(values)
-        logging.info("... finished evaluating custom field definitions.")
-        logging.debug(f"values after evaluating custom field definitions: {values}")
+            counts[e.name] = counts.get(e.name, 0) + 1
+            if counts[e.name] == 1:
+                keys.append((e.name, e))
+            else:
+                keys.append((f"{e.name}#{counts[e.name]}", e))
+        return keys
+
+    def get_statistics(self):
+        # Return a list with a dictionary of the statistics of every custom
+        # field definition in the order of the configuration, see
+        # FieldStatistics.as_dict().
+        return [e.statistics.as_dict() for e in self.expressions]
+
+    def print_statistics(self):
+        # Print a table of the statistics of all custom field definitions,
+        # the most expensive definitions first.
+        if len(self.expressions) == 0:
+            return
+        statistics = sorted(
+            self.get_statistics(), key=lambda s: s["total_time"], reverse=True
+        )
+        max_name_len = max(len("custom field"), *(len(s["name"]) for s in statistics))
+        table_width = 75 + max_name_len
+        total_time = sum(s["total_time"] for s in statistics)
+
+        bar = "+" + str.ljust("", table_width, "-") + "+"
+
+        print(bar)
+        print(
+            "| "
+            + str.ljust(
+                f"Custom field statistics, total time {total_time * 1000:.1f} ms.",
+                table_width - 2,
+            )
+            + " |"
+        )
+        print(bar)
+        print(
+            "| "
+            + str.ljust("custom field", max_name_len)
+            + " | {:>8} | {:>8} | {:>10} | {:>8} | {:>6} | {:>6} | {:>6} |".format(
+                "evals", "skipped", "total ms", "max ms", "errors", "guard", "fallb."
+            )
+        )
+        print(bar)
+        for s in statistics:
+            print(
+                "| "
+                + str.ljust(s["name"], max_name_len)
+                + " | {:>8} | {:>8} | {:>10.1f} | {:>8.3f} | {:>6} | {:>6} | {:>6} |".format(
+                    s["evaluations"],
+                    s["skipped"],
+                    s["total_time"] * 1000,
+                    s["max_time"] * 1000,
+                    s["exceptions"],
+                    s["guard_skips"],
+                    s["fallbacks"],
+                )
+            )
+        print(bar)
+        for s in statistics:
+            if s["last_exception"] is not None:
+                print(f"Last error of ´{s['name']}`: {s['last_exception']}")
+
+    @staticmethod
+    def same_values(values, other_values):
+        # Return True if both tuples contain the same values. Values of
+        # different types are considered different, even if they are equal
+        # (e.g. 1 and 1.0), because they may lead to different results.
+        for a, b in zip(values, other_values):
+            if a is not b and (type(a) is not type(b) or a != b):
+                return False
+        return True
 
     def get_field_list(self):
         the_list = []
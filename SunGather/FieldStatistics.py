@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+import logging
+import time
+
+
+class FieldStatistics:
+    # This class collects statistics about the evaluation of one custom field
+    # definition and limits the log messages about failed evaluations: a
+    # message is logged once, identical messages are suppressed for
+    # LOG_INTERVAL seconds and then logged with the number of suppressed
+    # repetitions.
+
+    # Seconds to suppress identical log messages:
+    LOG_INTERVAL = 3600
+
+    __slots__ = [
+        "name",
+        "evaluations",
+        "skipped",
+        "total_time",
+        "max_time",
+        "exceptions",
+        "last_exception",
+        "guard_skips",
+        "fallbacks",
+        "_messages",
+    ]
+
+    def __init__(self, name):
+        self.name = name
+        # Number of evaluations and evaluations skipped because no input
+        # changed:
+        self.evaluations = 0
+        self.skipped = 0
+        # Cumulative and maximum time of all evaluations in seconds:
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # Number of failed evaluations (including guards and fallbacks) and
+        # the message of the last failure:
+        self.exceptions = 0
+        self.last_exception = None
+        # Number of evaluations skipped by the guard and of fallbacks used:
+        self.guard_skips = 0
+        self.fallbacks = 0
+        # For every message logged: [time logged, number suppressed since]
+        self._messages = {}
+
+    def record_time(self, duration):
+        self.evaluations += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+
+    def record_exception(self, message):
+        # Count a failed evaluation and log message at level WARNING, unless
+        # the same message was logged within the last LOG_INTERVAL seconds.
+        self.exceptions += 1
+        self.last_exception = message
+        now = time.monotonic()
+        logged = self._messages.get(message)
+        if logged is None:
+            if len(self._messages) > 100:
+                # Forget old messages, e.g. messages containing changing
+                # values:
+                self._messages.clear()
+            self._messages[message] = [now, 0]
+            logging.warning(message)
+        elif now - logged[0] >= self.LOG_INTERVAL:
+            logging.warning(
+                f"{message} (repeated {logged[1]} times in the last {int(now - logged[0])} seconds)"
+            )
+            logged[0] = now
+            logged[1] = 0
+        else:
+            logged[1] += 1
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "evaluations": self.evaluations,
+            "skipped": self.skipped,
+            "total_time": self.total_time,
+            "max_time": self.max_time,
+            "exceptions": self.exceptions,
+            "last_exception": self.last_exception,
+            "guard_skips": self.guard_skips,
+            "fallbacks": self.fallbacks,
+        }
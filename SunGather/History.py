@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+
+import logging
+import math
+import struct
+import threading
+
+from collections import deque
+
+
+class BitWriter:
+    # Appends values of any number of bits to a bytearray, most significant
+    # bit first.
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._accumulator = 0
+        self._bits = 0
+
+    def write(self, value, bits):
+        self._accumulator = (self._accumulator << bits) | value
+        self._bits += bits
+        while self._bits >= 8:
+            self._bits -= 8
+            self.buffer.append((self._accumulator >> self._bits) & 0xFF)
+        self._accumulator &= (1 << self._bits) - 1
+
+    def get_bytes(self):
+        # Return the bits written so far, the last byte padded with zeros.
+        if self._bits == 0:
+            return bytes(self.buffer)
+        return bytes(self.buffer) + bytes([(self._accumulator << (8 - self._bits)) & 0xFF])
+
+    def __len__(self):
+        return len(self.buffer) + 1
+
+
+class BitReader:
+    # Reads values written by a BitWriter.
+
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+        self._accumulator = 0
+        self._bits = 0
+
+    def read(self, bits):
+        while self._bits < bits:
+            self._accumulator = (self._accumulator << 8) | self._data[self._position]
+            self._position += 1
+            self._bits += 8
+        self._bits -= bits
+        value = self._accumulator >> self._bits
+        self._accumulator &= (1 << self._bits) - 1
+        return value
+
+
+def float_to_bits(value):
+    return struct.unpack(">Q", struct.pack(">d", value))[0]
+
+
+def bits_to_float(bits):
+    return struct.unpack(">d", struct.pack(">Q", bits))[0]
+
+
+class Block:
+    # A Block holds the compressed values of one register at consecutive
+    # scrapes, like in Gorilla (Facebook's in-memory time series database):
+    # timestamps (in seconds) as delta of deltas, values as XOR with the
+    # previous value, writing only the bits between the leading and
+    # trailing zeros. Regular scrapes cost 1 bit for the timestamp, unchanged
+    # values 1 bit for the value.
+
+    # Ranges of the delta of deltas as (prefix, bits of the prefix, bits of
+    # the value), a delta of deltas of 0 is written as a single 0 bit:
+    DOD_ENCODINGS = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b1111, 4, 32)]
+
+    def __init__(self, timestamp, value):
+        self.first_time = timestamp
+        self.last_time = timestamp
+        self.first_value = value
+        self.count = 1
+        self._writer = BitWriter()
+        self._last_delta = 0
+        self._last_bits = float_to_bits(value)
+        # The window of meaningful bits of the last XOR, see add():
+        self._leading = -1
+        self._trailing = 0
+        # The encoded values when the block is closed, see close():
+        self.data = None
+
+    def add(self, timestamp, value):
+        writer = self._writer
+        delta = timestamp - self.last_time
+        dod = delta - self._last_delta
+        if dod == 0:
+            writer.write(0, 1)
+        else:
+            for prefix, prefix_bits, bits in self.DOD_ENCODINGS:
+                offset = (1 << (bits - 1)) - 1
+                if -offset <= dod <= offset + 1 or bits == 32:
+                    writer.write(prefix, prefix_bits)
+                    writer.write((dod + offset) & ((1 << bits) - 1), bits)
+                    break
+        self._last_delta = delta
+        self.last_time = timestamp
+
+        value_bits = float_to_bits(value)
+        xor = value_bits ^ self._last_bits
+        self._last_bits = value_bits
+        if xor == 0:
+            writer.write(0, 1)
+        else:
+            leading = min(64 - xor.bit_length(), 31)
+            trailing = (xor & -xor).bit_length() - 1
+            if self._leading >= 0 and leading >= self._leading and trailing >= self._trailing:
+                # The meaningful bits fit into the window of the last XOR:
+                writer.write(0b10, 2)
+                writer.write(xor >> self._trailing, 64 - self._leading - self._trailing)
+            else:
+                meaningful = 64 - leading - trailing
+                writer.write(0b11, 2)
+                writer.write(leading, 5)
+                writer.write(meaningful & 63, 6)
+                writer.write(xor >> trailing, meaningful)
+                self._leading = leading
+                self._trailing = trailing
+        self.count += 1
+
+    def close(self):
+        # No more values are added, keep the encoded bytes only.
+        self.data = self._writer.get_bytes()
+        self._writer = None
+
+    def get_size(self):
+        # Return the number of bytes used by the encoded values.
+        return len(self.data) if self.data is not None else len(self._writer)
+
+    def get_reader(self):
+        # Return the encoded values and their count. Closed blocks are not
+        # changed anymore, for open blocks the values added so far are
+        # copied.
+        if self.data is not None:
+            return self.data, self.count
+        return self._writer.get_bytes(), self.count
+
+    @classmethod
+    def decode(cls, first_time, first_value, data, count):
+        # Yield the (timestamp, value) pairs of a block.
+        yield first_time, first_value
+        reader = BitReader(data)
+        timestamp = first_time
+        delta = 0
+        value_bits = float_to_bits(first_value)
+        leading = 0
+        trailing = 0
+        for _ in range(count - 1):
+            if reader.read(1):
+                for prefix, prefix_bits, bits in cls.DOD_ENCODINGS[:-1]:
+                    if not reader.read(1):
+                        break
+                else:
+                    bits = 32
+                offset = (1 << (bits - 1)) - 1
+                delta += reader.read(bits) - offset
+            timestamp += delta
+            if reader.read(1):
+                if reader.read(1):
+                    leading = reader.read(5)
+                    meaningful = reader.read(6) or 64
+                    trailing = 64 - leading - meaningful
+                value_bits ^= reader.read(64 - leading - trailing) << trailing
+            yield timestamp, bits_to_float(value_bits)
+
+
+class History:
+    # This class keeps the values of selected registers of the last hours in
+    # memory, compressed per register in blocks (see Block), so charts of the
+    # recent past do not need a database. Blocks older than the configured
+    # number of hours are dropped. If the memory used exceeds the budget,
+    # the oldest blocks are dropped as well.
+
+    # Values per block, blocks are the unit of dropping old values:
+    BLOCK_SIZE = 256
+    # Estimated bytes used by a block in addition to its encoded values:
+    BLOCK_OVERHEAD = 200
+
+    def __init__(self, registers, hours=24, max_size=8):
+        self.registers = list(registers)
+        self.retention = hours * 3600
+        self.max_size = max_size * 1024 * 1024
+        # For every register the blocks, oldest first. The last block is
+        # open for adding values.
+        self.blocks = {register: deque() for register in self.registers}
+        self.size = 0
+        # Queries are answered from other threads (e.g. by the webserver):
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        # Create History from the configuration section ´history` of the
+        # inverter. Return None if no history is configured.
+        if not config or not config.get("registers"):
+            return None
+        history = cls(
+            config["registers"],
+            hours=config.get("hours", 24),
+            max_size=config.get("max_size", 8),
+        )
+        logging.info(
+            f"Keeping the history of {len(history.registers)} registers for {config.get('hours', 24)} hours."
+        )
+        return history
+
+    def add(self, values, timestamp):
+        # Add the values of a scrape at timestamp (in seconds since the
+        # epoch). Values which are not finite numbers are skipped.
+        timestamp = round(timestamp)
+        with self._lock:
+            for register in self.registers:
+                value = values.get(register)
+                if type(value) not in (int, float, bool) or not math.isfinite(value):
+                    continue
+                self.add_value(self.blocks[register], timestamp, float(value))
+            self.drop_blocks(timestamp - self.retention)
+
+    def add_value(self, blocks, timestamp, value):
+        if blocks:
+            block = blocks[-1]
+            if timestamp <= block.last_time:
+                # E.g. the clock was set back, keep the order of values:
+                return
+            if block.count < self.BLOCK_SIZE:
+                size = block.get_size()
+                block.add(timestamp, value)
+                self.size += block.get_size() - size
+                return
+            size = block.get_size()
+            block.close()
+            self.size += block.get_size() - size
+        blocks.append(Block(timestamp, value))
+        self.size += self.BLOCK_OVERHEAD + blocks[-1].get_size()
+
+    def drop_blocks(self, oldest_time):
+        # Drop blocks with values older than oldest_time only, then the
+        # oldest blocks until the size is within the budget. Open blocks are
+        # kept.
+        for blocks in self.blocks.values():
+            while len(blocks) > 1 and blocks[0].last_time < oldest_time:
+                self.drop_first(blocks)
+        while self.size > self.max_size:
+            candidates = [blocks for blocks in self.blocks.values() if len(blocks) > 1]
+            if not candidates:
+                break
+            self.drop_first(min(candidates, key=lambda blocks: blocks[0].first_time))
+
+    def drop_first(self, blocks):
+        block = blocks.popleft()
+        self.size -= self.BLOCK_OVERHEAD + block.get_size()
+
+    def get_values(self, register, start, end):
+        # Return the (timestamp, value) pairs of a register from start to
+        # end (inclusive), None if the register is not kept.
+        blocks = self.blocks.get(register)
+        if blocks is None:
+            return None
+        with self._lock:
+            selected = [
+                (block.first_time, block.first_value, *block.get_reader())
+                for block in blocks
+                if block.last_time >= start and block.first_time <= end
+            ]
+        values = []
+        for first_time, first_value, data, count in selected:
+            values.extend(
+                (timestamp, value)
+                for timestamp, value in Block.decode(first_time, first_value, data, count)
+                if start <= timestamp <= end
+            )
+        return values
+
+    def query(self, register, start, end, step=None):
+        # Return the values of a register from start to end as columns
+        # ´time` and ´value`, or downsampled to buckets of step seconds as
+        # columns ´time` (the start of the bucket), ´min`, ´max`, ´mean`
+        # and ´count`. Return None if the register is not kept.
+        values = self.get_values(register, start, end)
+        if values is None:
+            return None
+        if not step:
+            return {
+                "time": [timestamp for timestamp, _ in values],
+                "value": [value for _, value in values],
+            }
+        columns = {"time": [], "min": [], "max": [], "mean": [], "count": []}
+        bucket = None
+        for timestamp, value in values:
+            bucket_time = timestamp - timestamp % step
+            if bucket_time != bucket:
+                if bucket is not None:
+                    self.append_bucket(columns, bucket, minimum, maximum, total, count)
+                bucket = bucket_time
+                minimum = maximum = total = value
+                count = 1
+            else:
+                minimum = min(minimum, value)
+                maximum = max(maximum, value)
+                total += value
+                count += 1
+        if bucket is not None:
+            self.append_bucket(columns, bucket, minimum, maximum, total, count)
+        return columns
+
+    @staticmethod
+    def append_bucket(columns, bucket, minimum, maximum, total, count):
+        columns["time"].append(bucket)
+        columns["min"].append(minimum)
+        columns["max"].append(maximum)
+        columns["mean"].append(total / count)
+        columns["count"].append(count)
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                "blocks": sum(len(blocks) for blocks in self.blocks.values()),
+                "values": sum(block.count for blocks in self.blocks.values() for block in blocks),
+                "size": self.size,
+            }
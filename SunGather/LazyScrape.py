@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+# Placeholder for the value of a register not decoded yet:
+_RAW = object()
+
+
+class LazyScrape(dict):
+    # A dictionary of the values of a scrape which decodes the values of
+    # registers on first access only. Registers are added undecoded with
+    # add_raw(), accessing a value decodes it and replaces the placeholder by
+    # the result, so every register is decoded at most once per scrape.
+    # Registers nobody looks at are never decoded.
+
+    # Any other value behaves as in a normal dictionary. Operations returning
+    # all values (items(), values(), copies, comparisons, JSON encoding, ...)
+    # decode all remaining registers first. Iterating the keys, len() and
+    # ´in` do not decode anything.
+
+    # Decoding a value of a published snapshot from several threads at the
+    # same time is safe: the value is decoded twice at worst and the size of
+    # the dictionary never changes by decoding.
+
+    __slots__ = ["decode", "raw"]
+
+    def __init__(self, decode):
+        super().__init__()
+        # The function decoding a register, called with the words of the
+        # address range read from the inverter, the position of the register
+        # within these words and the register (see
+        # SungrowClientCore.interpret_value_for_register()):
+        self.decode = decode
+        # (words, position, register) by the name of every register added
+        # undecoded:
+        self.raw = {}
+
+    def add_raw(self, name, words, num, register):
+        self.raw[name] = (words, num, register)
+        dict.__setitem__(self, name, _RAW)
+
+    def decode_raw(self, key):
+        value = self.decode(*self.raw[key])
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if value is _RAW:
+            value = self.decode_raw(key)
+        return value
+
+    def get(self, key, default=None):
+        value = dict.get(self, key, default)
+        if value is _RAW:
+            value = self.decode_raw(key)
+        return value
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        dict.__setitem__(self, key, default)
+        return default
+
+    def pop(self, key, *default):
+        value = dict.pop(self, key, *default)
+        if value is _RAW:
+            value = self.decode(*self.raw[key])
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        if value is _RAW:
+            value = self.decode(*self.raw[key])
+        return key, value
+
+    def decode_all(self):
+        # Decode all values not decoded yet.
+        for key in self.raw:
+            if dict.get(self, key) is _RAW:
+                self.decode_raw(key)
+
+    def items(self):
+        self.decode_all()
+        return dict.items(self)
+
+    def values(self):
+        self.decode_all()
+        return dict.values(self)
+
+    def __iter__(self):
+        # Overridden, so copying the receiver into another dictionary (e.g.
+        # dict(), ´{**values}` or update()) uses __getitem__ instead of
+        # copying the placeholders.
+        return dict.__iter__(self)
+
+    def copy(self):
+        self.decode_all()
+        return dict.copy(self)
+
+    def __eq__(self, other):
+        self.decode_all()
+        if isinstance(other, LazyScrape):
+            other.decode_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        self.decode_all()
+        return dict.__repr__(self)
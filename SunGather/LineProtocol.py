@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+import math
+
+# Serialization of values in the InfluxDB line protocol without the Point
+# class of influxdb_client. The output is identical to Point.to_line_protocol()
+# for the values written by SunGatherEvo: strings are written as string
+# fields, everything else as float fields.
+
+# Escaping as defined by the line protocol:
+ESCAPE_MEASUREMENT = str.maketrans({",": r"\,", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"})
+ESCAPE_KEY = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"})
+ESCAPE_STRING = str.maketrans({'"': r"\"", "\\": r"\\"})
+
+# Register datatypes delivering numbers, unless the register has a datarange:
+NUMERIC_DATATYPES = ["U16", "S16", "U32", "S32"]
+
+
+def escape_tag_value(value):
+    escaped = str(value).translate(ESCAPE_KEY)
+    if escaped.endswith("\\"):
+        escaped += " "
+    return escaped
+
+
+def format_float(value):
+    # Return a float as field value, None for values not representable in
+    # the line protocol (inf, nan).
+    if not math.isfinite(value):
+        return None
+    formatted = str(value)
+    # Whole numbers are written without the trailing ´.0`:
+    if formatted.endswith(".0"):
+        return formatted[:-2]
+    return formatted
+
+
+def format_string(value):
+    return '"' + value.translate(ESCAPE_STRING) + '"'
+
+
+def format_value(value):
+    # Format a value of any type: strings as string fields, everything else
+    # converted to float.
+    if type(value) is str:
+        return format_string(value)
+    return format_float(float(value))
+
+
+def format_number_value(value):
+    # Format a value expected to be a number.
+    if type(value) is float:
+        return format_float(value)
+    if type(value) is int:
+        return format_float(float(value))
+    return format_value(value)
+
+
+def format_string_value(value):
+    # Format a value expected to be a string.
+    if type(value) is str:
+        return format_string(value)
+    return format_value(value)
+
+
+def get_formatter(register):
+    # Return the function formatting values of the register definition
+    # ´register`. Values of an unexpected type are formatted like by
+    # format_value(), so the type of a field never differs from what
+    # format_value() would write.
+    if register is None:
+        return format_value
+    if register.get("datatype") in NUMERIC_DATATYPES and not register.get("datarange"):
+        return format_number_value
+    if register.get("datatype") == "UTF-8" or register.get("datarange"):
+        return format_string_value
+    return format_value
+
+
+def format_line(measurement, tags, fields, time_ns):
+    # Return a line for the fields (a dictionary) of a point, None if no
+    # field has a value.
+    formatted = []
+    for key, value in sorted(fields.items()):
+        if value is None:
+            continue
+        value = format_value(value)
+        if value is not None:
+            formatted.append(f"{key.translate(ESCAPE_KEY)}={value}")
+    if not formatted:
+        return None
+    return f"{get_prefix(measurement, tags)}{','.join(formatted)} {time_ns}"
+
+
+def get_prefix(measurement, tags):
+    # Return the measurement and the tags of a line followed by the space
+    # separating them from the fields.
+    prefix = measurement.translate(ESCAPE_MEASUREMENT)
+    for key, value in sorted(tags.items()):
+        prefix += f",{key.translate(ESCAPE_KEY)}={escape_tag_value(value)}"
+    return prefix + " "
+
+
+class LineTemplate:
+    # A LineTemplate writes the values of several registers as fields of one
+    # line with the same measurement and tags. The measurement, the tags and
+    # the field keys are escaped once when the template is created, the
+    # formatter of every field is chosen from the register definition.
+
+    def __init__(self, measurement, tags, fields):
+        # fields is a dictionary of register names to formatters. The
+        # register name is used as field key.
+        self.prefix = get_prefix(measurement, tags)
+        self.fields = [
+            (f"{name.translate(ESCAPE_KEY)}=", name, formatter)
+            for name, formatter in sorted(fields.items())
+        ]
+
+    def format(self, values, time_ns):
+        # Return the line for the values of a scrape, None if no field has a
+        # value.
+        formatted = []
+        for key, name, formatter in self.fields:
+            value = values.get(name)
+            if value is None:
+                continue
+            value = formatter(value)
+            if value is not None:
+                formatted.append(key + value)
+        if not formatted:
+            return None
+        return f"{self.prefix}{','.join(formatted)} {time_ns}"
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+
+import math
+import re
+
+# Serialization of registers and of metrics of SunGatherEvo itself in the text
+# based exposition format of Prometheus (version 0.0.4). Only values valid as
+# samples are written: numbers as gauges (or counters for totals), registers
+# with a datarange as state sets or info metrics, text registers as info
+# metrics. Other text values (e.g. ´run_state` or the ´timestamp`) are
+# omitted.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+PREFIX = "sungather_"
+
+# Registers with a datarange of at most this number of values are written as
+# state set (one sample per value, 1 for the current one), registers with
+# more values as info metric:
+MAX_STATES = 16
+
+# Registers named ´total_...` with one of these units only grow and are
+# written as counters:
+COUNTER_UNITS = ["kWh", "h"]
+
+# Metrics of exports (see ExportManager.get_metrics()) which are counters,
+# all other numeric metrics are written as gauges:
+EXPORT_COUNTERS = ["publishes", "publish_failures", "publish_seconds", "written", "dropped", "failed_writes", "published", "replayed", "dropped_event_clients"]
+
+INVALID_NAME_CHARACTERS = re.compile(r"[^a-zA-Z0-9_:]")
+
+
+def metric_name(name):
+    return PREFIX + INVALID_NAME_CHARACTERS.sub("_", name)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def escape_help(text):
+    return str(text).replace("\\", r"\\").replace("\n", r"\n")
+
+
+def format_sample_value(value):
+    # Return a number as sample value, None if value is not a number.
+    value_type = type(value)
+    if value_type is int:
+        return str(value)
+    if value_type is float:
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    if value_type is bool:
+        return "1" if value else "0"
+    return None
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels.items()) + "}"
+
+
+def format_family(name, metric_type, help_text, samples):
+    # Return a metric family: the HELP and TYPE lines followed by the
+    # samples, a list of (suffix, labels, value). Samples without a numeric
+    # value are omitted.
+    lines = [f"# HELP {name} {escape_help(help_text)}\n# TYPE {name} {metric_type}\n"]
+    for suffix, labels, value in samples:
+        value = format_sample_value(value)
+        if value is not None:
+            lines.append(f"{name}{suffix}{format_labels(labels)} {value}\n")
+    return "".join(lines)
+
+
+class RegisterExposition:
+    # Writes the values of a scrape as metrics. How a register is written is
+    # determined once from its definition, the HELP and TYPE lines are
+    # prepared at the same time.
+
+    def __init__(self, registers):
+        # The register definitions by name, the first definition of a name
+        # counts (like in SungrowClient.getRegisterAddress()):
+        self.definitions = {}
+        for register in registers:
+            self.definitions.setdefault(register["name"], register)
+        # A function formatting the value of a register by register name:
+        self.renderers = {}
+
+    def render(self, values):
+        # Return the metrics of the values of a scrape as string.
+        renderers = self.renderers
+        parts = []
+        for name in values:
+            renderer = renderers.get(name)
+            if renderer is None:
+                renderer = renderers[name] = self.create_renderer(name)
+            text = renderer(values[name])
+            if text is not None:
+                parts.append(text)
+        return "".join(parts)
+
+    def create_renderer(self, name):
+        register = self.definitions.get(name, {})
+        unit = register.get("unit")
+        help_text = f"{name} [{unit}]" if unit else name
+        metric = metric_name(name)
+
+        datarange = register.get("datarange")
+        if datarange:
+            states = list(dict.fromkeys(entry["value"] for entry in datarange))
+            if len(states) <= MAX_STATES:
+                return self.create_state_set_renderer(metric, help_text, states)
+            return self.create_info_renderer(metric, help_text)
+        if register.get("datatype") == "UTF-8":
+            return self.create_info_renderer(metric, help_text)
+
+        metric_type = "gauge"
+        if name.startswith("total_") and unit in COUNTER_UNITS:
+            metric_type = "counter"
+            metric += "_total"
+        header = f"# HELP {metric} {escape_help(help_text)}\n# TYPE {metric} {metric_type}\n{metric} "
+
+        def render_number(value):
+            value = format_sample_value(value)
+            if value is None:
+                return None
+            return f"{header}{value}\n"
+
+        return render_number
+
+    @staticmethod
+    def create_state_set_renderer(metric, help_text, states):
+        header = f"# HELP {metric} {escape_help(help_text)}\n# TYPE {metric} gauge\n"
+        labels = [(state, f'{metric}{{state="{escape_label_value(state)}"}} ') for state in states]
+
+        def render_state_set(value):
+            if value is None:
+                return None
+            lines = [header]
+            for state, prefix in labels:
+                lines.append(prefix + ("1\n" if state == value else "0\n"))
+            if value not in states:
+                # E.g. the default of the register:
+                lines.append(f'{metric}{{state="{escape_label_value(value)}"}} 1\n')
+            return "".join(lines)
+
+        return render_state_set
+
+    @staticmethod
+    def create_info_renderer(metric, help_text):
+        metric += "_info"
+        header = f"# HELP {metric} {escape_help(help_text)}\n# TYPE {metric} gauge\n"
+
+        def render_info(value):
+            if value is None:
+                return None
+            return f'{header}{metric}{{value="{escape_label_value(value)}"}} 1\n'
+
+        return render_info
+
+
+def render_inverter_info(model, serial_number):
+    return format_family(
+        f"{PREFIX}inverter_info",
+        "gauge",
+        "Model and serial number of the inverter.",
+        [("", {"model": model or "", "serial_number": serial_number or ""}, 1)],
+    )
+
+
+def render_scrape_metrics(metrics):
+    # Return the metrics of ScrapeMetrics.get_metrics().
+    # The last bucket (+Inf) counts all scrapes:
+    buckets = [("_bucket", {"le": f"{bound:g}"}, count) for bound, count in metrics["duration_buckets"]]
+    buckets.append(("_bucket", {"le": "+Inf"}, metrics["scrapes"]))
+    buckets.append(("_sum", None, metrics["duration_sum"]))
+    buckets.append(("_count", None, metrics["scrapes"]))
+    ranges = metrics["ranges"]
+    range_labels = {key: {"type": key[0], "start": key[1], "count": key[2]} for key in ranges}
+    return "".join(
+        [
+            format_family(f"{PREFIX}scrape_duration_seconds", "histogram", "Duration of scrapes of the inverter.", buckets),
+            format_family(
+                f"{PREFIX}scrapes_failed_total", "counter", "Scrapes without any address range read.", [("", None, metrics["failed_scrapes"])]
+            ),
+            format_family(
+                f"{PREFIX}range_reads_total",
+                "counter",
+                "Reads of an address range.",
+                [("", range_labels[key], entry["reads"]) for key, entry in ranges.items()],
+            ),
+            format_family(
+                f"{PREFIX}modbus_errors_total",
+                "counter",
+                "Failed reads of an address range.",
+                [("", range_labels[key], entry["errors"]) for key, entry in ranges.items()],
+            ),
+            format_family(
+                f"{PREFIX}range_read_seconds_total",
+                "counter",
+                "Time spent reading an address range.",
+                [("", range_labels[key], entry["seconds"]) for key, entry in ranges.items()],
+            ),
+            format_family(
+                f"{PREFIX}range_read_last_seconds",
+                "gauge",
+                "Duration of the last read of an address range.",
+                [("", range_labels[key], entry["last_seconds"]) for key, entry in ranges.items()],
+            ),
+        ]
+    )
+
+
+def render_export_metrics(metrics):
+    # Return the metrics of ExportManager.get_metrics(): one family per
+    # metric with the name of the export as label. The families are named
+    # ´sungather_exports_...`, registers are named ´export_...`. Metrics which are not
+    # numbers (e.g. the last error) are omitted.
+    families = {}
+    for export, export_metrics in metrics.items():
+        for key, value in export_metrics.items():
+            if format_sample_value(value) is None:
+                continue
+            families.setdefault(key, []).append(("", {"export": export}, value))
+    parts = []
+    for key, samples in families.items():
+        if key in EXPORT_COUNTERS:
+            parts.append(format_family(f"{PREFIX}exports_{key}_total", "counter", f"Export metric {key}.", samples))
+        else:
+            parts.append(format_family(f"{PREFIX}exports_{key}", "gauge", f"Export metric {key}.", samples))
+    return "".join(parts)
+
+
+def render_field_statistics(statistics):
+    # Return the metrics of FieldPostProcessor.get_statistics().
+    if not statistics:
+        return ""
+    return "".join(
+        [
+            format_family(
+                f"{PREFIX}customfield_evaluations_total",
+                "counter",
+                "Evaluations of a custom field.",
+                [("", {"field": s["name"]}, s["evaluations"]) for s in statistics],
+            ),
+            format_family(
+                f"{PREFIX}customfield_failures_total",
+                "counter",
+                "Failed evaluations of a custom field.",
+                [("", {"field": s["name"]}, s["exceptions"]) for s in statistics],
+            ),
+            format_family(
+                f"{PREFIX}customfield_seconds_total",
+                "counter",
+                "Time spent evaluating a custom field.",
+                [("", {"field": s["name"]}, s["total_time"]) for s in statistics],
+            ),
+        ]
+    )
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+from JSONSchemaValidator import JSONSchemaValidator
+
+import hashlib
+import json
+import logging
+import marshal
+import os
+import sys
+
+
+class RegisterCatalogCache:
+    # This class stores the register configuration after loading, validating
+    # and patching it in a binary file. On the next start the configuration
+    # can be loaded directly from this file, skipping the expensive parsing of
+    # the yaml file and the schema validation.
+
+    # The cache file is only used if it was created from identical inputs:
+    # the registers file, the json schema files and the register patches
+    # configured. It is also bound to the Python version, because the marshal
+    # format may change between versions.
+
+    # Increment if the structure of the cached data changes:
+    FORMAT_VERSION = 1
+
+    def __init__(self, cache_filename):
+        self.cache_filename = cache_filename
+
+    def compute_key(self, registers_filename, register_patch_config):
+        # Return a hash over all inputs the register configuration is built
+        # from. Return None if any of the inputs cannot be read.
+        h = hashlib.sha256()
+        h.update(f"{self.FORMAT_VERSION} {sys.version}".encode("utf-8"))
+        try:
+            with open(registers_filename, "rb") as f:
+                h.update(f.read())
+            schema_path = JSONSchemaValidator.SCHEMA_FILE_PATH
+            for name in sorted(os.listdir(schema_path)):
+                if name.endswith(".json"):
+                    h.update(name.encode("utf-8"))
+                    with open(schema_path / name, "rb") as f:
+                        h.update(f.read())
+        except Exception as err:
+            logging.warning(f"Cannot compute key for register catalog cache: {err}")
+            return None
+        h.update(
+            json.dumps(register_patch_config, sort_keys=True, default=str).encode(
+                "utf-8"
+            )
+        )
+        return h.hexdigest()
+
+    def load(self, key):
+        # Return the register configuration stored in the cache file if it
+        # was created with the same key, None otherwise.
+        if key is None:
+            return None
+        try:
+            with open(self.cache_filename, "rb") as f:
+                cached_key, registers = marshal.load(f)
+        except FileNotFoundError:
+            logging.info(f"Register catalog cache ´{self.cache_filename}` not found.")
+            return None
+        except Exception as err:
+            logging.warning(
+                f"Ignoring unreadable register catalog cache ´{self.cache_filename}`: {err}"
+            )
+            return None
+        if cached_key != key:
+            logging.info(
+                f"Register catalog cache ´{self.cache_filename}` is outdated, ignoring it."
+            )
+            return None
+        logging.info(f"Loaded registers from catalog cache ´{self.cache_filename}`.")
+        return registers
+
+    def store(self, key, registers):
+        # Write the register configuration to the cache file. The file is
+        # replaced atomically, so a concurrently starting instance will never
+        # read a partially written file. Return True on success.
+        if key is None:
+            return False
+        tmp_filename = f"{self.cache_filename}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_filename, "wb") as f:
+                marshal.dump((key, registers), f)
+            os.replace(tmp_filename, self.cache_filename)
+        except Exception as err:
+            logging.info(
+                f"Could not write register catalog cache ´{self.cache_filename}`: {err}"
+            )
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            return False
+        logging.info(f"Stored registers in catalog cache ´{self.cache_filename}`.")
+        return True
@@ -52,8 +52,8 @@ class RegisterWriter(object):
         # of this class. A fully configured (i.e. including registers) instance
         # of a SungrowClient must be provided. Subsequent calls will fail and
         # log an error.
-        if self._sungrow_client is None:
-            self._sungrow_client = sgclient
+        if self._server_thread is None:
+            self.attach(sgclient)
             self.serverport = port
             self._server_thread = threading.Thread(target=_thread_start)
             # setting daemon to True causes the thread to terminate when the
@@ -63,7 +63,28 @@ class RegisterWriter(object):
         else:
             logging.error("The server thread is already running!")
 
-    def determine_updates(self, postdata):
+    def attach(self, sgclient):
+        # Provide the SungrowClient to write to without starting the HTTP
+        # server, e.g. for writing registers by MQTT commands. Calling this
+        # again with the same SungrowClient has no effect.
+        if self._sungrow_client is None:
+            self._sungrow_client = sgclient
+        elif self._sungrow_client is not sgclient:
+            logging.error("The register writer is already attached to another inverter!")
+
+    def apply(self, postdata, errors=None):
+        # Validate and write the target values of a dictionary with register
+        # names as keys. Return the list of updates written and whether
+        # writing succeeded. Registers which cannot be updated are skipped,
+        # their names and the reason are added to the dictionary errors if
+        # provided.
+        updates = self.determine_updates(postdata, errors)
+        if not updates:
+            return updates, True
+        compacted_updates = self.compact_updates(updates)
+        return updates, self.write_updates(compacted_updates)
+
+    def determine_updates(self, postdata, errors=None):
         # retrieve register names and target values from post_data and create
         # and return a dictionary containing the target addresses and target
         # values.
@@ -75,33 +96,35 @@ class RegisterWriter(object):
                     register = reg
                     logging.debug(f"Matched register ´{key}`.")
                     break
-            self._check_and_add_register(register, value, updates)
+            error = self._check_and_add_register(key, register, value, updates)
+            if error is not None:
+                logging.error(error)
+                if errors is not None:
+                    errors[key] = error
         return updates
 
-    def _check_and_add_register(self, register, target_value, updates):
+    def _check_and_add_register(self, key, register, target_value, updates):
         # Check if the register can be updated with the provided target value
-        # and if so add it to the updates dictionary.
+        # and if so add it to the updates dictionary. Return an error message
+        # if not.
         if register is None:
             # register is not part of the registers which are known to the
             # inverter client (configured as either custom field or in
             # the registers-sungrow.yaml file, not excluded due to
             # level, not exccluded due to model support.)
-            logging.error(f"Unknown register ´{register['name']}`!")
-            return
+            return f"Unknown register ´{key}`!"
 
         if register.get("type") != "hold":
             # register must be a hold register as we cannot write
             # to read registers ...
-            logging.error(f"Cannot update read register ´{register['name']}`!")
-            return
+            return f"Cannot update read register ´{register['name']}`!"
 
         address = register.get("address")
         if address is None:
             # custom registers do not have an actual address.  These should not
             # be 'hold' registers' anyway, but who knows what has been
             # configured ...
-            logging.error(f"Cannot update custom register ´{register['name']}`!")
-            return
+            return f"Cannot update custom register ´{register['name']}`!"
 
         datarange = register.get("datarange")
         if datarange is not None:
@@ -132,18 +155,14 @@ class RegisterWriter(object):
 
         if not isinstance(target_value, int):
             # we can only update with integer values.
-            logging.error(f"Integer required, got ´{target_value}` instead!")
-            return
+            return f"Integer required, got ´{target_value}` instead!"
 
         datatype = register.get("datatype")
         if not (
             (datatype == "S16" and target_value <= 32767 and target_value >= -32768)
             or (datatype == "U16" and target_value <= 65536 and target_value >= 0)
         ):
-            logging.error(
-                f"Value ´{target_value}` is not suitable for datatype ´{datatype}` of register ´{register['name']}`!"
-            )
-            return
+            return f"Value ´{target_value}` is not suitable for datatype ´{datatype}` of register ´{register['name']}`!"
 
         reg_name = register["name"]
         last_read_value = None
@@ -196,16 +215,18 @@ class RegisterWriter(object):
         return compacted_updates
 
     def write_updates(self, compacted_update_dict):
+        # Return True if all registers were written successfully.
         try:
             # avoid updates to holding registers while the SungrowClient is
             # reading data:
             self._sungrow_client.sem.acquire()
-            self._write_updates_guarded(compacted_update_dict)
+            return self._write_updates_guarded(compacted_update_dict)
         finally:
             self._sungrow_client.sem.release()
 
     def _write_updates_guarded(self, compacted_update_dict):
         self._sungrow_client.checkConnection()
+        success = True
         for address, vals in compacted_update_dict.items():
             logging.debug(f"Write ´{vals}` to ´{address}` ...")
             # With version 3.3.0 of PyModbus the ´unit` parameter is
@@ -223,8 +244,10 @@ class RegisterWriter(object):
             if rr.isError():
                 logging.warning("Modbus connection failed!")
                 logging.debug(f"{rr}")
+                success = False
             else:
                 logging.debug("... finished writing holding registers.")
+        return success
 
 
 class WebRequestHandler(BaseHTTPRequestHandler):
@@ -305,9 +328,7 @@ class WebRequestHandler(BaseHTTPRequestHandler):
 
         try:
             rw = RegisterWriter()
-            updates = rw.determine_updates(postdata)
-            compacted_updates = rw.compact_updates(updates)
-            rw.write_updates(compacted_updates)
+            updates, success = rw.apply(postdata)
         except Exception as err:
             # Not clear what went wrong if we end up here, so report a server
             # error.
@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+
+import builtins
+import time
+
+from collections import deque
+
+
+class RollingSeries:
+    # Common ancestor of the classes keeping the state of one series of values
+    # over a sliding time window. Adding a value is O(1) amortized and the
+    # state is bounded by the number of values within the window. A window of
+    # None means the series is not limited in time.
+
+    def __init__(self, window):
+        self.window = window
+
+        # The timestamp of the latest value added, None if no value has been
+        # added yet.
+        self.last_time = None
+
+    def add(self, value, timestamp):
+        # Add a value with its timestamp in seconds since the epoch and
+        # discard all values which are no longer within the window.
+        self.do_add(value, timestamp)
+        self.last_time = timestamp
+        if self.window is not None:
+            self.evict(timestamp - self.window)
+
+    def do_add(self, value, timestamp):
+        # The behavior is defined by subclasses.
+        pass
+
+    def evict(self, oldest_time):
+        # Discard all values older than or equal to oldest_time. The behavior
+        # is defined by subclasses.
+        pass
+
+    def result(self):
+        # Return the aggregated value of the series. The behavior is defined
+        # by subclasses.
+        pass
+
+
+class RollingAverage(RollingSeries):
+    # The arithmetic mean of the values within the window, using a running
+    # sum.
+
+    def __init__(self, window):
+        super().__init__(window)
+        self.values = deque()
+        self.sum = 0
+
+    def do_add(self, value, timestamp):
+        self.values.append((timestamp, value))
+        self.sum += value
+
+    def evict(self, oldest_time):
+        values = self.values
+        while values and values[0][0] <= oldest_time:
+            self.sum -= values.popleft()[1]
+        if not values:
+            # Do not accumulate rounding errors:
+            self.sum = 0
+
+    def result(self):
+        if not self.values:
+            raise ValueError("no values within the window")
+        return self.sum / len(self.values)
+
+
+class RollingExtreme(RollingSeries):
+    # The minimum or maximum of the values within the window, using a
+    # monotonic deque: every value which can never become the extreme
+    # (because there is a more extreme value which is newer) is discarded.
+
+    def __init__(self, window, use_max):
+        super().__init__(window)
+        self.values = deque()
+        self.use_max = use_max
+
+    def do_add(self, value, timestamp):
+        values = self.values
+        if self.use_max:
+            while values and values[-1][1] <= value:
+                values.pop()
+        else:
+            while values and values[-1][1] >= value:
+                values.pop()
+        values.append((timestamp, value))
+
+    def evict(self, oldest_time):
+        values = self.values
+        while values and values[0][0] <= oldest_time:
+            values.popleft()
+
+    def result(self):
+        if not self.values:
+            raise ValueError("no values within the window")
+        return self.values[0][1]
+
+
+class RollingRate(RollingSeries):
+    # The change of the value per second between the oldest and the latest
+    # value within the window. Without a window the change between the two
+    # latest values is calculated.
+
+    def __init__(self, window):
+        super().__init__(window)
+        self.values = deque(maxlen=None if window is not None else 2)
+
+    def do_add(self, value, timestamp):
+        self.values.append((timestamp, value))
+
+    def evict(self, oldest_time):
+        values = self.values
+        # The latest value is always kept:
+        while len(values) > 1 and values[0][0] <= oldest_time:
+            values.popleft()
+
+    def result(self):
+        values = self.values
+        if len(values) < 2 or values[-1][0] == values[0][0]:
+            raise ValueError("at least two values are required for a rate")
+        return (values[-1][1] - values[0][1]) / (values[-1][0] - values[0][0])
+
+
+class RollingIntegral(RollingSeries):
+    # The integral of the values over time, using the trapezoidal rule. The
+    # integral is in value * hours (e.g. Wh for a value in W), like the
+    # integral of the Aggregation module. Without a window the integral since
+    # the first value is calculated.
+
+    def __init__(self, window):
+        super().__init__(window)
+        # Segments between two subsequent values: (end time, area).
+        self.segments = deque()
+        self.sum = 0
+        self.last_value = None
+
+    def do_add(self, value, timestamp):
+        if self.last_time is not None:
+            area = (self.last_value + value) / 2 * (timestamp - self.last_time) / 3600
+            self.sum += area
+            if self.window is not None:
+                self.segments.append((timestamp, area))
+        self.last_value = value
+
+    def evict(self, oldest_time):
+        segments = self.segments
+        while segments and segments[0][0] <= oldest_time:
+            self.sum -= segments.popleft()[1]
+        if not segments:
+            self.sum = 0
+
+    def result(self):
+        if self.last_time is None:
+            raise ValueError("no values within the window")
+        return self.sum
+
+
+class RollingFunctions:
+    # This class provides the rolling window functions available in custom
+    # field expressions, for example ´avg("load_power", 300)`. Every
+    # combination of function, field name and window is a series of its own.
+    # The current value of a field is added to its series at most once per
+    # evaluation of the custom fields, when the function is called for the
+    # first time in this evaluation.
+
+    # Names of the functions, see get_functions():
+    NAMES = ["avg", "min", "max", "rate", "integral"]
+
+    def __init__(self, clock=time.time):
+        # A function returning the current time in seconds since the epoch.
+        # It can be replaced to evaluate values with other timestamps.
+        self.clock = clock
+
+        self.series = {}
+        self.values = {}
+        self.now = None
+
+        # Incremented for every evaluation, a series is updated only once
+        # per evaluation:
+        self.evaluation = 0
+        self.updated = {}
+
+    def begin(self, values, now=None):
+        # Start a new evaluation of the custom fields with the values.
+        self.values = values
+        self.now = now if now is not None else self.clock()
+        self.evaluation += 1
+
+    def get_functions(self):
+        # Return a dictionary with the functions by name.
+        return {name: getattr(self, name) for name in self.NAMES}
+
+    def get_series(self, key, factory):
+        # Return the series for key after adding the current value of the
+        # field. key is a tuple of the function name, field name and window.
+        name = key[1]
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = factory()
+        if self.updated.get(key) != self.evaluation:
+            self.updated[key] = self.evaluation
+            value = self.values.get(name)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                series.add(value, self.now)
+            elif value is not None:
+                raise TypeError(f"value of ´{name}` is not a number: {value!r}")
+            elif series.window is not None:
+                # No current value, but older values may leave the window:
+                series.evict(self.now - series.window)
+        if series.last_time is None:
+            raise NameError(f"name '{name}' is not defined")
+        return series
+
+    def avg(self, name, window):
+        # The mean of the values of field ´name` within the last window
+        # seconds.
+        return self.get_series(
+            ("avg", name, window), lambda: RollingAverage(window)
+        ).result()
+
+    def min(self, *args, **kwargs):
+        # min(name, window) is the minimum of the values of field ´name`
+        # within the last window seconds. Any other call is passed to the
+        # builtin min().
+        if self.is_rolling_call(args, kwargs):
+            name, window = args
+            return self.get_series(
+                ("min", name, window), lambda: RollingExtreme(window, False)
+            ).result()
+        return builtins.min(*args, **kwargs)
+
+    def max(self, *args, **kwargs):
+        # max(name, window) is the maximum of the values of field ´name`
+        # within the last window seconds. Any other call is passed to the
+        # builtin max().
+        if self.is_rolling_call(args, kwargs):
+            name, window = args
+            return self.get_series(
+                ("max", name, window), lambda: RollingExtreme(window, True)
+            ).result()
+        return builtins.max(*args, **kwargs)
+
+    def rate(self, name, window=None):
+        # The change of field ´name` per second within the last window
+        # seconds, or since the previous value if no window is given.
+        return self.get_series(
+            ("rate", name, window), lambda: RollingRate(window)
+        ).result()
+
+    def integral(self, name, window=None):
+        # The integral of field ´name` over time in value * hours within the
+        # last window seconds, or since the start if no window is given.
+        return self.get_series(
+            ("integral", name, window), lambda: RollingIntegral(window)
+        ).result()
+
+    @staticmethod
+    def is_rolling_call(args, kwargs):
+        return (
+            not kwargs
+            and len(args) == 2
+            and isinstance(args[0], str)
+            and isinstance(args[1], (int, float))
+        )
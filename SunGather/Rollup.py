@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+
+from Aggregation import SeriesAccumulator
+
+import logging
+import threading
+
+from collections import deque
+from datetime import datetime
+
+
+class Rollups:
+    # This class maintains aggregated values of selected registers per hour,
+    # day and month (local time): count, sum, mean, min, max, first, last
+    # and the time weighted integral. Every value of a scrape is added to the
+    # current period of each kind in O(1), so queries for the statistics of
+    # a day do not need to process the raw values of that day.
+
+    # When a period is complete it is moved to a bounded history and returned
+    # by add(), so exports can publish it.
+
+    # The kinds of periods with the format of their keys:
+    PERIOD_FORMATS = {
+        "hour": "%Y-%m-%dT%H",
+        "day": "%Y-%m-%d",
+        "month": "%Y-%m",
+    }
+
+    # Default number of completed periods kept by kind:
+    DEFAULT_HISTORY = {"hour": 48, "day": 62, "month": 24}
+
+    # The aggregated values of a register in a period:
+    RESULT_MODES = ["mean", "min", "max", "first", "last", "sum", "integral"]
+
+    def __init__(self, registers, periods=None, history=None):
+        self.registers = list(registers)
+        self.periods = list(periods) if periods else list(self.PERIOD_FORMATS)
+        history = {**self.DEFAULT_HISTORY, **(history or {})}
+
+        # For every kind of period: the key of the current period, e.g.
+        # ´2024-02-11` for a day, None if no value has been added yet.
+        self.current_keys = {period: None for period in self.periods}
+
+        # For every kind of period: a SeriesAccumulator by register.
+        self.accumulators = {period: {} for period in self.periods}
+
+        # For every kind of period: the completed periods, oldest first.
+        self.history = {
+            period: deque(maxlen=history[period]) for period in self.periods
+        }
+
+        # Queries are answered from other threads (e.g. by the webserver):
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        # Create Rollups from the configuration section ´rollups` of the
+        # inverter. Return None if no rollups are configured.
+        if not config or not config.get("registers"):
+            return None
+        rollups = cls(
+            config["registers"],
+            periods=config.get("periods"),
+            history=config.get("history"),
+        )
+        logging.info(
+            f"Rolling up {len(rollups.registers)} registers per {', '.join(rollups.periods)}."
+        )
+        return rollups
+
+    def add(self, values, timestamp):
+        # Add the values of a scrape at timestamp (in seconds since the
+        # epoch). Return a list of the periods completed by this scrape, see
+        # close_period().
+        completed = []
+        now = datetime.fromtimestamp(timestamp)
+        with self._lock:
+            for period in self.periods:
+                self.add_to_period(period, now, values, timestamp, completed)
+        return completed
+
+    def add_to_period(self, period, now, values, timestamp, completed):
+        key = now.strftime(self.PERIOD_FORMATS[period])
+        current_key = self.current_keys[period]
+        if current_key != key:
+            if current_key is not None:
+                completed.append(self.close_period(period))
+            self.current_keys[period] = key
+        accumulators = self.accumulators[period]
+        for name in self.registers:
+            value = values.get(name)
+            if value is None:
+                continue
+            acc = accumulators.get(name)
+            if acc is None:
+                acc = accumulators[name] = SeriesAccumulator()
+            acc.add(value, timestamp)
+
+    @classmethod
+    def get_period_start(cls, period, key):
+        # Return the start of the period with key in seconds since the epoch.
+        return datetime.strptime(key, cls.PERIOD_FORMATS[period]).timestamp()
+
+    def close_period(self, period):
+        # Move the current period of the kind ´period` to the history and
+        # return it as a dictionary with the kind, the key and the results by
+        # register. The next period continues to integrate from the last
+        # value of the completed period.
+        accumulators = self.accumulators[period]
+        record = {
+            "period": period,
+            "key": self.current_keys[period],
+            "values": self.get_results(accumulators),
+        }
+        self.history[period].append(record)
+        self.accumulators[period] = {
+            name: SeriesAccumulator(acc.last, acc.last_time)
+            for name, acc in accumulators.items()
+        }
+        return record
+
+    def get_results(self, accumulators):
+        results = {}
+        for name, acc in accumulators.items():
+            if acc.count == 0:
+                continue
+            entry = {"count": acc.count}
+            for mode in self.RESULT_MODES:
+                entry[mode] = acc.result(mode)
+            results[name] = entry
+        return results
+
+    def get_current(self, period):
+        # Return the current, incomplete period like close_period() does.
+        return {
+            "period": period,
+            "key": self.current_keys[period],
+            "values": self.get_results(self.accumulators[period]),
+        }
+
+    def query(self, period, register=None):
+        # Return the completed periods of the kind ´period` followed by the
+        # current period, optionally restricted to one register. Return None
+        # if the kind of period is not maintained.
+        if period not in self.history:
+            return None
+        with self._lock:
+            records = [*self.history[period]]
+            if self.current_keys[period] is not None:
+                records.append(self.get_current(period))
+        if register is not None:
+            records = [
+                {**record, "values": {register: record["values"][register]}}
+                for record in records
+                if register in record["values"]
+            ]
+        return records
+
+    def get_state(self):
+        # Return the state of all periods, see StateCheckpoint.
+        with self._lock:
+            return {
+                period: {
+                    "key": self.current_keys[period],
+                    "accumulators": {
+                        name: acc.get_state()
+                        for name, acc in self.accumulators[period].items()
+                    },
+                    "history": list(self.history[period]),
+                }
+                for period in self.periods
+            }
+
+    def set_state(self, state):
+        # Restore the state returned by get_state(). A current period which
+        # has ended in the meantime is completed by the next call to add().
+        with self._lock:
+            for period in self.periods:
+                self.set_period_state(period, state.get(period))
+
+    def set_period_state(self, period, period_state):
+        if period_state is None:
+            return
+        self.current_keys[period] = period_state["key"]
+        accumulators = {}
+        for name, acc_state in period_state["accumulators"].items():
+            if name in self.registers:
+                acc = accumulators[name] = SeriesAccumulator()
+                acc.set_state(acc_state)
+        self.accumulators[period] = accumulators
+        self.history[period].clear()
+        self.history[period].extend(period_state["history"])
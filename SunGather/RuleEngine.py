@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+
+from FieldPostProcessor import DEFAULT_NAMESPACE, TIME_DEPENDENT_NAMES, FieldFunctionBuilder, referenced_names
+from FieldStatistics import FieldStatistics
+
+import builtins
+import json
+import logging
+import queue
+import threading
+
+from datetime import datetime
+
+# Placeholder for registers not available in the values.
+_MISSING = object()
+
+# The names available to conditions in addition to the values and the
+# builtins:
+RULE_NAMESPACE = {**DEFAULT_NAMESPACE}
+
+
+class Rule:
+    # A Rule fires an event when the result of its condition changes in a
+    # configured way:
+    #   - trigger ´rising` (default): the condition becomes true,
+    #   - trigger ´falling`: the condition becomes false,
+    #   - trigger ´change`: the value of the condition changes, e.g. for a
+    #     condition ´fault_code`.
+    # With a hold time the event fires only if the new state lasts for hold
+    # seconds.
+
+    TRIGGERS = ["rising", "falling", "change"]
+
+    def __init__(self, name, condition, trigger="rising", hold=0, message=None, webhook=None):
+        self.name = name
+        self.condition = condition
+        self.trigger = trigger
+        self.hold = hold
+        self.message = message
+        self.webhook = webhook
+
+        self.code = None
+        try:
+            self.code = compile(condition, "<string>", "eval")
+        except Exception:
+            logging.exception(f"Failed compiling condition ´{condition}` of rule ´{name}`.")
+
+        # The registers the condition refers to:
+        self.inputs = set()
+        if self.code is not None:
+            self.inputs = referenced_names(self.code) - set(dir(builtins)) - set(RULE_NAMESPACE)
+
+        # Failed evaluations are counted and logged with suppressed
+        # repetitions like failed evaluations of custom fields:
+        self.statistics = FieldStatistics(name)
+
+        # The function evaluating the condition with the values, see
+        # build_function():
+        self.function = None
+        if self.code is not None:
+            self.function = self.build_function()
+
+        # The state of the condition after the last evaluation. Conditions
+        # of rising and falling rules are considered false initially, rules
+        # triggered by a change fire on the first change after the first
+        # evaluation.
+        self.state = False if trigger != "change" else _MISSING
+
+        # The time when a pending event fires, None if no event is pending:
+        self.deadline = None
+        self.pending_value = None
+
+    def build_function(self):
+        # Return a function evaluating the condition with the values. Like
+        # for custom fields (see FieldExpression.generate()) the condition is
+        # rewritten to look up every name in the values first, so the values
+        # are not copied for every evaluation and names are resolved in
+        # nested scopes (comprehensions, lambdas) as well. Conditions which
+        # cannot be rewritten are evaluated with the values merged into the
+        # globals.
+        builder = FieldFunctionBuilder()
+        builder.set_functions(RULE_NAMESPACE)
+        source = builder.rewrite(self.condition)
+        if source is None:
+            code = self.code
+            return lambda values: eval(code, {**RULE_NAMESPACE, **values})
+        builder.add(f"return {source}")
+        return builder.build(name="_fpp_condition")
+
+    def is_always_dirty(self):
+        # Return True if the result of the condition depends on the time of
+        # evaluation (e.g. ´datetime.now().hour >= 22`), so the rule must be
+        # evaluated on every scrape, not only if its registers changed.
+        return self.code is not None and not TIME_DEPENDENT_NAMES.isdisjoint(referenced_names(self.code))
+
+    def update(self, values, now):
+        # Evaluate the condition with the values at time now (a datetime).
+        # Return an event if the rule fires, None otherwise.
+        if self.function is None:
+            return None
+        try:
+            result = self.function(values)
+        except Exception as error:
+            # Typically a register which is not available. The state of the
+            # rule does not change.
+            self.statistics.record_exception(f"Rule ´{self.name}` not evaluated: {error}.")
+            return None
+        state = result if self.trigger == "change" else bool(result)
+        previous = self.state
+        if type(state) is type(previous) and state == previous:
+            return None
+        self.state = state
+        # Any pending event is cancelled by a change of the state:
+        self.deadline = None
+        if not self.is_triggered_by(previous, state):
+            return None
+        if self.hold > 0:
+            self.deadline = now.timestamp() + self.hold
+            self.pending_value = result
+            return None
+        return self.create_event(values, result, now)
+
+    def is_triggered_by(self, previous, state):
+        if self.trigger == "rising":
+            return state
+        if self.trigger == "falling":
+            return not state
+        return previous is not _MISSING
+
+    def check_deadline(self, values, now):
+        # Return an event if the hold time of a pending event has elapsed,
+        # None otherwise.
+        if self.deadline is None or now.timestamp() < self.deadline:
+            return None
+        self.deadline = None
+        return self.create_event(values, self.pending_value, now)
+
+    def create_event(self, values, result, now):
+        event = {
+            "rule": self.name,
+            "time": now.isoformat(timespec="seconds"),
+            "value": result,
+            "values": {name: values.get(name) for name in sorted(self.inputs)},
+        }
+        if self.message is not None:
+            try:
+                event["message"] = self.message.format_map(event["values"])
+            except Exception:
+                event["message"] = self.message
+        return event
+
+
+class RuleEngine:
+    # The RuleEngine evaluates the rules after every scrape. Rules are indexed
+    # by the registers they refer to, so a rule is evaluated only if any of
+    # its registers changed. Pending events of rules with a hold time are
+    # checked on every scrape without evaluating the rules.
+
+    # Rules whose condition depends on the time of evaluation are evaluated
+    # on every scrape.
+
+    # Events are passed to sinks (webhooks of the rules, exports registered
+    # with add_sink()) by a background thread, so slow sinks do not delay
+    # scraping.
+
+    # Maximum number of events waiting for the background thread:
+    MAX_QUEUED_EVENTS = 1000
+
+    def __init__(self, rules):
+        self.rules = rules
+
+        # The rules by the names of the registers they refer to:
+        self.index = {}
+        for rule in rules:
+            for name in rule.inputs:
+                self.index.setdefault(name, []).append(rule)
+
+        # The values of the registers in the index at the last evaluation:
+        self.previous_values = {}
+
+        # Rules depending on the time are evaluated on every scrape:
+        self.always_dirty = [rule for rule in rules if rule.is_always_dirty()]
+
+        # Other rules not referring to any register are evaluated once:
+        self.unconditional = [rule for rule in rules if not rule.inputs and not rule.is_always_dirty()]
+
+        # Rules with a pending event:
+        self.pending = []
+
+        self.sinks = []
+        self._queue = queue.Queue(self.MAX_QUEUED_EVENTS)
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, rule_configs):
+        # Create a RuleEngine from the configuration section ´rules` of the
+        # inverter. Return None if no rules are configured.
+        if not rule_configs:
+            return None
+        rules = []
+        for config in rule_configs:
+            rules.append(
+                Rule(
+                    config["name"],
+                    config["condition"],
+                    trigger=config.get("trigger", "rising"),
+                    hold=config.get("hold", 0),
+                    message=config.get("message"),
+                    webhook=config.get("webhook"),
+                )
+            )
+        logging.info(f"Configured {len(rules)} rules.")
+        return cls(rules)
+
+    def add_sink(self, sink):
+        # Register a function to be called with every event. It is called in
+        # the background thread of the RuleEngine.
+        self.sinks.append(sink)
+
+    def evaluate(self, values, timestamp):
+        # Evaluate the rules whose registers changed since the last
+        # evaluation with the values of a scrape at timestamp (in seconds
+        # since the epoch). Return the list of events fired.
+        now = datetime.fromtimestamp(timestamp)
+        previous_values = self.previous_values
+        dirty = {}
+        for name, rules in self.index.items():
+            value = values.get(name, _MISSING)
+            previous = previous_values.get(name, _MISSING)
+            if value is previous or (type(value) is type(previous) and value == previous):
+                continue
+            previous_values[name] = value
+            for rule in rules:
+                dirty[id(rule)] = rule
+        for rule in self.unconditional:
+            dirty[id(rule)] = rule
+        self.unconditional = []
+        for rule in self.always_dirty:
+            dirty[id(rule)] = rule
+
+        events = []
+        for rule in dirty.values():
+            event = rule.update(values, now)
+            if event is not None:
+                events.append(event)
+            if rule.deadline is not None and rule not in self.pending:
+                self.pending.append(rule)
+        if self.pending:
+            for rule in self.pending:
+                event = rule.check_deadline(values, now)
+                if event is not None:
+                    events.append(event)
+            self.pending = [rule for rule in self.pending if rule.deadline is not None]
+
+        for event in events:
+            self.dispatch(event)
+        return events
+
+    def dispatch(self, event):
+        logging.warning(
+            f"Rule ´{event['rule']}` fired: {event.get('message', event['value'])}"
+        )
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._dispatch_loop, name="rules")
+            self._thread.daemon = True
+            self._thread.start()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            logging.error(f"Too many events queued, dropping event of rule ´{event['rule']}`.")
+
+    def _dispatch_loop(self):
+        webhooks = {rule.name: rule.webhook for rule in self.rules if rule.webhook}
+        while True:
+            event = self._queue.get()
+            webhook = webhooks.get(event["rule"])
+            if webhook is not None:
+                self.post_webhook(webhook, event)
+            for sink in self.sinks:
+                try:
+                    sink(event)
+                except Exception as err:
+                    logging.error(f"Failed to pass event of rule ´{event['rule']}` to sink: {err}")
+
+    def post_webhook(self, url, event):
+        # requests is imported on first use only.
+        import requests
+
+        try:
+            response = requests.post(
+                url, data=json.dumps(event, default=str), headers={"Content-Type": "application/json"}, timeout=5
+            )
+            if response.status_code >= 300:
+                logging.error(
+                    f"Webhook for rule ´{event['rule']}` failed: {response.status_code} {response.text}"
+                )
+        except Exception as err:
+            logging.error(f"Webhook for rule ´{event['rule']}` failed: {err}")
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+import threading
+
+from bisect import bisect_left
+
+
+class ScrapeMetrics:
+    # ScrapeMetrics collects metrics about scraping the inverter: the
+    # duration of every scrape as histogram and the latency and errors of
+    # reading every address range. They are updated by the scraping thread
+    # and read by exports (e.g. the Prometheus export) from other threads.
+
+    # Upper bounds of the buckets of the scrape duration histogram in
+    # seconds:
+    DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Number of scrapes per bucket of DURATION_BUCKETS (not cumulative),
+        # the last entry counts scrapes exceeding the largest bucket:
+        self.duration_counts = [0] * (len(self.DURATION_BUCKETS) + 1)
+        self.duration_sum = 0.0
+        self.scrapes = 0
+        self.failed_scrapes = 0
+        # For every address range (type, start, count):
+        # [reads, failed reads, total seconds, seconds of the last read]
+        self.ranges = {}
+
+    def record_scrape(self, duration, success):
+        # Buckets are inclusive of their upper bound:
+        bucket = bisect_left(self.DURATION_BUCKETS, duration)
+        with self._lock:
+            self.duration_counts[bucket] += 1
+            self.duration_sum += duration
+            self.scrapes += 1
+            if not success:
+                self.failed_scrapes += 1
+
+    def record_range(self, register_type, start, count, duration, success):
+        key = (register_type, start, count)
+        with self._lock:
+            entry = self.ranges.get(key)
+            if entry is None:
+                entry = self.ranges[key] = [0, 0, 0.0, 0.0]
+            entry[0] += 1
+            if not success:
+                entry[1] += 1
+            entry[2] += duration
+            entry[3] = duration
+
+    def get_metrics(self):
+        # Return a consistent copy of the metrics as dictionary. The
+        # ´duration_buckets` are (upper bound, cumulative count) pairs of
+        # DURATION_BUCKETS, scrapes exceeding the largest bucket are counted
+        # in ´scrapes` only.
+        with self._lock:
+            cumulative = []
+            total = 0
+            for count in self.duration_counts:
+                total += count
+                cumulative.append(total)
+            return {
+                "duration_buckets": list(zip(self.DURATION_BUCKETS, cumulative)),
+                "duration_sum": self.duration_sum,
+                "scrapes": self.scrapes,
+                "failed_scrapes": self.failed_scrapes,
+                "ranges": {
+                    key: {
+                        "reads": entry[0],
+                        "errors": entry[1],
+                        "seconds": entry[2],
+                        "last_seconds": entry[3],
+                    }
+                    for key, entry in sorted(self.ranges.items())
+                },
+            }
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+import time
+
+from datetime import datetime
+
+
+class ScrapeTime:
+    # The time of a scrape. It is taken once when the scrape starts and
+    # passed along with the values, so exports do not need to parse the
+    # ´timestamp` register and values written later (e.g. in batches) carry
+    # the time they were scraped at.
+
+    __slots__ = [
+        "epoch_ns",
+        "monotonic_ns",
+        "datetime",
+        "inverter_datetime",
+        "timestamp_datetime",
+    ]
+
+    def __init__(self, epoch_ns, monotonic_ns=None):
+        # Wall clock time in nanoseconds since the epoch:
+        self.epoch_ns = epoch_ns
+
+        # Monotonic clock in nanoseconds, for measuring intervals between
+        # scrapes independent of changes of the wall clock. None if the
+        # ScrapeTime was not taken from the clocks (see from_seconds()).
+        self.monotonic_ns = monotonic_ns
+
+        # Wall clock time as timezone aware datetime in local time:
+        self.datetime = datetime.fromtimestamp(epoch_ns / 1e9).astimezone()
+
+        # The time reported by the inverter as timezone aware datetime, None
+        # if not read from the inverter.
+        self.inverter_datetime = None
+
+        # The time of the ´timestamp` register, if it was created from this
+        # ScrapeTime (either inverter_datetime or datetime), None otherwise.
+        self.timestamp_datetime = None
+
+    @classmethod
+    def now(cls):
+        return cls(time.time_ns(), time.monotonic_ns())
+
+    @classmethod
+    def from_seconds(cls, seconds):
+        # Create a ScrapeTime for a time in seconds since the epoch.
+        return cls(int(seconds * 1e9))
+
+    @property
+    def seconds(self):
+        # Wall clock time in seconds since the epoch as float.
+        return self.epoch_ns / 1e9
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+import json
+import logging
+import threading
+
+
+class Snapshot:
+    # A Snapshot represents the data of one successful scrape. Encoded
+    # representations of this data (e.g. the JSON payload for MQTT or the
+    # bodies served by the webserver) are computed on first request only and
+    # then shared as bytes by every export and HTTP request asking for the same
+    # representation of the same snapshot.
+
+    def __init__(self, sequence, values, cache):
+        # The number of the scrape this snapshot belongs to. It is
+        # incremented by one for every snapshot and can be used to tell
+        # whether data has changed since a previous request.
+        self.sequence = sequence
+
+        # The dictionary of values of the scrape. It must not be changed after
+        # the snapshot has been created.
+        self.values = values
+
+        self._cache = cache
+        self._encodings = {}
+        # Reentrant, so an encoder may derive its representation from
+        # another one of the same snapshot (e.g. a compressed variant):
+        self._lock = threading.RLock()
+
+    def get_encoded(self, name):
+        # Return the representation ´name` of the receiver as bytes. The
+        # encoder is looked up in the SnapshotCache the receiver belongs to.
+        # Every representation is computed at most once per snapshot, even if
+        # requested concurrently from several threads.
+        encoded = self._encodings.get(name)
+        if encoded is None:
+            with self._lock:
+                encoded = self._encodings.get(name)
+                if encoded is None:
+                    encoded = self._cache.get_encoder(name)(self)
+                    self._encodings[name] = encoded
+        return encoded
+
+
+class SnapshotCache:
+    # The SnapshotCache keeps the snapshot of the latest successful scrape and
+    # the encoders known for creating representations of snapshots. Exports
+    # register their own encoders under a unique name and retrieve the encoded
+    # bytes from the current snapshot instead of serializing the data
+    # themselves on every scrape.
+
+    # The name of the built in encoder creating a JSON object from the static
+    # configuration merged with the values of a scrape.
+    JSON_WITH_CONFIG = "json_with_config"
+
+    def __init__(self):
+        self.sequence = 0
+
+        # The Snapshot of the latest scrape or None, if there was no
+        # successful scrape yet.
+        self.current = None
+
+        self._encoders = {self.JSON_WITH_CONFIG: self._encode_json_with_config}
+
+        # Pre-encoded JSON fragments of the static configuration: for every
+        # key a string ´"key": value`. See set_static_values().
+        self._static_fragments = {}
+
+        # Joined static fragments by the set of keys which are overridden by
+        # values of a scrape. This set is typically the same for every
+        # scrape, so joining is required only once.
+        self._static_bodies = {}
+
+    def register_encoder(self, name, encoder):
+        # Make an encoder available under ´name`. The encoder is called with a
+        # Snapshot as the only argument and must return bytes.
+        if name in self._encoders:
+            logging.warning(f"Replacing encoder ´{name}` in the snapshot cache.")
+        self._encoders[name] = encoder
+
+    def get_encoder(self, name):
+        return self._encoders[name]
+
+    def set_static_values(self, static_values):
+        # Pre-encode values which do not change between scrapes (i.e. the
+        # client and inverter configuration). This must be called again if
+        # the static values are changed.
+        self._static_fragments = {
+            key: json.dumps(key) + ": " + json.dumps(value, default=str)
+            for key, value in static_values.items()
+        }
+        self._static_bodies = {}
+
+    def derive(self):
+        # Return a new SnapshotCache with its own sequence of snapshots, but
+        # sharing the encoders and pre-encoded static values of the receiver.
+        # This is used for exports publishing data which is not identical to
+        # the scraped data, e.g. aggregated values.
+        derived = SnapshotCache()
+        derived._encoders = self._encoders
+        derived._static_fragments = self._static_fragments
+        derived._static_bodies = self._static_bodies
+        return derived
+
+    def publish(self, values):
+        # Create a new Snapshot for the values of a scrape and make it the
+        # current one. Return the new Snapshot.
+        self.sequence += 1
+        self.current = Snapshot(self.sequence, values, self)
+        return self.current
+
+    def _encode_json_with_config(self, snapshot):
+        # Encode the static values merged with the values of the snapshot as
+        # one JSON object. Values of the snapshot take precedence over static
+        # values with the same key.
+        values = snapshot.values
+        overridden = frozenset(self._static_fragments.keys() & values.keys())
+        static_body = self._static_bodies.get(overridden)
+        if static_body is None:
+            static_body = ", ".join(
+                fragment
+                for key, fragment in self._static_fragments.items()
+                if key not in overridden
+            )
+            self._static_bodies[overridden] = static_body
+
+        values_body = json.dumps(values)[1:-1]
+        if static_body and values_body:
+            return ("{" + static_body + ", " + values_body + "}").encode("utf-8")
+        return ("{" + static_body + values_body + "}").encode("utf-8")
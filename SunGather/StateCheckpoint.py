@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+import json
+import logging
+import os
+import time
+
+from datetime import datetime
+
+
+class StateCheckpoint:
+    # This class writes the runtime state of SunGatherEvo (running totals of
+    # custom fields, daily counters, pending uploads of exports, ...) to a
+    # file and restores it on startup, so a restart does not reset values
+    # calculated over time.
+
+    # The state is provided by providers registered with register(). A
+    # provider is a pair of functions: get_state() returns a dictionary which
+    # can be encoded as JSON (datetime values are supported in addition),
+    # set_state(state) restores it. Whether a restored state is still valid
+    # (e.g. a daily value of yesterday) is decided by the providers.
+
+    # The file is written at most once per interval and replaced atomically,
+    # so a crash while writing never destroys the previous checkpoint.
+
+    # Increment if the structure of the file changes:
+    FORMAT_VERSION = 1
+
+    def __init__(self, filename, interval=300):
+        self.filename = filename
+        # Seconds between two checkpoints:
+        self.interval = interval
+        self.providers = {}
+        self.last_save = time.monotonic()
+
+    def register(self, name, get_state, set_state):
+        self.providers[name] = (get_state, set_state)
+
+    def restore(self):
+        # Read the checkpoint file and pass the state of every registered
+        # provider to it. Return True if a checkpoint was restored.
+        try:
+            with open(self.filename, encoding="utf-8") as f:
+                checkpoint = json.load(f, object_hook=self.decode)
+        except FileNotFoundError:
+            logging.info(f"State checkpoint ´{self.filename}` not found.")
+            return False
+        except Exception as err:
+            logging.warning(
+                f"Ignoring unreadable state checkpoint ´{self.filename}`: {err}"
+            )
+            return False
+        if checkpoint.get("version") != self.FORMAT_VERSION:
+            logging.info(
+                f"State checkpoint ´{self.filename}` has an unknown format, ignoring it."
+            )
+            return False
+        logging.info(
+            f"Restoring state checkpoint ´{self.filename}` written {checkpoint.get('time')}."
+        )
+        states = checkpoint.get("state", {})
+        for name, (get_state, set_state) in self.providers.items():
+            if name not in states:
+                continue
+            try:
+                set_state(states[name])
+            except Exception as err:
+                logging.warning(f"Failed to restore state of ´{name}`: {err}")
+        return True
+
+    def save_if_due(self):
+        # Write a checkpoint if the interval elapsed since the last one.
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        # Write the state of all providers to the checkpoint file. Return
+        # True on success.
+        self.last_save = time.monotonic()
+        parts = []
+        for name, (get_state, set_state) in self.providers.items():
+            try:
+                state = get_state()
+            except Exception as err:
+                logging.warning(f"Failed to get state of ´{name}`: {err}")
+                continue
+            encoded = self.encode_state(name, state)
+            if encoded is not None:
+                parts.append(f"{json.dumps(name)}: {encoded}")
+        data = (
+            f'{{"version": {self.FORMAT_VERSION}, '
+            f'"time": {json.dumps(datetime.now().isoformat(timespec="seconds"))}, '
+            f'"state": {{{", ".join(parts)}}}}}'
+        )
+        tmp_filename = f"{self.filename}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_filename, "w", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, self.filename)
+            self.sync_directory()
+        except Exception as err:
+            logging.warning(
+                f"Could not write state checkpoint ´{self.filename}`: {err}"
+            )
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            return False
+        logging.debug(f"Wrote state checkpoint ´{self.filename}`.")
+        return True
+
+    def sync_directory(self):
+        # Make the rename of the file durable. Not supported on all
+        # platforms, in which case this is skipped.
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def encode_state(self, name, state):
+        # Return the state encoded as JSON. If the state cannot be encoded,
+        # the entries of nested dictionaries which cannot be encoded are
+        # omitted. Return None if a value other than a dictionary cannot be
+        # encoded.
+        try:
+            return json.dumps(state, default=self.encode)
+        except (TypeError, ValueError) as err:
+            if not isinstance(state, dict):
+                logging.warning(
+                    f"State ´{name}` cannot be written to the checkpoint: {err}"
+                )
+                return None
+        parts = []
+        for key, value in state.items():
+            encoded = self.encode_state(f"{name}.{key}", value)
+            if encoded is not None:
+                parts.append(f"{json.dumps(str(key))}: {encoded}")
+        return f"{{{', '.join(parts)}}}"
+
+    @staticmethod
+    def encode(obj):
+        if isinstance(obj, datetime):
+            return {"__datetime__": obj.isoformat()}
+        raise TypeError(f"Object of type {obj.__class__.__name__} is not supported")
+
+    @staticmethod
+    def decode(obj):
+        if len(obj) == 1 and "__datetime__" in obj:
+            return datetime.fromisoformat(obj["__datetime__"])
+        return obj
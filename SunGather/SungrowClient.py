@@ -5,7 +5,16 @@ from SungrowModbusWebClient import SungrowModbusWebClient
 from pymodbus.client.sync import ModbusTcpClient
 
 from FieldPostProcessor import FieldPostProcessor
-
+from History import History
+from LazyScrape import LazyScrape
+from Rollup import Rollups
+from RuleEngine import RuleEngine
+from ScrapeMetrics import ScrapeMetrics
+from ScrapeTime import ScrapeTime
+from SnapshotCache import SnapshotCache
+
+from array import array
+from bisect import bisect_left
 from datetime import datetime
 
 from threading import BoundedSemaphore
@@ -43,11 +52,46 @@ class SungrowClientCore():
         self.register_ranges = [[]]
         self.register_ranges.pop() # Remove null value from list
 
+        # Register definitions of the registers file by type and name, see
+        # find_register_definition():
+        self.register_definition_index = None
+
+        # The registers to read by address range, see
+        # find_registers_in_range():
+        self.range_index = None
+
+        # Whether registers of type ´read` are decoded on first access of
+        # their values only, see LazyScrape:
+        self.lazy_decoding = config_inverter.get("lazy_decoding", False)
+
         self.latest_scrape = {}
 
+        # The ScrapeTime of the latest scrape, None before the first scrape:
+        self.scrape_time = None
+
         fpp = FieldPostProcessor(config_inverter.get("customfields", None))
         self.field_post_processor = fpp 
 
+        # Snapshots of successful scrapes and their encoded representations
+        # shared by all exports:
+        self.snapshot_cache = SnapshotCache()
+        # Duration of scrapes, latency and errors of reading address ranges:
+        self.scrape_metrics = ScrapeMetrics()
+
+        # Hourly, daily and monthly aggregates of selected registers, None if
+        # not configured. completed_rollups are the periods completed by the
+        # latest scrape, to be published by exports.
+        self.rollups = Rollups.from_config(config_inverter.get("rollups"))
+        self.completed_rollups = []
+
+        # Compressed values of selected registers of the last hours, None if
+        # not configured:
+        self.history = History.from_config(config_inverter.get("history"))
+
+        # Rules firing events on changes of registers, None if not
+        # configured:
+        self.rule_engine = RuleEngine.from_config(config_inverter.get("rules"))
+
         self.sem = BoundedSemaphore()
 
 
@@ -132,20 +176,28 @@ class SungrowClientCore():
         return reg_len
 
 
+    def find_register_definition(self, reg_name, reg_type, registersfile):
+        # Return the definition of the register named reg_name of type
+        # reg_type from the registers file or None. The definitions are
+        # indexed by name on first use.
+        if self.register_definition_index is None:
+            self.register_definition_index = {'read': {}, 'hold': {}}
+            for register in registersfile['registers'][0]['read']:
+                self.register_definition_index['read'].setdefault(register.get('name'), register)
+            for register in registersfile['registers'][1]['hold']:
+                self.register_definition_index['hold'].setdefault(register.get('name'), register)
+        return self.register_definition_index['read' if reg_type == 'read' else 'hold'].get(reg_name)
+
+
     def load_single_register(self, reg_name, reg_type, registersfile):
         # load a single register from the inverter and return the register value.
-        if reg_type == 'read':
-            reg_list = registersfile['registers'][0]['read']
-        else:
-            reg_list = registersfile['registers'][1]['hold']
         reg_address = None
-        for register in reg_list:
-            if register.get('name') == reg_name:
-                reg_address = register.get('address')
-                reg_len = self.register_length(register)
-                register['type'] = reg_type
-                self.registers.append(register)
-                break
+        register = self.find_register_definition(reg_name, reg_type, registersfile)
+        if register is not None:
+            reg_address = register.get('address')
+            reg_len = self.register_length(register)
+            register['type'] = reg_type
+            self.registers.append(register)
         if reg_address is None:
             logging.warning(f"Failed loading register ´{reg_name}` of type ´{reg_type}`, slave ´{self.inverter_config['slave']}`. Register is not defined or address is missing in the register definition!")
             return None
@@ -233,25 +285,32 @@ class SungrowClientCore():
         # Build a list of address ranges to read from the inverter. Only
         # address ranges are of interest which contain at least one register we
         # are interested in.
+        # The addresses of the registers of each type are sorted once, so each
+        # range can be checked by a binary search.
+        addresses = {'read': [], 'hold': []}
+        for register in self.registers:
+            if register.get('type') in addresses:
+                addresses[register.get('type')].append(register.get('address'))
+        for reg_type in addresses:
+            addresses[reg_type].sort()
         for register_range in registersfile['scan'][0]['read']:
-            self.append_address_range_if_required(register_range, 'read')
+            self.append_address_range_if_required(register_range, 'read', addresses['read'])
         for register_range in registersfile['scan'][1]['hold']:
-            self.append_address_range_if_required(register_range, 'hold')
+            self.append_address_range_if_required(register_range, 'hold', addresses['hold'])
         # logging.debug(f"The following address ranges will be scraped: {self.register_ranges}.")
 
 
-    def append_address_range_if_required(self, reg_range, reg_type):
+    def append_address_range_if_required(self, reg_range, reg_type, sorted_addresses):
         # Search for registers which are located in this address range, if any
-        # are found append the address range.
+        # are found append the address range. sorted_addresses is the sorted
+        # list of addresses of all registers of type reg_type.
         range_start = reg_range.get("start")
         range_end = range_start  + reg_range.get("range")
-        for register in self.registers:
-            if register.get("type") == reg_type:
-                reg_address = register.get('address')
-                if reg_address >= range_start and reg_address <= range_end:
-                    reg_range['type'] = reg_type
-                    self.register_ranges.append(reg_range)
-                    return
+        # Index of the lowest address >= range_start:
+        i = bisect_left(sorted_addresses, range_start)
+        if i < len(sorted_addresses) and sorted_addresses[i] <= range_end:
+            reg_range['type'] = reg_type
+            self.register_ranges.append(reg_range)
 
 
     def configure_registers(self, registersfile):
@@ -269,6 +328,14 @@ class SungrowClientCore():
         # which contain available registers:
         self.build_range_list(registersfile)
 
+        # The list of registers to read does not change anymore, the registers
+        # found in an address range can be kept:
+        self.range_index = {}
+
+        # The configuration does not change anymore, pre-encode it for the
+        # snapshots:
+        self.snapshot_cache.set_static_values(self.inverter_config | self.client_config)
+
         return True
 
 
@@ -303,12 +370,13 @@ class SungrowClientCore():
         return rr
 
 
-    def interpret_value_for_register(self, rr, num, register):
+    def interpret_value_for_register(self, words, num, register):
 
         # Convert the values delivered by the inverter into a format suitable
-        # for further work.
+        # for further work. words are the registers of the address range read
+        # from the inverter, num is the position of the register within them.
 
-        register_value = rr.registers[num]
+        register_value = words[num]
 
         # Convert unsigned to signed
         # If xFF / xFFFF then change to 0, looks better when logging / graphing
@@ -324,13 +392,13 @@ class SungrowClientCore():
             if register_value >= 32767:  # Anything greater than 32767 is a negative for 16bit
                 register_value = (register_value - 65536)
         elif register.get('datatype') == "U32":
-            u32_value = rr.registers[num+1]
+            u32_value = words[num+1]
             if register_value == 0xFFFF and u32_value == 0xFFFF:
                 register_value = 0
             else:
                 register_value = (register_value + u32_value * 0x10000)
         elif register.get('datatype') == "S32":
-            u32_value = rr.registers[num+1]
+            u32_value = words[num+1]
             if register_value == 0xFFFF and (u32_value == 0xFFFF or u32_value == 0x7FFF):
                 register_value = 0
             elif u32_value >= 32767:  # Anything greater than 32767 is a negative
@@ -341,8 +409,8 @@ class SungrowClientCore():
             utf_value = register_value.to_bytes(2, 'big')
 
             # Use attribute ´length` if configured for the UTF-8 attribute,
-            # otherwise assume 10 registers (20 characters), rr.registers[num]
-            # .. rr.registers[num+9].
+            # otherwise assume 10 registers (20 characters), words[num]
+            # .. words[num+9].
 
             # Notes:
 
@@ -352,7 +420,7 @@ class SungrowClientCore():
 
             # (b) Any UTF-8 attribute SHORTER than 10 registers will probably
             # either contain garbage after its regular length or the reading
-            # may fail altogether if reading from rr exceeds the length of rr
+            # may fail altogether if reading from words exceeds their length
             # ...
 
             # (c) Version V1.1.12 of the Sungrow Specification ´Communication
@@ -361,7 +429,7 @@ class SungrowClientCore():
             # and dsp_software_version) characters.
 
             for x in range(1, register.get('length', 10-1)):
-                utf_value += rr.registers[num+x].to_bytes(2, 'big')
+                utf_value += words[num+x].to_bytes(2, 'big')
             utf_string = utf_value.decode()
             # remove trailing null bytes:
             utf_string = utf_string.rstrip("\u0000")
@@ -376,7 +444,7 @@ class SungrowClientCore():
         if register.get('datarange'):
             match = False
             for value in register.get('datarange'):
-                if value['response'] == rr.registers[num] or value['response'] == register_value:
+                if value['response'] == words[num] or value['response'] == register_value:
                     register_value = value['value']
                     match = True
             if not match:
@@ -400,28 +468,61 @@ class SungrowClientCore():
         logging.info(f"Start reading a single range of data, type ´{register_type}`, slave ´{slave_id}`, start {start}, count {count}.")
 
         # first read the data area containing the registers from the inverter.
+        read_start = time.perf_counter()
         rr = self.read_registers(register_type, slave_id, start, count)
+        self.scrape_metrics.record_range(register_type, start, count, time.perf_counter() - read_start, rr is not None)
         if rr is None:
             return False
 
-        # for each address in the range check which registers they contain and extract the data for the registers accordingly.
-        for num in range(0, count):
-            for register in self.registers:
-                if register_type == register['type'] and register['address'] == start + 1 + num:
-                    # skip register, if it is not yet time to read it:
-                    if register.get("update_frequency") and register.get("last_update") and (datetime.now() - register["last_update"]).total_seconds() < register.get("update_frequency"):
-                        logging.debug(f"Skipping register {register.get('name')}, has been read within update_frequency.")
-                        continue
-                    register_value = self.interpret_value_for_register(rr, num, register)
-                    # remember the last update timestamp in the register:
-                    register["last_update"] = datetime.now()
-                    # remember the last value read for the register:
-                    register["last_read_value"] = register_value
-                    # Set the final register value with adjustments above included 
-                    self.latest_scrape[register["name"]] = register_value
+        words = rr.registers
+        lazy = isinstance(self.latest_scrape, LazyScrape)
+        if lazy:
+            # Keep the raw words compact until the registers are decoded:
+            words = array("H", words)
+
+        # for each register in the range extract the data for the register.
+        now = datetime.now()
+        for num, register in self.find_registers_in_range(register_type, start, count):
+            # skip register, if it is not yet time to read it:
+            if register.get("update_frequency") and register.get("last_update") and (now - register["last_update"]).total_seconds() < register.get("update_frequency"):
+                logging.debug(f"Skipping register {register.get('name')}, has been read within update_frequency.")
+                continue
+            # remember the last update timestamp in the register:
+            register["last_update"] = now
+            if lazy and register_type == "read":
+                # Decode on first access. Holding registers are always
+                # decoded, their last_read_value is used when writing them.
+                self.latest_scrape.add_raw(register["name"], words, num, register)
+                continue
+            register_value = self.interpret_value_for_register(words, num, register)
+            # remember the last value read for the register:
+            register["last_read_value"] = register_value
+            # Set the final register value with adjustments above included 
+            self.latest_scrape[register["name"]] = register_value
         return True
 
 
+    def find_registers_in_range(self, register_type, start, count):
+        # Return a list of (position in the range, register) for the
+        # registers of type register_type located in the address range
+        # beginning after start with count registers, ordered by address.
+        # Once the list of registers is complete, the result is kept for
+        # every range.
+        key = (register_type, start, count)
+        if self.range_index is not None and key in self.range_index:
+            return self.range_index[key]
+        addresses = range(start + 1, start + 1 + count)
+        registers = [
+            (register['address'] - start - 1, register)
+            for register in self.registers
+            if register.get('type') == register_type and register.get('address') in addresses
+        ]
+        registers.sort(key=lambda entry: entry[0])
+        if self.range_index is not None:
+            self.range_index[key] = registers
+        return registers
+
+
     def get_my_register_list(self):
         return [*self.registers, *self.field_post_processor.get_field_list()]
 
@@ -445,16 +546,10 @@ class SungrowClientCore():
         return ''
 
     def validateLatestScrape(self, check_register):
-        for register, value in self.latest_scrape.items():
-            if check_register == register:
-                return True
-        return False
+        return check_register in self.latest_scrape
 
     def getRegisterValue(self, check_register):
-        for register, value in self.latest_scrape.items():
-            if check_register == register:
-                return value
-        return False
+        return self.latest_scrape.get(check_register, False)
 
     def getHost(self):
         return self.client_config['host']
@@ -529,13 +624,19 @@ class SungrowClientCore():
 
 
 
+    def create_latest_scrape(self):
+        # Return an empty dictionary for the values of a scrape.
+        return LazyScrape(self.interpret_value_for_register) if self.lazy_decoding else {}
+
     def init_latest_scrape(self):
-        self.latest_scrape = {}
+        self.latest_scrape = self.create_latest_scrape()
 
 
     def scrape(self):
         logging.info("Start reading ranges of data from inverter.")
         scrape_start = datetime.now()
+        duration_start = time.perf_counter()
+        self.scrape_time = ScrapeTime.now()
 
         # Protect the reading as a whole to avoid concurrent updates to
         # holding registers. This would possibly result in inconsistent readings
@@ -546,12 +647,23 @@ class SungrowClientCore():
         finally:
             self.sem.release()
 
+        self.scrape_metrics.record_scrape(time.perf_counter() - duration_start, result)
         scrape_end = datetime.now()
         logging.info('Finished reading ranges of data from inverter '
                      + f"in {(scrape_end - scrape_start).seconds}."
                      + f"{(scrape_end - scrape_start).microseconds} "
                      + "seconds.")
 
+        self.completed_rollups = []
+        if result:
+            if self.rule_engine is not None:
+                self.rule_engine.evaluate(self.latest_scrape, self.scrape_time.seconds)
+            if self.rollups is not None:
+                self.completed_rollups = self.rollups.add(self.latest_scrape, self.scrape_time.seconds)
+            if self.history is not None:
+                self.history.add(self.latest_scrape, self.scrape_time.seconds)
+            self.snapshot_cache.publish(self.latest_scrape)
+
         return result
 
 
@@ -600,7 +712,37 @@ class SungrowClientCore():
 
     def do_field_post_processing(self):
         if self.field_post_processor is not None:
-            self.field_post_processor.evaluate(self.latest_scrape)
+            # The sliding window functions use the time the scrape started,
+            # not the time the values are evaluated at:
+            self.field_post_processor.evaluate(self.latest_scrape, now=self.scrape_time.seconds)
+
+    def get_timestamp(self):
+        # Return the time of the latest scrape as datetime: the time of the
+        # ´timestamp` register if available, otherwise the local time of
+        # the scrape.
+        if self.scrape_time is not None and self.scrape_time.timestamp_datetime is not None:
+            return self.scrape_time.timestamp_datetime
+        timestamp = self.latest_scrape.get("timestamp")
+        if isinstance(timestamp, str):
+            try:
+                return datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                pass
+        if self.scrape_time is not None:
+            return self.scrape_time.datetime
+        return datetime.now()
+
+    def get_state(self):
+        # Return the state kept between scrapes, see StateCheckpoint.
+        state = {"customfields": self.field_post_processor.get_state()}
+        if self.rollups is not None:
+            state["rollups"] = self.rollups.get_state()
+        return state
+
+    def set_state(self, state):
+        self.field_post_processor.set_state(state.get("customfields", {}))
+        if self.rollups is not None and "rollups" in state:
+            self.rollups.set_state(state["rollups"])
 
 
 
@@ -642,6 +784,9 @@ class SungrowClient(SungrowClientCore):
                                     {'name': 'daily_export_to_grid', 'unit': 'kWh', 'address': 'vr006'}, 
                                     {'name': 'daily_import_from_grid', 'unit': 'kWh', 'address': 'vr007'}
                                 ]
+        # The date of the register last_reset, to compare it without parsing
+        # the register. None if not known yet.
+        self.last_reset_date = None
 
     def get_my_register_list(self):
         the_super_list = super().get_my_register_list()
@@ -654,7 +799,7 @@ class SungrowClient(SungrowClientCore):
             "daily_export_to_grid":     self.latest_scrape.get("daily_export_to_grid",0),
             "daily_import_from_grid":   self.latest_scrape.get("daily_import_from_grid",0),
         }
-        self.latest_scrape = {}
+        self.latest_scrape = self.create_latest_scrape()
         for register, value in persist_registers.items():
             self.latest_scrape[register] = value
 
@@ -669,6 +814,23 @@ class SungrowClient(SungrowClientCore):
         }
         return persist_registers
 
+    def get_state(self):
+        state = super().get_state()
+        state["legacy_registers"] = {
+            name: self.latest_scrape[name]
+            for name in ["last_reset", "daily_export_to_grid", "daily_import_from_grid"]
+            if name in self.latest_scrape
+        }
+        return state
+
+    def set_state(self, state):
+        # The daily registers are carried over to the next scrape by
+        # init_latest_scrape(). They are reset if last_reset is from a
+        # previous day, see create_custom_registers().
+        super().set_state(state)
+        self.latest_scrape.update(state.get("legacy_registers", {}))
+        self.last_reset_date = None
+
     def do_field_post_processing(self):
         super().do_field_post_processing()
         self.convert_time_fields_to_timestamp()
@@ -704,19 +866,29 @@ class SungrowClient(SungrowClientCore):
     def convert_time_fields_to_timestamp(self):
         # A timestamp is delivered in 6 distinct time fields by the inverter, create a timestamp from these values.
         ## vr002
+        # The time is kept as datetime in the ScrapeTime of the scrape, the
+        # register contains it formatted as string.
+        scrape_time = self.scrape_time
         try:
             if self.inverter_config.get('use_local_time',False):
-                self.latest_scrape["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                scrape_time.timestamp_datetime = scrape_time.datetime
+                self.latest_scrape["timestamp"] = scrape_time.datetime.strftime("%Y-%m-%d %H:%M:%S")
                 logging.debug(f'Using local computer time as timestamp for scrape: {self.latest_scrape.get("timestamp")}')       
             else:
                 try:
+                    scrape_time.inverter_datetime = datetime(
+                        self.latest_scrape["year"], self.latest_scrape["month"], self.latest_scrape["day"],
+                        self.latest_scrape["hour"], self.latest_scrape["minute"], self.latest_scrape["second"],
+                    ).astimezone()
+                    scrape_time.timestamp_datetime = scrape_time.inverter_datetime
                     self.latest_scrape["timestamp"] = "%04d-%02d-%02d %s:%02d:%02d" % (
                         self.latest_scrape["year"], self.latest_scrape["month"], self.latest_scrape["day"],
                         self.latest_scrape["hour"], self.latest_scrape["minute"], self.latest_scrape["second"],
                     )
                     logging.debug(f'Using inverter time as timestamp for scrape: {self.latest_scrape.get("timestamp")}')       
                 except Exception:
-                    self.latest_scrape["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    scrape_time.timestamp_datetime = scrape_time.datetime
+                    self.latest_scrape["timestamp"] = scrape_time.datetime.strftime("%Y-%m-%d %H:%M:%S")
                     logging.warning(f'Failed to get timestamp from inverter, using local computer time as timestamp for scrape: {self.latest_scrape.get("timestamp")}')       
         finally:
             for field in ["year", "month", "day", "hour", "minute", "second"]:
@@ -746,18 +918,26 @@ class SungrowClient(SungrowClientCore):
             pass
 
         ## vr003 - last_reset
-        date_format = "%Y-%m-%d %H:%M:%S"
+        # The dates are compared using the datetime of the scrape instead of
+        # parsing the registers.
+        timestamp_date = self.get_timestamp().date()
         if not self.latest_scrape.get('last_reset', False):
             logging.info('Setting Initial Daily registers; daily_export_to_grid, daily_import_from_grid, last_reset')
             self.latest_scrape["daily_export_to_grid"] = 0
             self.latest_scrape["daily_import_from_grid"] = 0
             self.latest_scrape['last_reset'] = self.latest_scrape["timestamp"]
-        elif datetime.strptime(self.latest_scrape['last_reset'], date_format).date() < datetime.strptime(self.latest_scrape['timestamp'], date_format).date():
-            logging.info('last_reset: ' + self.latest_scrape['last_reset'] + ', timestamp: ' + self.latest_scrape['timestamp'])
-            logging.info('Resetting Daily registers; daily_export_to_grid, daily_import_from_grid, last_reset')
-            self.latest_scrape["daily_export_to_grid"] = 0
-            self.latest_scrape["daily_import_from_grid"] = 0
-            self.latest_scrape['last_reset'] = self.latest_scrape["timestamp"]
+            self.last_reset_date = timestamp_date
+        else:
+            if self.last_reset_date is None:
+                # E.g. restored from a state checkpoint:
+                self.last_reset_date = datetime.strptime(self.latest_scrape['last_reset'], "%Y-%m-%d %H:%M:%S").date()
+            if self.last_reset_date < timestamp_date:
+                logging.info('last_reset: ' + self.latest_scrape['last_reset'] + ', timestamp: ' + self.latest_scrape['timestamp'])
+                logging.info('Resetting Daily registers; daily_export_to_grid, daily_import_from_grid, last_reset')
+                self.latest_scrape["daily_export_to_grid"] = 0
+                self.latest_scrape["daily_import_from_grid"] = 0
+                self.latest_scrape['last_reset'] = self.latest_scrape["timestamp"]
+                self.last_reset_date = timestamp_date
 
         ## vr004 - import_from_grid, vr005 - export_to_grid
         # Create a registers for Power imported and exported to/from Grid
@@ -67,9 +67,10 @@ class export_hassio(object):
                 logging.error(f"PVOutput: System Status Failed; {str(response.status_code)} Message; {str(response.content)}")
         
         except Exception as err:
+            # Raise the error to have the configuration retried later on.
             logging.error(f"PVOutput: Failed to configure")
             logging.debug(f"{err}")
-            return False
+            raise
 
         try:
             if not team_member and self.pvoutput_config['join_team']:
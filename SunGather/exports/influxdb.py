@@ -1,21 +1,47 @@
-import influxdb_client
+from BatchWriter import BatchWriter, DiskSpool, WriteRejected
+from LineProtocol import LineTemplate, format_line, get_formatter
+
 import logging
-from influxdb_client.client.write_api import SYNCHRONOUS
 
 class export_influxdb(object):
+    # Points are written by a BatchWriter in the background, so publishing
+    # never waits for the InfluxDB server. See BatchWriter for batching,
+    # retries and the optional spool.
+
+    # HTTP status codes of writes rejected for the data itself, which are
+    # dropped instead of retried:
+    REJECTED_STATUS = [400, 413, 422]
+
     def __init__(self):
         self.client = None
         self.write_api = None
+        self.writer = None
+        # One LineTemplate per point, see build_templates():
+        self.templates = []
 
     # Configure InfluxDB
     def configure(self, config, inverter):
+        # influxdb_client is imported on first use only, it takes a
+        # significant time to import.
+        import influxdb_client
+        from influxdb_client.client.write_api import SYNCHRONOUS
+
         self.influxdb_config = {
             'url': config.get('url', "http://localhost:8086"),
             'token': config.get('token', None),
             'username': config.get('username', None),
             'password': config.get('password', None),
             'org': config.get('org',None),
-            'bucket': config.get('bucket',None)
+            'bucket': config.get('bucket',None),
+            'publish_rollups': config.get('publish_rollups',False),
+            'gzip': config.get('gzip', False),
+            'batch_size': config.get('batch_size', 1000),
+            'flush_interval': config.get('flush_interval', 5),
+            'max_queued': config.get('max_queued', 10000),
+            'retry_interval': config.get('retry_interval', 5),
+            'max_retry_interval': config.get('max_retry_interval', 300),
+            'spool_dir': config.get('spool_dir', None),
+            'spool_max_size': config.get('spool_max_size', 50),
         }
         self.influxdb_measurements = [{}]
         self.influxdb_measurements.pop() # Remove null value from list
@@ -29,13 +55,15 @@ class export_influxdb(object):
                 self.client = influxdb_client.InfluxDBClient(
                     url=self.influxdb_config['url'],
                     token=self.influxdb_config['token'],
-                    org=self.influxdb_config['org']
+                    org=self.influxdb_config['org'],
+                    enable_gzip=self.influxdb_config['gzip']
                 )
             elif config.get('username',False) and config.get('password',False):
                 self.client = influxdb_client.InfluxDBClient(
                     url=self.influxdb_config['url'],
                     token=f"{self.influxdb_config['username']}:{self.influxdb_config['password']}",
-                    org=self.influxdb_config['org']
+                    org=self.influxdb_config['org'],
+                    enable_gzip=self.influxdb_config['gzip']
                 )
 
         except Exception as err:
@@ -49,26 +77,107 @@ class export_influxdb(object):
             self.influxdb_measurements.append(measurement)
 
         self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+        self.build_templates(inverter)
+
+        spool = None
+        if self.influxdb_config['spool_dir']:
+            spool = DiskSpool(self.influxdb_config['spool_dir'], self.influxdb_config['spool_max_size'] * 1024 * 1024)
+        self.writer = BatchWriter(
+            "InfluxDB",
+            self.write_lines,
+            batch_size=self.influxdb_config['batch_size'],
+            flush_interval=self.influxdb_config['flush_interval'],
+            max_queued=self.influxdb_config['max_queued'],
+            retry_interval=self.influxdb_config['retry_interval'],
+            max_retry_interval=self.influxdb_config['max_retry_interval'],
+            spool=spool,
+        )
+        self.writer.start()
         logging.info(f"InfluxDB: Configured: {self.client.url}")
 
         return True
 
-    def publish(self, inverter):
-        sequence = []
-
+    def build_templates(self, inverter):
+        # Measurements with the same point are written as one line with a
+        # field per register. The model tag and the types of the fields are
+        # determined once.
+        self.tags = {"inverter": inverter.getInverterModel(True)}
+        definitions = {register.get('name'): register for register in inverter.get_my_register_list()}
+        fields_by_point = {}
         for measurement in self.influxdb_measurements:
             register = measurement['register']
-            if not inverter.validateLatestScrape(register):
+            fields_by_point.setdefault(measurement['point'], {})[register] = get_formatter(definitions.get(register))
+        self.templates = [LineTemplate(point, self.tags, fields) for point, fields in fields_by_point.items()]
+        self.registers = list(dict.fromkeys(measurement['register'] for measurement in self.influxdb_measurements))
+        logging.debug(f"InfluxDB: Writing {len(self.registers)} registers in {len(self.templates)} points.")
+
+    def write_lines(self, lines):
+        # Write a batch of lines in line protocol, called by the BatchWriter.
+        from influxdb_client import WritePrecision
+        from influxdb_client.rest import ApiException
+
+        try:
+            self.write_api.write(self.influxdb_config['bucket'], self.client.org, "\n".join(lines), write_precision=WritePrecision.NS)
+        except ApiException as err:
+            if err.status in self.REJECTED_STATUS:
+                raise WriteRejected(f"{err.status} {err.reason}: {err.body}")
+            raise ConnectionError(f"{err.status} {err.reason}") from err
+
+    def get_metrics(self):
+        # Queue depth, flush latency, dropped points, ... of the writer.
+        if self.writer is None:
+            return {}
+        return self.writer.get_metrics()
+
+    def close(self):
+        # Write the points still queued, called on exit.
+        if self.writer is not None:
+            self.writer.close()
+
+    def publish_rollups(self, inverter):
+        # Write completed hours, days and months to the measurements
+        # ´rollup_hour`, ´rollup_day` and ´rollup_month` with the start of the
+        # period as time. Non numeric values are omitted.
+        from Rollup import Rollups
+
+        lines = []
+        for rollup in inverter.completed_rollups:
+            start = int(Rollups.get_period_start(rollup['period'], rollup['key']))
+            for register, results in rollup['values'].items():
+                if not isinstance(results['min'], (int, float)):
+                    continue
+                fields = {
+                    name: value for name, value in results.items()
+                    if isinstance(value, (int, float)) and not isinstance(value, bool)
+                }
+                line = format_line(f"rollup_{rollup['period']}", {**self.tags, "register": register}, fields, start * 1000000000)
+                if line is not None:
+                    lines.append(line)
+        if not lines:
+            return
+        self.writer.add(lines)
+        logging.info(f"InfluxDB: Queued {len(lines)} rollups")
+
+    def publish(self, inverter):
+        if self.influxdb_config['publish_rollups'] and inverter.completed_rollups:
+            self.publish_rollups(inverter)
+
+        values = inverter.latest_scrape
+        for register in self.registers:
+            if register not in values:
                 logging.error(f"InfluxDB: Skipped collecting data, {register} missing from last scrape")
                 return False
-            value = inverter.getRegisterValue(register) if type(inverter.getRegisterValue(register)) is str else float(inverter.getRegisterValue(register))
-            sequence.append(influxdb_client.Point(measurement['point']).tag("inverter", inverter.getInverterModel(True)).field(register, value))
 
-        try:
-            self.write_api.write(self.influxdb_config['bucket'], self.client.org, sequence)
-        except Exception as err:
-            logging.error("InfluxDB: " + str(err))
+        # Points are written with the time of the scrape, not the time of
+        # arrival at the server:
+        scrape_ns = inverter.scrape_time.epoch_ns
+        lines = []
+        for template in self.templates:
+            line = template.format(values, scrape_ns)
+            if line is not None:
+                lines.append(line)
+        self.writer.add(lines)
 
-        logging.info("InfluxDB: Published")
+        logging.info(f"InfluxDB: Queued {len(lines)} points")
 
         return True
@@ -1,18 +1,97 @@
+from BatchWriter import DiskSpool
+from RegisterWriter import RegisterWriter
+
+import base64
 import logging
 import json
-import paho.mqtt.client as mqtt
+import threading
+import time
+import zlib
+
+from collections import deque
 
 class export_mqtt(object):
+    # Messages published are tracked by message id until paho reports them
+    # as written (qos 0) or acknowledged (qos 1 and 2).
+
+    # While the broker is not available messages with qos 1 (and, if a spool
+    # is configured, the JSON payload) are stored: at most max_queued
+    # messages in memory, further messages are moved to the spool or dropped
+    # according to the drop_policy. Stored messages are replayed in order by
+    # a background thread after reconnecting, at most replay_rate messages
+    # per second. New messages are stored behind them until all are
+    # replayed, so retained messages are never overwritten by older ones.
+
+    DROP_POLICIES = ["oldest", "newest"]
+
+    PAYLOAD_FORMATS = ["json", "compact"]
+
+    # paho.mqtt.client.MQTT_ERR_NO_CONN, paho is imported on first use only:
+    MQTT_ERR_NO_CONN = 4
+
     def __init__(self):
         self.mqtt_client = None
         self.sensor_topic = None
-        self.mqtt_queue = []
         self.ha_discovery_published = False
+
+        # (MQTTMessageInfo, qos) of the messages not written or acknowledged
+        # yet by message id. on_publish() is called by paho while holding
+        # its own locks, so the dictionary is changed without taking
+        # self.lock.
+        self.in_flight = {}
+
+        # Messages (topic, payload, qos, retain) stored while the broker is
+        # not available, oldest first:
+        self.stored = deque()
+        self.spool = None
+        # (name, messages, position) of the spooled batch being replayed:
+        self.spool_batch = None
+        self.replay_event = threading.Event()
+
+        # Counters for get_metrics():
+        self.published = 0
+        self.replayed = 0
+        self.dropped = 0
+
+        # Schema of the compact payload (see option ´payload_format`): the
+        # register names in the order of their values and their index.
+        # Registers are only appended, so the position of a register never
+        # changes while running.
+        self.schema_fields = []
+        self.schema_index = {}
+        self.schema_version = None
+        # The schema version and the configuration last published, None if
+        # to be published with the next payload:
+        self.published_schema_version = None
+        self.published_config = None
+
+        # Commands received on the command topic and not written yet, see
+        # command_loop(): the target values by register name and the
+        # (topic, correlation data) of the responses to send.
+        self.pending_commands = {}
+        self.pending_replies = []
+        self.command_condition = threading.Condition()
+
+        # Topics of the registers by register name, see option
+        # ´register_topics`:
+        self.register_topics = {}
+
+        # Topic aliases (MQTT v5) of the current connection by topic. The
+        # broker announces the maximum number of aliases when connecting,
+        # aliases are valid for one connection only.
+        self.topic_aliases = {}
+        self.topic_alias_maximum = 0
+        self.alias_properties = {}
+        # Protects the topic aliases and the stored messages:
+        self.lock = threading.Lock()
         # Exclude ones linked to register lookups; unit_of_measurement
         self.ha_variables = ["action_topic", "action_template", "automation_type", "aux_command_topic", "aux_state_template", "aux_state_topic", "available_tones", "availability", "availability_mode", "availability_topic", "availability_template", "away_mode_command_topic", "away_mode_state_template", "away_mode_state_topic", "blue_template", "brightness_command_topic", "brightness_command_template", "brightness_scale", "brightness_state_topic", "brightness_template", "brightness_value_template", "color_temp_command_template", "battery_level_topic", "battery_level_template", "charging_topic", "charging_template", "color_temp_command_topic", "color_temp_state_topic", "color_temp_template", "color_temp_value_template", "color_mode", "color_mode_state_topic", "color_mode_value_template", "cleaning_topic", "cleaning_template", "command_off_template", "command_on_template", "command_topic", "command_template", "code_arm_required", "code_disarm_required", "code_trigger_required", "current_temperature_topic", "current_temperature_template", "device", "device_class", "docked_topic", "docked_template", "encoding", "enabled_by_default", "entity_category", "entity_picture", "error_topic", "error_template", "fan_speed_topic", "fan_speed_template", "fan_speed_list", "flash_time_long", "flash_time_short", "effect_command_topic", "effect_command_template", "effect_list", "effect_state_topic", "effect_template", "effect_value_template", "expire_after", "fan_mode_command_template", "fan_mode_command_topic", "fan_mode_state_template", "fan_mode_state_topic", "force_update", "green_template", "hold_command_template", "hold_command_topic", "hold_state_template", "hold_state_topic", "hs_command_topic", "hs_state_topic", "hs_value_template", "icon", "image_encoding", "initial", "target_humidity_command_topic", "target_humidity_command_template", "target_humidity_state_topic", "target_humidity_state_template", "json_attributes", "json_attributes_topic", "json_attributes_template", "latest_version_topic", "latest_version_template", "last_reset_topic", "last_reset_value_template", "max", "min", "max_mireds", "min_mireds", "max_temp", "min_temp", "max_humidity", "min_humidity", "mode", "mode_command_template", "mode_command_topic", "mode_state_template", "mode_state_topic", "modes", "name", "object_id", "off_delay", "on_command_type", "options", "optimistic", "oscillation_command_topic", "oscillation_command_template", "oscillation_state_topic", "oscillation_value_template", "percentage_command_topic", "percentage_command_template", "percentage_state_topic", "percentage_value_template", "pattern", "payload", "payload_arm_away", "payload_arm_home", "payload_arm_custom_bypass", "payload_arm_night", "payload_arm_vacation", "payload_press", "payload_reset", "payload_available", "payload_clean_spot", "payload_close", "payload_disarm", "payload_home", "payload_install", "payload_lock", "payload_locate", "payload_not_available", "payload_not_home", "payload_off", "payload_on", "payload_open", "payload_oscillation_off", "payload_oscillation_on", "payload_pause", "payload_stop", "payload_start", "payload_start_pause", "payload_return_to_base", "payload_reset_humidity", "payload_reset_mode", "payload_reset_percentage", "payload_reset_preset_mode", "payload_turn_off", "payload_turn_on", "payload_trigger", "payload_unlock", "position_closed", "position_open", "power_command_topic", "power_state_topic", "power_state_template", "preset_mode_command_topic", "preset_mode_command_template", "preset_mode_state_topic", "preset_mode_value_template", "preset_modes", "red_template", "release_summary", "release_url", "retain", "rgb_command_topic", "rgb_command_template", "rgb_state_topic", "rgb_value_template", "rgbw_command_topic", "rgbw_command_template", "rgbw_state_topic", "rgbw_value_template", "rgbww_command_topic", "rgbww_command_template", "rgbww_state_topic", "rgbww_value_template", "send_command_topic", "send_if_off", "set_fan_speed_topic", "set_position_template", "set_position_topic", "position_topic", "position_template", "speed_range_min", "speed_range_max", "source_type", "state_class", "state_closed", "state_closing", "state_off", "state_on", "state_open", "state_opening", "state_stopped", "state_locked", "state_unlocked", "state_topic", "state_template", "state_value_template", "step", "subtype", "supported_color_modes", "support_duration", "support_volume_set", "supported_features", "swing_mode_command_template", "swing_mode_command_topic", "swing_mode_state_template", "swing_mode_state_topic", "temperature_command_template", "temperature_command_topic", "temperature_high_command_template", "temperature_high_command_topic", "temperature_high_state_template", "temperature_high_state_topic", "temperature_low_command_template", "temperature_low_command_topic", "temperature_low_state_template", "temperature_low_state_topic", "temperature_state_template", "temperature_state_topic", "temperature_unit", "tilt_closed_value", "tilt_command_topic", "tilt_command_template", "tilt_invert_state", "tilt_max", "tilt_min", "tilt_opened_value", "tilt_optimistic", "tilt_status_topic", "tilt_status_template", "title", "topic", "unique_id", "value_template", "white_command_topic", "white_scale", "white_value_command_topic", "white_value_scale", "white_value_state_topic", "white_value_template", "xy_command_topic", "xy_state_topic", "xy_value_template"]
 
     # Configure MQTT
     def configure(self, config, inverter):
+        # paho is imported on first use only.
+        import paho.mqtt.client as mqtt
+
         self.model = inverter.getInverterModel(True)
         self.serial_number = inverter.getSerialNumber()
 
@@ -23,7 +102,19 @@ class export_mqtt(object):
             'topic': config.get('topic', f"SunGather/{self.serial_number}"),
             'username': config.get('username', None),
             'password': config.get('password',None),
-            'homeassistant': config.get('homeassistant',False)
+            'homeassistant': config.get('homeassistant',False),
+            'publish_rollups': config.get('publish_rollups',False),
+            'publish_events': config.get('publish_events',False),
+            'register_topics': config.get('register_topics',False),
+            'protocol': str(config.get('protocol', '3.1.1')),
+            'max_queued': config.get('max_queued', 1000),
+            'drop_policy': config.get('drop_policy', 'oldest'),
+            'spool_dir': config.get('spool_dir', None),
+            'spool_max_size': config.get('spool_max_size', 50),
+            'replay_rate': config.get('replay_rate', 10),
+            'payload_format': config.get('payload_format', 'json'),
+            'command_topic': config.get('command_topic', None),
+            'response_topic': config.get('response_topic', None)
         }
 
         self.ha_sensors = [{}]
@@ -35,22 +126,44 @@ class export_mqtt(object):
         if not self.mqtt_config['host']:
             logging.info(f"MQTT: Host config is required")
             return False
-        client_id = self.mqtt_config['client_id']
-        self.mqtt_client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
-        self.mqtt_client.on_connect = self.on_connect
-        self.mqtt_client.on_disconnect = self.on_disconnect
-        self.mqtt_client.on_publish = self.on_publish
-
-        if self.mqtt_config['username'] and self.mqtt_config['password']:
-            self.mqtt_client.username_pw_set(self.mqtt_config['username'], self.mqtt_config['password'])
-
-        if self.mqtt_config['port'] == 8883:
-            self.mqtt_client.tls_set()
-        
-        self.mqtt_client.connect_async(self.mqtt_config['host'], port=self.mqtt_config['port'], keepalive=60)
-        self.mqtt_client.loop_start()
+        if self.mqtt_config['drop_policy'] not in self.DROP_POLICIES:
+            logging.error(f"MQTT: drop_policy must be one of {self.DROP_POLICIES}")
+            return False
+        if type(self.mqtt_config['max_queued']) is not int or self.mqtt_config['max_queued'] <= 0:
+            logging.error(f"MQTT: max_queued must be a positive integer")
+            return False
+        if type(self.mqtt_config['replay_rate']) not in (int, float) or not self.mqtt_config['replay_rate'] > 0:
+            logging.error(f"MQTT: replay_rate must be a positive number")
+            return False
+        if self.mqtt_config['payload_format'] not in self.PAYLOAD_FORMATS:
+            logging.error(f"MQTT: payload_format must be one of {self.PAYLOAD_FORMATS}")
+            return False
+        if self.mqtt_config['payload_format'] == 'compact' and self.mqtt_config['homeassistant']:
+            logging.error(f"MQTT: Home Assistant discovery requires payload_format json")
+            return False
+        if self.mqtt_config['command_topic']:
+            # Like the import ´http`, writing registers works with these
+            # connections only:
+            if inverter.inverter_config.get('connection') not in ["modbus", "sungrow"]:
+                logging.error("MQTT: command_topic requires connection ´modbus` or ´sungrow`")
+                return False
+            # A wildcard would subscribe to the responses as well, every
+            # response would be read back as (invalid) command:
+            if any(wildcard in self.mqtt_config['command_topic'] for wildcard in "#+"):
+                logging.error("MQTT: command_topic must not contain wildcards ´#` or ´+`")
+                return False
+            if self.mqtt_config['response_topic'] is None:
+                self.mqtt_config['response_topic'] = f"{self.mqtt_config['command_topic']}/response"
+            elif any(wildcard in self.mqtt_config['response_topic'] for wildcard in "#+"):
+                logging.error("MQTT: response_topic must not contain wildcards ´#` or ´+`")
+                return False
 
+        # The whole configuration is validated before connecting and starting
+        # any thread, so an invalid configuration leaves nothing running:
         if self.mqtt_config['homeassistant']:
+            if not config.get('ha_sensors'):
+                logging.error("MQTT: homeassistant requires ha_sensors")
+                return False
             for ha_sensor in config.get('ha_sensors'):
                 if not inverter.validateRegister(ha_sensor['register']):
                     logging.error(f"MQTT: Configured to use {ha_sensor['register']} but not configured to scrape this register")
@@ -66,34 +179,456 @@ class export_mqtt(object):
                 else:
                     self.topics.append(topic)
 
+        if self.mqtt_config['register_topics']:
+            # Topics of registers not known yet (e.g. custom fields) are
+            # added on first publish.
+            self.register_topics = {
+                register['name']: f"{self.mqtt_config['topic']}/{register['name']}"
+                for register in inverter.get_my_register_list()
+            }
+
+        if self.mqtt_config['spool_dir']:
+            self.spool = DiskSpool(self.mqtt_config['spool_dir'], self.mqtt_config['spool_max_size'] * 1024 * 1024)
+        client_id = self.mqtt_config['client_id']
+        protocol = mqtt.MQTTv5 if self.mqtt_config['protocol'] == '5' else mqtt.MQTTv311
+        self.mqtt_client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, protocol=protocol)
+        self.mqtt_client.on_connect = self.on_connect
+        self.mqtt_client.on_disconnect = self.on_disconnect
+        self.mqtt_client.on_publish = self.on_publish
+        self.mqtt_client.on_message = self.on_message
+        # Limits the messages queued by paho itself, e.g. qos 1 messages
+        # waiting for an acknowledgement:
+        self.mqtt_client.max_queued_messages_set(self.mqtt_config['max_queued'])
+
+        if self.mqtt_config['username'] and self.mqtt_config['password']:
+            self.mqtt_client.username_pw_set(self.mqtt_config['username'], self.mqtt_config['password'])
+
+        if self.mqtt_config['port'] == 8883:
+            self.mqtt_client.tls_set()
+
+        if self.mqtt_config['payload_format'] == 'compact':
+            self.inverter = inverter
+            self.compact_encoder = f"mqtt_compact:{self.mqtt_config['topic']}"
+            inverter.snapshot_cache.register_encoder(self.compact_encoder, self.encode_compact)
+
+        self.mqtt_client.connect_async(self.mqtt_config['host'], port=self.mqtt_config['port'], keepalive=60)
+        self.mqtt_client.loop_start()
+
+        replay_thread = threading.Thread(target=self.replay_loop, name="mqtt-replay")
+        replay_thread.daemon = True
+        replay_thread.start()
+
+        if self.mqtt_config['command_topic']:
+            self.register_writer = RegisterWriter()
+            self.register_writer.attach(inverter)
+            command_thread = threading.Thread(target=self.command_loop, name="mqtt-commands")
+            command_thread.daemon = True
+            command_thread.start()
+
+        if self.mqtt_config['publish_events'] and inverter.rule_engine is not None:
+            inverter.rule_engine.add_sink(self.publish_event)
+
         return True
 
     def on_connect(self, client, userdata, flags, reason_code, properties):
         logging.info(f"MQTT: Connected to {client._host}:{client._port}")
+        maximum = getattr(properties, "TopicAliasMaximum", 0) if properties is not None else 0
+        self.reset_topic_aliases(maximum)
+        if maximum:
+            logging.info(f"MQTT: Using up to {maximum} topic aliases")
+        # Publish the retained schema and configuration again with the next
+        # payload, in case the broker lost them:
+        self.published_schema_version = None
+        self.published_config = None
+        if self.mqtt_config['command_topic']:
+            client.subscribe(self.mqtt_config['command_topic'], qos=1)
+        self.replay_event.set()
 
     def on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
         logging.info(f"MQTT: Server Disconnected code: {reason_code}")
+        self.reset_topic_aliases(0)
+        # paho discards qos 0 messages not written yet:
+        for mid, (info, qos) in list(self.in_flight.items()):
+            if qos == 0:
+                self.in_flight.pop(mid, None)
+
+    def reset_topic_aliases(self, maximum):
+        with self.lock:
+            self.topic_aliases = {}
+            self.topic_alias_maximum = maximum
+
+    def publish_aliased(self, topic, payload):
+        # Publish a message with qos 0 using a topic alias if the broker
+        # supports them: the first message to a topic carries the topic and
+        # assigns the alias, later messages carry the alias only. Topics
+        # exceeding the maximum number of aliases are published as usual.
+        with self.lock:
+            alias = self.topic_aliases.get(topic)
+            if alias is not None:
+                return self.mqtt_client.publish("", payload, qos=0, properties=self.get_alias_properties(alias))
+            if len(self.topic_aliases) >= self.topic_alias_maximum:
+                return self.mqtt_client.publish(topic, payload, qos=0)
+            alias = len(self.topic_aliases) + 1
+            info = self.mqtt_client.publish(topic, payload, qos=0, properties=self.get_alias_properties(alias))
+            if info.rc == 0:
+                # The alias is known to the broker now:
+                self.topic_aliases[topic] = alias
+            return info
+
+    def get_alias_properties(self, alias):
+        properties = self.alias_properties.get(alias)
+        if properties is None:
+            from paho.mqtt.packettypes import PacketTypes
+            from paho.mqtt.properties import Properties
+
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.TopicAlias = alias
+            self.alias_properties[alias] = properties
+        return properties
+
+    def publish_registers(self, inverter):
+        # Publish every value of the scrape to ´<topic>/<register name>`.
+        # Messages are published with qos 0 and are not tracked.
+        register_topics = self.register_topics
+        for name, value in inverter.latest_scrape.items():
+            topic = register_topics.get(name)
+            if topic is None:
+                topic = register_topics[name] = f"{self.mqtt_config['topic']}/{name}"
+            if value is not None and not isinstance(value, (str, int, float, bytes)):
+                value = json.dumps(value, default=str)
+            self.publish_aliased(topic, value)
+        logging.info("MQTT: Published register topics")
     
     def on_publish(self, client, userdata, mid, reason_code, properties):
-        try:
-            self.mqtt_queue.remove(mid)
-        except Exception as err:
-            pass
+        self.in_flight.pop(mid, None)
         logging.debug(f"MQTT: Message {mid} Published")
 
+    def track(self, info, qos):
+        # Track a message handed over to paho until on_publish() is called.
+        if len(self.in_flight) >= self.mqtt_config['max_queued']:
+            self.prune_in_flight()
+            if len(self.in_flight) >= self.mqtt_config['max_queued']:
+                # Should not happen, paho limits its queue as well:
+                self.in_flight.pop(next(iter(self.in_flight)), None)
+        self.in_flight[info.mid] = (info, qos)
+        self.published += 1
+
+    def prune_in_flight(self):
+        # Remove messages published before they were tracked: on_publish()
+        # may be called by paho's thread before publish() returned.
+        for mid, (info, qos) in list(self.in_flight.items()):
+            try:
+                if info.is_published():
+                    self.in_flight.pop(mid, None)
+            except (ValueError, RuntimeError):
+                # Not sent yet because of a lost connection, paho sends
+                # messages with qos > 0 after reconnecting.
+                pass
+
+    def send(self, topic, payload, qos=0, retain=False, forward=False):
+        # Publish a message. If the broker is not available, messages with
+        # qos > 0 are stored and replayed later, with forward=True also
+        # messages with qos 0 if a spool is configured. Other messages are
+        # not published at all.
+        store = qos > 0 or (forward and self.spool is not None)
+        with self.lock:
+            if store and self.has_stored():
+                self.store((topic, payload, qos, retain))
+                return
+        if self.mqtt_client.is_connected():
+            info = self.mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+            # Messages with qos > 0 are kept by paho if the connection was
+            # lost meanwhile:
+            if info.rc == 0 or (qos > 0 and info.rc == self.MQTT_ERR_NO_CONN):
+                self.track(info, qos)
+                return
+        if store:
+            with self.lock:
+                self.store((topic, payload, qos, retain))
+
+    def store(self, message):
+        # Store a message to be replayed later. Must be called holding
+        # self.lock.
+        self.stored.append(message)
+        if len(self.stored) > self.mqtt_config['max_queued']:
+            if self.spool is not None:
+                self.spool_stored()
+            elif self.mqtt_config['drop_policy'] == 'newest':
+                self.stored.pop()
+                self.dropped += 1
+            else:
+                self.stored.popleft()
+                self.dropped += 1
+        if self.mqtt_client.is_connected():
+            self.replay_event.set()
+
+    def has_stored(self):
+        # Must be called holding self.lock.
+        return bool(self.stored or self.spool_batch or (self.spool is not None and self.spool.files))
+
+    def count_stored(self):
+        count = len(self.stored)
+        if self.spool is not None:
+            count += self.spool.lines
+        return count
+
+    def spool_stored(self):
+        # Move the messages stored in memory to the spool. Must be called
+        # holding self.lock.
+        if not self.stored:
+            return
+        lines = [self.encode_message(*message) for message in self.stored]
+        self.stored.clear()
+        try:
+            evicted = self.spool.append(lines)
+        except OSError as err:
+            self.dropped += len(lines)
+            logging.error(f"MQTT: could not spool {len(lines)} messages: {err}")
+            return
+        if evicted:
+            self.dropped += evicted
+            logging.warning(f"MQTT: spool full, dropped {evicted} oldest spooled messages.")
+
+    @staticmethod
+    def encode_message(topic, payload, qos, retain):
+        # One line of JSON per message in the spool.
+        message = {"topic": topic, "qos": qos, "retain": retain}
+        if isinstance(payload, bytes):
+            try:
+                message["payload"] = payload.decode("utf-8")
+            except UnicodeDecodeError:
+                message["payload_base64"] = base64.b64encode(payload).decode("ascii")
+        else:
+            message["payload"] = payload
+        return json.dumps(message)
+
+    @staticmethod
+    def decode_message(line):
+        message = json.loads(line)
+        if "payload_base64" in message:
+            payload = base64.b64decode(message["payload_base64"])
+        else:
+            payload = message.get("payload")
+        return message["topic"], payload, message["qos"], message["retain"]
+
+    def peek_stored(self):
+        # Return the oldest stored message, None if there is none. Spooled
+        # messages are always older than the messages in memory.
+        with self.lock:
+            while self.spool_batch is None and self.spool is not None and self.spool.files:
+                name, lines = self.spool.peek()
+                if name is None:
+                    break
+                try:
+                    messages = [self.decode_message(line) for line in lines]
+                except (ValueError, KeyError) as err:
+                    logging.warning(f"MQTT: Dropping invalid spool file ´{name}`: {err}")
+                    self.dropped += len(lines)
+                    self.spool.remove(name)
+                    continue
+                self.spool_batch = (name, messages, 0)
+            if self.spool_batch is not None:
+                name, messages, position = self.spool_batch
+                return messages[position]
+            if self.stored:
+                return self.stored[0]
+        return None
+
+    def remove_stored(self):
+        # Remove the message returned by peek_stored() after replaying it.
+        with self.lock:
+            if self.spool_batch is not None:
+                name, messages, position = self.spool_batch
+                if position + 1 < len(messages):
+                    self.spool_batch = (name, messages, position + 1)
+                else:
+                    self.spool.remove(name)
+                    self.spool_batch = None
+            elif self.stored:
+                self.stored.popleft()
+
+    def replay_loop(self):
+        # Replay stored messages after reconnecting, rate limited so the
+        # broker is not flooded after an outage.
+        while True:
+            self.replay_event.wait(60)
+            self.replay_event.clear()
+            replayed = 0
+            while self.mqtt_client.is_connected():
+                message = self.peek_stored()
+                if message is None:
+                    break
+                topic, payload, qos, retain = message
+                info = self.mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+                if info.rc != 0 and not (qos > 0 and info.rc == self.MQTT_ERR_NO_CONN):
+                    # Queue of paho full or connection lost, retry later:
+                    break
+                self.track(info, qos)
+                self.remove_stored()
+                self.replayed += 1
+                replayed += 1
+                time.sleep(1 / self.mqtt_config['replay_rate'])
+            if replayed:
+                logging.info(f"MQTT: Replayed {replayed} stored messages")
+
+    def get_metrics(self):
+        self.prune_in_flight()
+        with self.lock:
+            metrics = {
+                "in_flight": len(self.in_flight),
+                "queued": len(self.stored),
+                "published": self.published,
+                "replayed": self.replayed,
+                "dropped": self.dropped,
+            }
+            if self.spool is not None:
+                metrics["spooled"] = self.spool.lines
+                metrics["spooled_bytes"] = self.spool.size
+        return metrics
+
+    def close(self):
+        # Move the messages stored in memory to the spool, called on exit.
+        with self.lock:
+            if not self.stored:
+                return
+            if self.spool is not None:
+                logging.info(f"MQTT: spooled {len(self.stored)} messages on exit.")
+                self.spool_stored()
+            else:
+                logging.warning(f"MQTT: {len(self.stored)} stored messages not published on exit.")
+
+    def on_message(self, client, userdata, message):
+        # A command on the command topic: a JSON object with register names
+        # as keys and the target values as values. Called by paho's network
+        # thread, so writing is left to command_loop().
+        if message.topic == self.mqtt_config['response_topic']:
+            # Never read a response back as command:
+            return
+        reply = None
+        properties = getattr(message, "properties", None)
+        if properties is not None and getattr(properties, "ResponseTopic", None):
+            # MQTT v5 request / response:
+            reply = (properties.ResponseTopic, getattr(properties, "CorrelationData", None))
+        try:
+            command = json.loads(message.payload)
+            if not isinstance(command, dict):
+                raise ValueError("JSON object required")
+        except ValueError as err:
+            logging.error(f"MQTT: Invalid command ´{message.payload}`: {err}")
+            self.send_response({"updates": [], "errors": {}, "error": f"Invalid command: {err}", "success": False}, [reply])
+            return
+        logging.info(f"MQTT: Received command {command}")
+        with self.command_condition:
+            # Commands arriving while registers are written (or the inverter
+            # is scraped) are coalesced, later values replace earlier ones:
+            self.pending_commands.update(command)
+            self.pending_replies.append(reply)
+            self.command_condition.notify()
+
+    def command_loop(self):
+        # Write the pending commands with the RegisterWriter, one write per
+        # contiguous address range, and publish the result.
+        while True:
+            with self.command_condition:
+                while not self.pending_commands and not self.pending_replies:
+                    self.command_condition.wait()
+                commands = self.pending_commands
+                replies = self.pending_replies
+                self.pending_commands = {}
+                self.pending_replies = []
+            errors = {}
+            response = {}
+            try:
+                updates, success = self.register_writer.apply(commands, errors)
+            except Exception as err:
+                logging.exception(f"MQTT: Writing registers failed: {err}")
+                updates, success = [], False
+                response["error"] = str(err)
+            response.update({"updates": updates, "errors": errors, "success": success and not errors})
+            self.send_response(response, replies)
+
+    def send_response(self, response, replies):
+        # Publish the result of commands to the response topic and to the
+        # response topics requested by MQTT v5 commands.
+        payload = json.dumps(response, default=str)
+        self.send(self.mqtt_config['response_topic'], payload, qos=1)
+        for reply in replies:
+            if reply is None:
+                continue
+            topic, correlation_data = reply
+            properties = None
+            if correlation_data is not None:
+                from paho.mqtt.packettypes import PacketTypes
+                from paho.mqtt.properties import Properties
+
+                properties = Properties(PacketTypes.PUBLISH)
+                properties.CorrelationData = correlation_data
+            self.mqtt_client.publish(topic, payload, qos=1, properties=properties)
+
+    def publish_event(self, event):
+        # Called by the rule engine as soon as a rule fires, independent of
+        # the scrape cycle.
+        topic = f"{self.mqtt_config['topic']}/events"
+        self.send(topic, json.dumps(event, default=str), qos=1)
+        logging.info(f"MQTT: Published event of rule {event['rule']}")
+
+    def encode_compact(self, snapshot):
+        # Encode the values of a snapshot as JSON array: the schema version
+        # followed by the values in the order of the schema, null for
+        # registers missing in the scrape.
+        values = snapshot.values
+        schema_index = self.schema_index
+        new_fields = [name for name in values if name not in schema_index]
+        if new_fields or self.schema_version is None:
+            self.extend_schema(new_fields)
+        row = [self.schema_version, *map(values.get, self.schema_fields)]
+        return json.dumps(row, separators=(",", ":"), default=str).encode("utf-8")
+
+    def extend_schema(self, names):
+        for name in names:
+            self.schema_index[name] = len(self.schema_fields)
+            self.schema_fields.append(name)
+        # The version identifies the list of fields, so it is the same after
+        # a restart with the same registers. All 32 bits of the CRC are used,
+        # consumers caching schemas by version would decode values with the
+        # wrong fields after a collision:
+        self.schema_version = zlib.crc32(json.dumps(self.schema_fields).encode("utf-8"))
+
+    def get_schema(self):
+        units = {register['name']: register.get('unit') for register in self.inverter.get_my_register_list()}
+        return {
+            "version": self.schema_version,
+            "fields": [{"name": name, "unit": units.get(name) or None} for name in self.schema_fields],
+        }
+
+    def publish_compact(self, inverter):
+        # Publish the values as compact payload to ´<topic>`. The schema
+        # mapping positions to register names and units is published
+        # retained to ´<topic>/schema`, the configuration of the inverter and
+        # client retained to ´<topic>/config`, both only if changed.
+        payload = inverter.snapshot_cache.current.get_encoded(self.compact_encoder)
+        if self.schema_version != self.published_schema_version:
+            self.send(f"{self.mqtt_config['topic']}/schema", json.dumps(self.get_schema()), qos=1, retain=True)
+            self.published_schema_version = self.schema_version
+            logging.info(f"MQTT: Published schema version {self.schema_version}")
+        config = inverter.inverter_config | inverter.client_config
+        if config != self.published_config:
+            self.send(f"{self.mqtt_config['topic']}/config", json.dumps(config, default=str), qos=1, retain=True)
+            self.published_config = config
+            logging.info("MQTT: Published configuration")
+        logging.debug(f"MQTT: Publishing Registers: {self.mqtt_config['topic']} : {payload}")
+        self.send(self.mqtt_config['topic'], payload, qos=0, forward=True)
+
     def cleanName(self, name):
         return name.lower().replace(' ','_')
 
     def publish(self, inverter):
         try:
             if not self.mqtt_client.is_connected():
-                logging.warning(f'MQTT: Server Disconnected; {self.mqtt_queue.__len__()} messages queued, will automatically attempt to reconnect')
+                logging.warning(f'MQTT: Server Disconnected; {self.count_stored()} messages stored, will automatically attempt to reconnect')
         except Exception as err:
             logging.warning(f'MQTT: Server Error; Server not configured')
             return False
-        # qos=0 is set, so no acknowledgment is sent, rending this check useless
-        #elif self.mqtt_queue.__len__() > 10:
-        #    logging.warning(f'MQTT: {self.mqtt_queue.__len__()} messages queued, this may be due to a MQTT server issue')
 
         if self.mqtt_config['homeassistant'] and not self.ha_discovery_published:
             # Build Device, this will be the same for every message
@@ -127,17 +662,39 @@ class export_mqtt(object):
                 # <discovery_prefix>/<component>/<object_id>/config
                 ha_topic = f"homeassistant/{ha_sensor.get('sensor_type')}/{self.serial_number}_{self.cleanName(ha_sensor.get('name'))}/config"
                 logging.debug(f'MQTT: Topic; {ha_topic}, Message: {config_msg}')
-                self.mqtt_queue.append(self.mqtt_client.publish(ha_topic, json.dumps(config_msg), retain=True, qos=1).mid)
+                self.send(ha_topic, json.dumps(config_msg), qos=1, retain=True)
             self.ha_discovery_published = True
             logging.info("MQTT: Published Home Assistant Discovery messages")
         if self.topics:
             for topic in self.topics:
-                self.mqtt_queue.append(self.mqtt_client.publish(topic.get('topic'), inverter.getRegisterValue(topic.get('register')), qos=0).mid)
+                info = self.publish_aliased(topic.get('topic'), inverter.getRegisterValue(topic.get('register')))
+                if info.rc == 0:
+                    self.track(info, 0)
             logging.info("MQTT: Published custom mqtt topics")
 
-        payload = json.dumps(inverter.inverter_config | inverter.client_config | inverter.latest_scrape).replace('"', '\"')
-        logging.debug(f"MQTT: Publishing Registers: {self.mqtt_config['topic']} : {payload}")
-        self.mqtt_queue.append(self.mqtt_client.publish(self.mqtt_config['topic'], payload, qos=0).mid)
+        if self.mqtt_config['register_topics']:
+            self.publish_registers(inverter)
+
+        if self.mqtt_config['publish_rollups']:
+            # Completed hours, days and months are published retained to
+            # ´<topic>/rollups/<period>`:
+            for rollup in inverter.completed_rollups:
+                rollup_topic = f"{self.mqtt_config['topic']}/rollups/{rollup['period']}"
+                self.send(rollup_topic, json.dumps(rollup), qos=1, retain=True)
+                logging.info(f"MQTT: Published rollup {rollup['period']} {rollup['key']}")
+
+        if self.mqtt_config['payload_format'] == 'compact':
+            self.publish_compact(inverter)
+        else:
+            payload = inverter.snapshot_cache.current.get_encoded(inverter.snapshot_cache.JSON_WITH_CONFIG)
+            logging.debug(f"MQTT: Publishing Registers: {self.mqtt_config['topic']} : {payload}")
+            self.send(self.mqtt_config['topic'], payload, qos=0, forward=True)
         logging.info(f"MQTT: Registers Published")
 
+        if self.spool is not None and not self.mqtt_client.is_connected():
+            # Spool the messages of every scrape during an outage, so they
+            # survive a restart:
+            with self.lock:
+                self.spool_stored()
+
         return True
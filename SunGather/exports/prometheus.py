@@ -0,0 +1,126 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from PrometheusExposition import (
+    CONTENT_TYPE,
+    RegisterExposition,
+    render_export_metrics,
+    render_field_statistics,
+    render_inverter_info,
+    render_scrape_metrics,
+)
+
+import gzip
+import logging
+
+
+class export_prometheus(object):
+    # Serves the registers in the text exposition format of Prometheus at
+    # ´/metrics`, on a port of its own. Only numeric registers are written,
+    # as gauges or counters (totals), registers with a datarange as state
+    # sets or info metrics, text registers as info metrics. Metrics of
+    # SunGatherEvo itself are included: model and serial number, scrape
+    # durations, latency and errors of reading address ranges, publish
+    # latencies and queue depths of the exports and statistics of custom
+    # fields.
+    #
+    # The payload is encoded on first request only and cached per snapshot
+    # by the SnapshotCache (also compressed with gzip), so the metrics of
+    # SunGatherEvo itself are those at the time of the first request after a
+    # scrape.
+
+    ENCODING = "prometheus"
+
+    def __init__(self):
+        self.inverter = None
+        self.export_manager = None
+        self.exposition = None
+        self.server = None
+
+    def configure(self, config, inverter):
+        self.inverter = inverter
+        self.exposition = RegisterExposition(inverter.get_my_register_list())
+        inverter.snapshot_cache.register_encoder(self.ENCODING, self.encode)
+        inverter.snapshot_cache.register_encoder(f"{self.ENCODING}.gzip", self.encode_gzip)
+        try:
+            self.server = ThreadingHTTPServer(("", config.get("port", 9469)), PrometheusHandler)
+            self.server.export = self
+            thread = Thread(target=self.server.serve_forever, name="prometheus")
+            thread.daemon = True
+            thread.start()
+        except Exception as err:
+            logging.error(f"Prometheus: Error: {err}")
+            return False
+        logging.info(f"Prometheus: Configured, serving port {self.server.server_address[1]}")
+        return True
+
+    def set_export_manager(self, export_manager):
+        # Called by the ExportManager, which provides the metrics of all
+        # exports.
+        self.export_manager = export_manager
+
+    def publish(self, inverter):
+        # Nothing is rendered here, the payload is encoded from the current
+        # snapshot on first request only.
+        return True
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def encode(self, snapshot):
+        return bytes(self.exposition.render(snapshot.values) + self.render_self_metrics(), "utf-8")
+
+    def encode_gzip(self, snapshot):
+        return gzip.compress(snapshot.get_encoded(self.ENCODING), compresslevel=6)
+
+    def render_self_metrics(self):
+        inverter = self.inverter
+        parts = [
+            render_inverter_info(inverter.inverter_config.get("model"), inverter.inverter_config.get("serial_number")),
+            render_scrape_metrics(inverter.scrape_metrics.get_metrics()),
+        ]
+        if self.export_manager is not None:
+            parts.append(render_export_metrics(self.export_manager.get_metrics()))
+        parts.append(render_field_statistics(inverter.field_post_processor.get_statistics()))
+        return "".join(parts)
+
+    def get_body(self, compressed):
+        # Return the payload of the current snapshot, only the metrics of
+        # SunGatherEvo itself before the first successful scrape.
+        snapshot = self.inverter.snapshot_cache.current
+        if snapshot is None:
+            body = bytes(self.render_self_metrics(), "utf-8")
+            return gzip.compress(body, compresslevel=6) if compressed else body
+        return snapshot.get_encoded(f"{self.ENCODING}.gzip" if compressed else self.ENCODING)
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    # Keep connections of the Prometheus server open, see MyServer of the
+    # webserver export.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_body(b"Not Found\n", "text/plain", status=404)
+            return
+        compressed = self.accepts_gzip()
+        self.send_body(self.server.export.get_body(compressed), CONTENT_TYPE, compressed=compressed)
+
+    def send_body(self, body, content_type, status=200, compressed=False):
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if compressed:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def accepts_gzip(self):
+        accepted = self.headers.get("Accept-Encoding", "")
+        return any(coding.split(";")[0].strip() == "gzip" and not coding.replace(" ", "").endswith(";q=0") for coding in accepted.split(","))
+
+    def log_message(self, format, *args):
+        pass
@@ -3,6 +3,8 @@ import requests
 import datetime
 import time
 
+from Aggregation import AggregationStage
+
 """
     See: https://pvoutput.org/help/api_specification.html#add-status-service
     Parameter   Field               Required    Format      Unit    Example     Donation
@@ -60,7 +62,8 @@ class export_pvoutput(object):
         self.pvoutput_parameters = [{}]
         self.pvoutput_parameters.pop() # Remove null value from list
 
-        self.collected_data = {}
+        self.aggregation = None
+        self.collected_data = None
         self.batch_data = []
         self.batch_count = 0
         self.last_run = 0
@@ -93,9 +96,10 @@ class export_pvoutput(object):
                 logging.error(f"PVOutput: System Status Failed; {str(response.status_code)} Message; {str(response.content)}")
         
         except Exception as err:
+            # Raise the error to have the configuration retried later on.
             logging.error(f"PVOutput: Failed to configure")
             logging.debug(f"{err}")
-            return False
+            raise
 
         try:
             if not team_member and self.pvoutput_config['join_team']:
@@ -112,6 +116,30 @@ class export_pvoutput(object):
         logging.info(f"PVOutput: Configured export to {invertername} every {self.status_interval} minutes")
         return True
 
+    def setup_aggregation(self):
+        # Values are averaged over one status interval, except cumulative
+        # energy values: for these only the last value is required.
+        modes = {'timestamp': 'last'}
+        if self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 2:
+            modes['v1'] = 'last'
+        if self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 3:
+            modes['v3'] = 'last'
+        self.aggregation = AggregationStage(self.status_interval * 60, default_mode='mean', modes=modes)
+
+    def get_state(self):
+        # Return the data not yet uploaded, see StateCheckpoint.
+        state = {'batch_data': self.batch_data, 'batch_count': self.batch_count}
+        if self.aggregation is not None:
+            state['aggregation'] = self.aggregation.get_state()
+        return state
+
+    def set_state(self, state):
+        self.batch_data = state.get('batch_data', [])
+        self.batch_count = state.get('batch_count', 0)
+        if state.get('aggregation') is not None:
+            self.setup_aggregation()
+            self.aggregation.set_state(state['aggregation'])
+
     def collect_data(self, inverter):
         # Check all required registers have been returned by the inverter
         if not inverter.validateLatestScrape('timestamp'):
@@ -122,59 +150,63 @@ class export_pvoutput(object):
                 logging.error(f"PVOutput: Skipped collecting data,  {parameter['register']} missing from last scrape")
                 return False
 
-        # Add new data to old data and increase count of data points
+        if self.aggregation is None:
+            self.setup_aggregation()
+
+        # Add new data to the current status interval. When a status interval
+        # is complete, its aggregated data is stored in self.collected_data.
+        # The time is kept as datetime, it is formatted for the upload only.
+        data = {'timestamp': inverter.get_timestamp()}
         for parameter in self.pvoutput_parameters:
             value = inverter.getRegisterValue(parameter.get('register'))
 
             if parameter.get('multiple'):
                 value = value * parameter.get('multiple')
 
-            # If using Cumulative Energy we just need the last data point, not the average
-            if parameter.get('name') == 'v1' and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 2):
-                self.collected_data[parameter.get('name')] = value
-            elif parameter.get('name') == 'v3' and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 3):
-                self.collected_data[parameter.get('name')] = value
-            # Add the last data point to the previous data point if exists, otherwise set as the last data point
-            elif self.collected_data.get(parameter.get('name'),False):
-                self.collected_data[parameter.get('name')] = round(self.collected_data[parameter.get('name')] + value,3)
-            else:
-                self.collected_data[parameter.get('name')] = value
+            data[parameter.get('name')] = value
 
-        if self.collected_data.get('count',False):
-            self.collected_data['count'] +=1
-        else:
-            self.collected_data['count'] = 1
+        self.collected_data = self.aggregation.add(data, inverter.scrape_time.seconds)
 
-        logging.debug(f'PVOutput: Data Logged: {self.collected_data}')
+        logging.debug(f'PVOutput: Data Logged: {data}')
 
         return True
 
+    def create_data_point(self):
+        # Create a data point for the addbatchstatus service from
+        # self.collected_data. Return None if there are no values.
+        any_data = False
+        now = self.collected_data['timestamp']
+        if isinstance(now, str):
+            # Restored from a state checkpoint of an older version:
+            now = datetime.datetime.strptime(now, "%Y-%m-%d %H:%M:%S")
+        data_point = str(now.strftime("%Y%m%d")) + "," + str(now.strftime("%H:%M"))
+        for x in range(1, 13):
+            field = 'v' + str(x)
+            if self.collected_data.get(field):
+                if x == 1  and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 2):
+                    value = int(self.collected_data[field])
+                elif x == 3 and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 3):
+                    value = int(self.collected_data[field])
+                elif x == 6 or x == 7:    # Round to 1 decimal place
+                    value = round(self.collected_data[field], 1)
+                else:                     # Getting errors when uploading decimals for power/energy so return INT
+                    value = int(self.collected_data[field])
+                data_point = data_point + "," + str(value)
+                any_data = True
+            else:
+                data_point = data_point + ","
+        if any_data:
+            return data_point
+        return None
+
     def publish(self, inverter):
         if self.collect_data(inverter):
             # Process data points every status_interval
-            if((time.time() - self.last_publish) >= (self.status_interval * 60)):
-                any_data = False
-                if inverter.validateLatestScrape('timestamp'):
-                    now = datetime.datetime.strptime(inverter.getRegisterValue('timestamp'), "%Y-%m-%d %H:%M:%S")
-                    data_point = str(now.strftime("%Y%m%d")) + "," + str(now.strftime("%H:%M"))
-                    for x in range(1, 13):
-                        field = 'v' + str(x)
-                        if self.collected_data.get(field):
-                            if x == 1  and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 2):
-                                value = int(self.collected_data[field])
-                            elif x == 3 and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 3):
-                                value = int(self.collected_data[field])
-                            elif x == 6 or x == 7:    # Round to 1 decimal place
-                                value = round(self.collected_data[field] / self.collected_data['count'], 1)
-                            else:                     # Getting errors when uploading decimals for power/energy so return INT
-                                value = int((self.collected_data[field] / self.collected_data['count']))
-                            data_point = data_point + "," + str(value)
-                            any_data = True
-                        else:
-                            data_point = data_point + ","
-                    self.collected_data = {}
+            if self.collected_data is not None:
+                data_point = self.create_data_point()
+                self.collected_data = None
 
-                if any_data:
+                if data_point is not None:
                     self.batch_data.append(data_point)
                 else:
                     logging.warning(f"PVOutput: No data collected in last {(self.status_interval * 60)} minutes")
@@ -221,6 +253,6 @@ class export_pvoutput(object):
                 else:
                     logging.info("PVOutput: Data added to next batch upload")
             else:
-                logging.info(f"PVOutput: Data logged, next upload in {int(((self.status_interval) * 60) - (time.time() - self.last_publish))} secs")
+                logging.info(f"PVOutput: Data logged, next data point in {int(self.aggregation.get_window_end() - time.time())} secs")
 
-            self.last_run = time.time()
\ No newline at end of file
+            self.last_run = time.time()
@@ -1,22 +1,76 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from EventStream import EventStream
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from threading import Thread
 from version import __version__
 from urllib.parse import parse_qs, urlparse
 
+import gzip
 import json
 import logging
+import time
 import urllib
 
+# The parts of the main page around the body:
+MAIN_HEAD = (
+    "<html><head><title>SunGather</title>"
+    "<meta charset='UTF-8'><noscript><meta http-equiv='refresh' content='15'></noscript>"
+    # Reload when the next scrape is pushed to /events:
+    "<script>new EventSource('/events?changes=true').addEventListener('changes', function() { location.reload(); });</script>"
+    '<style media = "all"> body { background-color: black; color: white; } @media screen and (prefers-color-scheme: light) { body { background-color: white; color: black; } } </style>'
+    "</head><body>"
+).encode("utf-8")
+MAIN_TAIL = b"</table></body></html>"
+
 class export_webserver(object):
-    html_body = "Pending Data Retrieval"
-    metrics = ""
+    # Bodies are encoded on first request only and cached per snapshot by
+    # the SnapshotCache, also compressed with gzip for clients accepting it.
+    # Requests are served concurrently. Responses derived from a snapshot
+    # carry an ETag tied to the scrape sequence, so pollers get a 304 Not
+    # Modified until the next scrape.
+    #
+    # Clients of /events receive every new snapshot (or only the changed
+    # fields) as server-sent events. Every event is encoded once and the same
+    # bytes are buffered for all clients, clients not keeping up are dropped.
+
+    html_body = b"Pending Data Retrieval"
+    snapshot_cache = None
+    rollups = None
+    history = None
+    config = b""
+    # The export serving the requests:
+    current_webserver = None
+
+    # The scrape sequence starts at 1 again after a restart, so the ETags
+    # include the start time: W/"<start time>-<sequence>"
+    etag_prefix = f'W/"{time.time_ns():x}-'
+
+    # Bodies not cached (e.g. /json?fields=) are compressed only from this
+    # size on:
+    GZIP_MIN_SIZE = 1024
+
+    # The representations of a snapshot served, each also available
+    # compressed as ´<name>.gzip`:
+    ENCODINGS = ["webserver_main", "webserver_metrics", "webserver_json"]
+
+    # Seconds between comments sent to idle clients of /events, so closed
+    # connections are detected:
+    EVENTS_KEEPALIVE = 15
+    # Seconds a write to a client of /events may block:
+    EVENTS_WRITE_TIMEOUT = 30
+
     def __init__(self):
-        False
+        self.inverter = None
+        # (address, unit) as strings by register name, see get_metadata():
+        self.register_metadata = {}
+        self.events = EventStream()
+        # Sequence and values of the snapshot last pushed to /events:
+        self.last_sequence = 0
+        self.previous_values = None
 
     # Configure Webserver
     def configure(self, config, inverter):
         try:
-            self.webServer = HTTPServer(('', config.get('port',8080)), MyServer)
+            self.webServer = ThreadingHTTPServer(('', config.get('port',8080)), MyServer)
             self.t = Thread(target=self.webServer.serve_forever)
             self.t.daemon = True    # Make it a deamon, so if main loop ends the webserver dies
             self.t.start()
@@ -27,7 +81,7 @@ class export_webserver(object):
         pending_config = False
         config_body = f"""
             <h3>SunGather v{__version__}</h3></p>
-            <h4>Configuration changes require a restart to take effect!</h4>    
+            <h4>Configuration changes require a restart to take effect!</h4>
             <form action="/config">
             <label>Inverter Settings:</label><br>
             <table><tr><th>Option</th><th>Setting</th><th>Update?</th></tr>
@@ -39,73 +93,343 @@ class export_webserver(object):
         for setting, value in inverter.inverter_config.items():
             config_body += f'<tr><td><label for="{str(setting)}">{str(setting)}:</label></td>'
             config_body += f'<td><input type="text" id="{str(setting)}" name="{str(setting)}" value="{str(value)}"></td>'
-            config_body += f'<td><input type="checkbox" id="update_{str(setting)}" name="update_{str(setting)}" value="False"></td></tr>' 
+            config_body += f'<td><input type="checkbox" id="update_{str(setting)}" name="update_{str(setting)}" value="False"></td></tr>'
         #config_body += f'</table><input type="submit" value="Submit"></form>'
         config_body += f'</table>Currently ReadOnly, No save function yet :(</form>'
-        export_webserver.config = config_body
+        export_webserver.config = bytes(config_body, "utf-8")
+
+        self.inverter = inverter
+        self.register_metadata = {}
+        for register in inverter.get_my_register_list():
+            # The first register of a name counts, like in getRegisterAddress():
+            self.register_metadata.setdefault(register['name'], (str(register.get('address', '----')), str(register.get('unit', ''))))
+        export_webserver.snapshot_cache = inverter.snapshot_cache
+        export_webserver.rollups = inverter.rollups
+        export_webserver.history = inverter.history
+        self.events = EventStream(config.get('events_buffer', 10))
+        export_webserver.current_webserver = self
+        inverter.snapshot_cache.register_encoder("webserver_main", self.encode_main)
+        inverter.snapshot_cache.register_encoder("webserver_metrics", self.encode_metrics)
+        inverter.snapshot_cache.register_encoder("webserver_json", self.encode_json)
+        inverter.snapshot_cache.register_encoder("webserver_events", self.encode_event)
+        for name in self.ENCODINGS:
+            inverter.snapshot_cache.register_encoder(f"{name}.gzip", self.get_gzip_encoder(name))
 
         return True
 
     def publish(self, inverter):
-        json_array={"registers":{}, "client_config":{}, "inverter_config":{}}
-        metrics_body = ""
+        # The bodies are encoded from the current snapshot on first request
+        # only, see the encode_* methods. A new snapshot is pushed to the
+        # clients of /events, encoded only for the kinds of events subscribed
+        # to.
+        snapshot = self.get_snapshot()
+        if snapshot is None or snapshot.sequence == self.last_sequence:
+            return True
+        previous_values = self.previous_values
+        self.last_sequence = snapshot.sequence
+        self.previous_values = snapshot.values
+        kinds = self.events.get_kinds()
+        if not kinds:
+            return True
+        frames = {}
+        if "snapshot" in kinds:
+            frames["snapshot"] = snapshot.get_encoded("webserver_events")
+        if "changes" in kinds:
+            frames["changes"] = self.encode_changes(snapshot, previous_values)
+        self.events.broadcast(snapshot.sequence, frames)
+        return True
+
+    def get_metrics(self):
+        return {"event_clients": self.events.count(), "dropped_event_clients": self.events.dropped}
+
+    def close(self):
+        # End the streams of all clients of /events.
+        self.events.close()
+
+    @staticmethod
+    def get_gzip_encoder(name):
+        def encode_gzip(snapshot):
+            return gzip.compress(snapshot.get_encoded(name), compresslevel=6)
+        return encode_gzip
+
+    def get_metadata(self, register):
+        # Return address and unit of a register as strings. Names not in the
+        # register list (e.g. ´timestamp`) are looked up once.
+        metadata = self.register_metadata.get(register)
+        if metadata is None:
+            metadata = (str(self.inverter.getRegisterAddress(register)), str(self.inverter.getRegisterUnit(register)))
+            self.register_metadata[register] = metadata
+        return metadata
+
+    def encode_main(self, snapshot):
+        inverter = self.inverter
         main_body = f"""
             <h3>SunGather v{__version__}</h3></p>
             <h4>Need Help? <href a='https://github.com/bohdan-s/SunGather'>https://github.com/bohdan-s/SunGather</a></h4></p>
             <h4>NEW HomeAssistant Add-on: <href a='https://github.com/bohdan-s/hassio-repository'>https://github.com/bohdan-s/SunGather</a></h4></p>
             """
-        main_body += "<table><th>Address</th><tr><th>Register</th><th>Value</th></tr>"
-        for register, value in inverter.latest_scrape.items():
-            main_body += f"<tr><td>{str(inverter.getRegisterAddress(register))}</td><td>{str(register)}</td><td>{str(value)} {str(inverter.getRegisterUnit(register))}</td></tr>"
-            metrics_body += f"{str(register)}{{address=\"{str(inverter.getRegisterAddress(register))}\", unit=\"{str(inverter.getRegisterUnit(register))}\"}} {str(value)}\n"
-            json_array["registers"][str(inverter.getRegisterAddress(register))]={"register": str(register), "value":str(value), "unit": str(inverter.getRegisterUnit(register))}
-        main_body += f"</table><p>Total {len(inverter.latest_scrape)} registers"
+        rows = ["<table><th>Address</th><tr><th>Register</th><th>Value</th></tr>"]
+        for register, value in snapshot.values.items():
+            address, unit = self.get_metadata(register)
+            rows.append(f"<tr><td>{address}</td><td>{str(register)}</td><td>{str(value)} {unit}</td></tr>")
+        main_body += "".join(rows)
+        main_body += f"</table><p>Total {len(snapshot.values)} registers"
 
         main_body += "</p></p><table><tr><th>Configuration</th><th>Value</th></tr>"
         for setting, value in inverter.client_config.items():
             main_body += f"<tr><td>{str(setting)}</td><td>{str(value)}</td></tr>"
-            json_array["client_config"][str(setting)]=str(value)
         for setting, value in inverter.inverter_config.items():
             main_body += f"<tr><td>{str(setting)}</td><td>{str(value)}</td></tr>"
-            json_array["inverter_config"][str(setting)]=str(value)
         main_body += f"</table></p>"
+        return MAIN_HEAD + bytes(main_body, "utf-8") + MAIN_TAIL
 
-        export_webserver.main = main_body
-        export_webserver.metrics = metrics_body
-        export_webserver.json = json.dumps(json_array)
-        return True
+    def encode_metrics(self, snapshot):
+        lines = []
+        for register, value in snapshot.values.items():
+            address, unit = self.get_metadata(register)
+            lines.append(f"{str(register)}{{address=\"{address}\", unit=\"{unit}\"}} {str(value)}\n")
+        return bytes("".join(lines), "utf-8")
+
+    def encode_json(self, snapshot, fields=None):
+        # With fields (a set of register names) only these registers are
+        # included.
+        inverter = self.inverter
+        json_array={"registers":{}, "client_config":{}, "inverter_config":{}}
+        registers = json_array["registers"]
+        values = snapshot.values
+        names = values.keys() if fields is None else [name for name in values if name in fields]
+        for register in names:
+            address, unit = self.get_metadata(register)
+            registers[address]={"register": str(register), "value":str(values[register]), "unit": unit}
+        for setting, value in inverter.client_config.items():
+            json_array["client_config"][str(setting)]=str(value)
+        for setting, value in inverter.inverter_config.items():
+            json_array["inverter_config"][str(setting)]=str(value)
+        return bytes(json.dumps(json_array), "utf-8")
+
+    def encode_event(self, snapshot):
+        return f"id: {snapshot.sequence}\nevent: snapshot\ndata: {json.dumps(snapshot.values)}\n\n".encode("utf-8")
+
+    def encode_changes(self, snapshot, previous_values):
+        # Return the event with the fields changed since the previous
+        # snapshot, fields no longer present are null.
+        values = snapshot.values
+        if previous_values is None:
+            changes = values
+        else:
+            changes = {name: value for name, value in values.items() if name not in previous_values or previous_values[name] != value}
+            for name in previous_values:
+                if name not in values:
+                    changes[name] = None
+        return f"id: {snapshot.sequence}\nevent: changes\ndata: {json.dumps(changes)}\n\n".encode("utf-8")
+
+    @classmethod
+    def get_snapshot(cls):
+        # Return the current snapshot, None if there was no successful
+        # scrape yet.
+        if cls.snapshot_cache is None:
+            return None
+        return cls.snapshot_cache.current
+
+    @classmethod
+    def get_etag(cls, snapshot):
+        return f'{cls.etag_prefix}{snapshot.sequence}"'
+
+    @classmethod
+    def get_rollups(cls, query):
+        # Return the rollups selected by the query parameters ´period`
+        # (default: day) and optionally ´register` as JSON, None if the
+        # period is not available.
+        if cls.rollups is None:
+            return None
+        period = query.get('period', ['day'])[0]
+        register = query.get('register', [None])[0]
+        records = cls.rollups.query(period, register)
+        if records is None:
+            return None
+        return bytes(json.dumps(records), "utf-8")
+
+    @classmethod
+    def get_history(cls, query):
+        # Return the history of the registers selected by the query
+        # parameter ´register` (default: all registers kept) from ´from` to
+        # ´to` (seconds since the epoch, negative values relative to now,
+        # default: all values), downsampled to buckets of ´step` seconds if
+        # given, as JSON. Return None if a register is not kept. Raise
+        # ValueError for invalid parameters.
+        if cls.history is None:
+            return None
+        registers = [name for value in query.get('register', []) for name in value.split(',') if name]
+        if not registers:
+            registers = cls.history.registers
+        now = time.time()
+        start = float(query.get('from', [-cls.history.retention])[0])
+        end = float(query.get('to', [now])[0])
+        if start < 0:
+            start += now
+        if end < 0:
+            end += now
+        step = int(query.get('step', [0])[0])
+        if step < 0:
+            raise ValueError("step must not be negative")
+        result = {"from": start, "to": end, "step": step or None, "registers": {}}
+        for register in registers:
+            columns = cls.history.query(register, start, end, step)
+            if columns is None:
+                return None
+            result["registers"][register] = columns
+        return bytes(json.dumps(result), "utf-8")
 
 class MyServer(BaseHTTPRequestHandler):
+    # Keep connections of pollers open, every response has a Content-Length.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, without TCP_NODELAY the
+    # response on a kept open connection is delayed by the client's delayed
+    # ACK:
+    disable_nagle_algorithm = True
+
     def do_GET(self):
-        if self.path.startswith('/metrics'):
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(bytes(export_webserver.metrics, "utf-8"))
+        url = urlparse(self.path)
+        if self.path.startswith('/events'):
+            self.send_events(parse_qs(url.query))
+        elif self.path.startswith('/metrics'):
+            self.send_snapshot("webserver_metrics", b"", "text/plain")
         elif self.path.startswith('/config'):
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-            self.wfile.write(bytes(export_webserver.config, "utf-8"))
-            parsed_data = parse_qs(urlparse(self.path).query)
+            self.send_body(export_webserver.config, "text/html")
+            parsed_data = parse_qs(url.query)
             logging.info(f"{parsed_data}")
+        elif self.path.startswith('/rollups'):
+            snapshot = export_webserver.get_snapshot()
+            if snapshot is not None and self.is_not_modified(snapshot):
+                return
+            body = export_webserver.get_rollups(parse_qs(url.query))
+            if body is None:
+                self.send_body(b"", "text/plain", status=404)
+                return
+            self.send_compressible(body, "application/json", snapshot)
+        elif self.path.startswith('/history'):
+            snapshot = export_webserver.get_snapshot()
+            if snapshot is not None and self.is_not_modified(snapshot):
+                return
+            try:
+                body = export_webserver.get_history(parse_qs(url.query))
+            except ValueError as err:
+                self.send_body(bytes(str(err), "utf-8"), "text/plain", status=400)
+                return
+            if body is None:
+                self.send_body(b"", "text/plain", status=404)
+                return
+            self.send_compressible(body, "application/json", snapshot)
         elif self.path.startswith('/json'):
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(export_webserver.json, "utf-8"))
+            fields = parse_qs(url.query).get('fields')
+            if not fields:
+                self.send_snapshot("webserver_json", b"{}", "application/json")
+                return
+            # ´?fields=a,b` or ´?fields=a&fields=b`:
+            fields = {name for value in fields for name in value.split(',') if name}
+            snapshot = export_webserver.get_snapshot()
+            if snapshot is None:
+                self.send_body(b"{}", "application/json")
+            elif not self.is_not_modified(snapshot):
+                body = export_webserver.current_webserver.encode_json(snapshot, fields)
+                self.send_compressible(body, "application/json", snapshot)
         else:
+            self.send_snapshot("webserver_main", MAIN_HEAD + export_webserver.html_body + MAIN_TAIL, "text/html")
+
+    def send_events(self, query):
+        # Stream server-sent events until the client disconnects or is
+        # dropped for not keeping up: first the current snapshot, then every
+        # new snapshot, with ´?changes=true` only the changed fields.
+        webserver = export_webserver.current_webserver
+        changes = query.get('changes', ['false'])[0].lower() in ['true', '1', 'yes']
+        subscriber = webserver.events.subscribe("changes" if changes else "snapshot")
+        self.close_connection = True
+        try:
             self.send_response(200)
-            self.send_header("Content-type", "text/html")
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
             self.end_headers()
-            self.wfile.write(bytes("<html><head><title>SunGather</title>", "utf-8"))
-            self.wfile.write(bytes("<meta charset='UTF-8'><meta http-equiv='refresh' content='15'>", "utf-8"))
-            self.wfile.write(bytes('<style media = "all"> body { background-color: black; color: white; } @media screen and (prefers-color-scheme: light) { body { background-color: white; color: black; } } </style>', "utf-8"))
-            self.wfile.write(bytes("</head>", "utf-8"))
-            self.wfile.write(bytes("<body>", "utf-8"))
-            self.wfile.write(bytes(export_webserver.main, "utf-8"))
-            self.wfile.write(bytes("</table>", "utf-8"))
-            self.wfile.write(bytes("</body></html>", "utf-8"))
+            self.connection.settimeout(export_webserver.EVENTS_WRITE_TIMEOUT)
+            sent = 0
+            snapshot = export_webserver.get_snapshot()
+            if snapshot is not None:
+                self.wfile.write(snapshot.get_encoded("webserver_events"))
+                sent = snapshot.sequence
+            while True:
+                event = subscriber.get(export_webserver.EVENTS_KEEPALIVE)
+                if event is None:
+                    if subscriber.closed:
+                        break
+                    self.wfile.write(b": keep-alive\n\n")
+                    continue
+                sequence, frame = event
+                # Snapshots sent already on connecting are skipped:
+                if sequence > sent:
+                    self.wfile.write(frame)
+                    sent = sequence
+        except OSError:
+            # The client has closed the connection.
+            pass
+        finally:
+            webserver.events.unsubscribe(subscriber)
+
+    def send_snapshot(self, name, pending, content_type):
+        # Send the representation ´name` of the current snapshot, ´pending`
+        # if there was no successful scrape yet.
+        snapshot = export_webserver.get_snapshot()
+        if snapshot is None:
+            self.send_body(pending, content_type)
+            return
+        if self.is_not_modified(snapshot):
+            return
+        compressed = self.accepts_gzip()
+        body = snapshot.get_encoded(f"{name}.gzip" if compressed else name)
+        self.send_body(body, content_type, etag=export_webserver.get_etag(snapshot), compressed=compressed, vary=True)
+
+    def send_compressible(self, body, content_type, snapshot):
+        # Send a body not cached, compressed if large enough.
+        compressed = len(body) >= export_webserver.GZIP_MIN_SIZE and self.accepts_gzip()
+        if compressed:
+            body = gzip.compress(body, compresslevel=6)
+        etag = export_webserver.get_etag(snapshot) if snapshot is not None else None
+        self.send_body(body, content_type, etag=etag, compressed=compressed, vary=True)
+
+    def send_body(self, body, content_type, status=200, etag=None, compressed=False, vary=False):
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if compressed:
+            self.send_header("Content-Encoding", "gzip")
+        if vary:
+            self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def accepts_gzip(self):
+        accepted = self.headers.get("Accept-Encoding", "")
+        return any(coding.split(';')[0].strip() == "gzip" and not coding.replace(' ', '').endswith(";q=0") for coding in accepted.split(','))
+
+    def is_not_modified(self, snapshot):
+        # Send a 304 Not Modified and return True if the client has the
+        # representation of the snapshot already.
+        header = self.headers.get("If-None-Match")
+        if header is None:
+            return False
+        etag = export_webserver.get_etag(snapshot)
+        # Weak comparison, ignoring ´W/`:
+        tags = [tag.strip().removeprefix("W/") for tag in header.split(',')]
+        if "*" not in tags and etag.removeprefix("W/") not in tags:
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        return True
 
     def do_POST(self):
         length = int(self.headers['Content-Length'])
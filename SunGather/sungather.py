@@ -3,18 +3,27 @@
 from SungrowClient import SungrowClient
 from SungrowClient import SungrowClientCore
 from FieldConfigurator import FieldConfigurator
+from RegisterCatalogCache import RegisterCatalogCache
 from JSONSchemaValidator import JSONSchemaValidator
 from version import __version__
 from RegisterWriter import RegisterWriter
+from ExportManager import ExportManager
+from FieldPostProcessor import FieldPostProcessor
+from Backfill import Backfill
+from StateCheckpoint import StateCheckpoint
 
-import importlib
 import logging
 import logging.handlers
+import os
+import signal
 import sys
 import getopt
 import yaml
 import time
 
+# Use the much faster C implementation of the yaml loader, if available:
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 def main():
     app_args = read_arguments_from_commandline()
@@ -31,18 +40,48 @@ def main():
 
     print_welcome_message(app_args, inverter_config)
 
-    inverter = setup_inverter(inverter_config, app_args["registersfilename"])
+    if app_args["backfillfilename"]:
+        run_backfill(
+            inverter_config,
+            app_args["backfillfilename"],
+            app_args["backfilloutputfilename"],
+        )
+
+    if app_args["buildcatalogcache"]:
+        build_register_catalog_cache(
+            inverter_config,
+            app_args["registersfilename"],
+            app_args["catalogcachefilename"],
+        )
+
+    inverter = setup_inverter(
+        inverter_config,
+        app_args["registersfilename"],
+        app_args["catalogcachefilename"],
+    )
 
-    exports = setup_exports(app_config, inverter)
+    export_manager = setup_exports(app_config, inverter)
 
     setup_imports(app_config, inverter_config, inverter)
 
-    core_loop(
-        inverter,
-        exports,
-        inverter_config.get("scan_interval"),
-        app_args["runonce"],
-    )
+    checkpoint = setup_state_checkpoint(inverter_config, inverter, export_manager)
+
+    # Stopping the container sends SIGTERM: exit like on ´Ctrl-C`, so the
+    # statistics are printed and the state checkpoint is written.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        core_loop(
+            inverter,
+            export_manager,
+            checkpoint,
+            inverter_config.get("scan_interval"),
+            app_args["runonce"],
+        )
+    finally:
+        inverter.field_post_processor.print_statistics()
+        export_manager.close()
+        if checkpoint is not None:
+            checkpoint.save()
 
 
 #######################################################################
@@ -58,9 +97,24 @@ def read_arguments_from_commandline():
         "logfolder": "logs/",
         "loglevel": None,
         "runonce": False,
+        "catalogcachefilename": "registers-catalog.cache",
+        "buildcatalogcache": False,
+        "backfillfilename": None,
+        "backfilloutputfilename": None,
     }
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hc:r:l:v:", ["runonce", "help"])
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "hc:r:l:v:",
+            [
+                "runonce",
+                "help",
+                "catalog-cache=",
+                "build-catalog-cache",
+                "backfill=",
+                "backfill-output=",
+            ],
+        )
     except getopt.GetoptError:
         logging.error(
             "Error parsing command line! Run with option ´-h` to show usage information."
@@ -92,6 +146,14 @@ def read_arguments_from_commandline():
                 sys.exit(2)
         elif opt == "--runonce":
             app_args["runonce"] = True
+        elif opt == "--catalog-cache":
+            app_args["catalogcachefilename"] = arg
+        elif opt == "--build-catalog-cache":
+            app_args["buildcatalogcache"] = True
+        elif opt == "--backfill":
+            app_args["backfillfilename"] = arg
+        elif opt == "--backfill-output":
+            app_args["backfilloutputfilename"] = arg
 
     return app_args
 
@@ -107,6 +169,13 @@ def print_synopsis():
     print("-v 30                   : Logging Level")
     print("                          10 = Debug, 20 = Info, 30 = Warning, 40 = Error")
     print("--runonce               : Run once then exit.")
+    print("--catalog-cache file    : Specify the register catalog cache file.")
+    print("                          An empty name disables the cache.")
+    print("--build-catalog-cache   : Build the register catalog cache then exit.")
+    print("--backfill file         : Evaluate the custom fields for the values recorded")
+    print("                          in a CSV file, then exit.")
+    print("--backfill-output file  : Specify the CSV file to write the custom fields to.")
+    print("                          Default: <backfill file>-customfields.csv")
     print("-h                      : print this help message and exit.")
     print("\nExample:")
     print("python3 sungather.py -c /full/path/config.yaml\n")
@@ -114,7 +183,8 @@ def print_synopsis():
 
 def load_config_file(configfilename):
     try:
-        configfile = yaml.safe_load(open(configfilename, encoding="utf-8"))
+        with open(configfilename, encoding="utf-8") as f:
+            configfile = yaml.load(f, Loader=YamlLoader)
         logging.debug(f"Loaded config: {configfilename}")
     except Exception as err:
         logging.exception(f"Failed loading config: {configfilename} \n\t\t\t     {err}")
@@ -153,6 +223,12 @@ def get_inverter_config(app_configuration):
         ),
         "customfields": app_configuration["inverter"].get("customfields", []),
         "register_patches": app_configuration["inverter"].get("register_patches", []),
+        "state_file": app_configuration["inverter"].get("state_file", None),
+        "state_interval": app_configuration["inverter"].get("state_interval", 300),
+        "rollups": app_configuration["inverter"].get("rollups", None),
+        "history": app_configuration["inverter"].get("history", None),
+        "rules": app_configuration["inverter"].get("rules", []),
+        "lazy_decoding": app_configuration["inverter"].get("lazy_decoding", False),
     }
     return config_inverter
 
@@ -165,9 +241,51 @@ def print_welcome_message(app_args, inverter_configuration):
     logging.info("##################################################################")
 
 
-def setup_inverter(inverter_config, register_config_filename):
+def build_register_catalog_cache(
+    inverter_config, register_config_filename, catalog_cache_filename
+):
+    # Load, validate and patch the register configuration and store it in the
+    # register catalog cache, then exit. Intended to prebuild the cache, e.g.
+    # when building a Docker image.
+    if not catalog_cache_filename:
+        logging.critical("No file name for the register catalog cache specified!")
+        sys.exit(1)
     patches = inverter_config.get("register_patches", None)
     fc = FieldConfigurator(register_config_filename, register_patch_config=patches)
+    fc.get_register_config()
+    cache = RegisterCatalogCache(catalog_cache_filename)
+    key = cache.compute_key(register_config_filename, patches)
+    if not cache.store(key, fc.registers):
+        logging.critical(
+            f"Failed to build the register catalog cache ´{catalog_cache_filename}`."
+        )
+        sys.exit(1)
+    sys.exit(0)
+
+
+def run_backfill(inverter_config, input_filename, output_filename):
+    # Evaluate the custom fields for recorded values, write them to a file,
+    # then exit.
+    if output_filename is None:
+        output_filename = os.path.splitext(input_filename)[0] + "-customfields.csv"
+    backfill = Backfill(FieldPostProcessor(inverter_config.get("customfields")))
+    try:
+        backfill.read_csv(input_filename)
+        backfill.run()
+        backfill.write_csv(output_filename)
+    except Exception as err:
+        logging.critical(f"Backfill of ´{input_filename}` failed: {err}")
+        sys.exit(1)
+    sys.exit(0)
+
+
+def setup_inverter(inverter_config, register_config_filename, catalog_cache_filename):
+    patches = inverter_config.get("register_patches", None)
+    fc = FieldConfigurator(
+        register_config_filename,
+        register_patch_config=patches,
+        cache_filename=catalog_cache_filename,
+    )
     register_configuration = fc.get_register_config()
 
     if inverter_config.get("disable_legacy_custom_registers"):
@@ -214,63 +332,50 @@ def setup_imports(app_config, inverter_config, inverter):
 
 def setup_exports(app_configuration, inverter):
     # Note that exports may fail during configuration if data cannot be
-    # read from the inverter!
-    exports = []
-    logging.info("Start loading exports ...")
+    # read from the inverter! Exports are configured in the background, the
+    # returned ExportManager provides the exports which are ready.
+    export_manager = ExportManager(inverter)
     export_config_section = app_configuration.get("exports")
-    for exportconfig in export_config_section:
-        export_loaded = load_one_export(exportconfig, inverter)
-        if export_loaded is not None:
-            exports.append(export_loaded)
-    # Fall back to console if nothing else was configured.
-    if len(exports) == 0:
+    # Fall back to console if nothing else was configured or all exports
+    # failed permanently.
+    if export_manager.start(export_config_section) == 0:
         logging.warning(
-            "No exports were configured or enabled. Falling back to console export."
+            "No exports were configured, enabled or valid. Falling back to console export."
         )
-        export_loaded = load_one_export({"name": "console", "enabled": True}, inverter)
-        if export_loaded is not None:
-            exports.append(export_loaded)
-        else:
+        export_manager.start([{"name": "console", "enabled": True}])
+        if len(export_manager.get_exports()) == 0:
             logging.critical("Fallback to export ´console` failed, exiting.")
             sys.exit(1)
-    return exports
+    return export_manager
 
 
-def load_one_export(export, inverter):
-    logging.debug(f"Checking enablement of export ´{export.get('name')}` ...")
-    if export.get("enabled", False):
-        logging.debug(f"... Export ´{export.get('name')}` is enabled.")
-        try:
-            logging.info(f"Loading module ´exports/{export.get('name')}.py`.")
-            export_loaded = importlib.import_module("exports." + export.get("name"))
-            logging.debug(f"Module ´{export.get('name')}` imported successfully.")
-        except Exception as err:
-            logging.error(
-                f"Failed loading export ´{export.get('name')}`: {err}"
-                + f". Please make sure ´{export.get('name')}.py` exists in the exports folder."
-            )
-            return None
-        try:
-            export_loaded = getattr(export_loaded, "export_" + export.get("name"))()
-            export_loaded.configure(export, inverter)
-            logging.debug(f"Configured export ´{export.get('name')}`.")
-        except Exception as err:
-            logging.error(f"Failed configuring export ´{export.get('name')}`: {err}")
-            return None
-        return export_loaded
-    else:
-        logging.debug(f"... Export ´{export.get('name')}` is not enabled.")
+def setup_state_checkpoint(inverter_config, inverter, export_manager):
+    # Restore the runtime state of the inverter (including the custom fields)
+    # and the exports from the state file, if configured. Return the
+    # StateCheckpoint or None.
+    state_filename = inverter_config.get("state_file")
+    if not state_filename:
         return None
+    checkpoint = StateCheckpoint(
+        state_filename, interval=inverter_config.get("state_interval")
+    )
+    checkpoint.register("inverter", inverter.get_state, inverter.set_state)
+    checkpoint.register("exports", export_manager.get_state, export_manager.set_state)
+    checkpoint.restore()
+    return checkpoint
 
 
-def core_loop(inverter, exports, interval, runonce):
+def core_loop(inverter, export_manager, checkpoint, interval, runonce):
     while True:
         logging.info("Starting scrape ...")
         loop_start = time.perf_counter()
 
         inverter.checkConnection()
 
-        scrape_and_export_once(inverter, exports)
+        scrape_and_export_once(inverter, export_manager)
+
+        if checkpoint is not None:
+            checkpoint.save_if_due()
 
         if runonce:
             logging.info("Option ´--runonce` was specified, exiting.")
@@ -290,7 +395,7 @@ def core_loop(inverter, exports, interval, runonce):
             time.sleep(interval - process_time)
 
 
-def scrape_and_export_once(inverter, exports):
+def scrape_and_export_once(inverter, export_manager):
     # Scrape the inverter.
     success = False
     try:
@@ -301,11 +406,7 @@ def scrape_and_export_once(inverter, exports):
 
     # Export all scraped data, if scraping was successful, otherwise skip.
     if success:
-        for export in exports:
-            try:
-                export.publish(inverter)
-            except Exception as e:
-                logging.exception("Failed to export: %s", e)
+        export_manager.publish(inverter)
         inverter.close()
     else:
         inverter.disconnect()
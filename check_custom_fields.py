@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+
+# Randomized check that the code generated for the custom fields (see
+# FieldPostProcessor.build_function()) calculates the same as evaluating the
+# custom field definitions one by one (FieldPostProcessor.evaluate_one_by_one()).
+#
+# Random custom field configurations are evaluated with random values by two
+# FieldPostProcessors, one using each way. After every evaluation the values,
+# the warnings logged and the statistics of the definitions must be the same,
+# after all evaluations the state as well. The configurations cover guards,
+# fallbacks, write modes, aggregation, statements, comprehensions, lambdas,
+# rolling window functions, names not defined and expressions not compiling.
+#
+# Run it after changing either way of evaluating:
+#
+#   python3 check_custom_fields.py [--seed N] [--configurations N] [--rounds N]
+#
+# The exit code is 1 if the results differ, the configuration and the values
+# of the first difference are printed.
+#
+# With --benchmark the time of evaluating a number of guarded fields with a
+# fallback among a few hundred values is measured instead, both ways:
+#
+#   python3 check_custom_fields.py --benchmark [--fields N] [--registers N] [--rounds N]
+
+import argparse
+import copy
+import logging
+import os
+import random
+import re
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "SunGather"))
+
+from FieldPostProcessor import FieldPostProcessor  # noqa: E402
+
+INPUTS = ["x", "y", "z"]
+FIELDS = ["f0", "f1", "f2", "f3", "f4"]
+INPUT_VALUES = [0, 1, 2, 2.0, -1, 0.5, "s", None, True]
+
+# Expression templates, {a} and {b} are replaced by names or constants, {n}
+# by the name of a field:
+EXPRESSIONS = [
+    "{a}",
+    "{a} + {b}",
+    "{a} * 2 - {b}",
+    "{a} / {b}",
+    "{a} if {b} else 0",
+    "{a} > {b}",
+    "str({a})",
+    "max({a}, {b})",
+    "abs({a}) + 1",
+    "isinstance({a}, int) and {a} + 1",
+    "sum(v for v in [{a}, {b}])",
+    "any({a} < v for v in (1, 2))",
+    "[v * w for v in range(3) for w in [{a}, {b}] if v]",
+    "{{k: v for k, v in [('a', {a}), ('b', {b})]}}",
+    "{{v for v in [{a}, {b}]}}",
+    "(lambda q, *r, k={b}: q + k + len(r))({a})",
+    "(w := {a}) + w",
+    "datetime.now().year > 2000 and {a}",
+    "avg('{n}', 60)",
+    "rate('{n}')",
+    "integral('{n}', 120)",
+    "min('{n}', 60)",
+    "{a} +* 2",
+]
+GUARDS = ["{a} > 0", "{a}", "{a} != {b}", "undefined_name", "{a} +* 2", "[1, 2][{a}]"]
+FALLBACKS = ["-1", "{a}", "1 / 0", "{a} * {b}"]
+STATEMENTS = [
+    'results["{n}"] = previous_results.get("count", 0)\nprevious_results["count"] = previous_results.get("count", 0) + 1',
+    'results["{n}"] = {a} + 1',
+    'results["{n}"] = [v for v in range(2) if {a}]',
+]
+ATOMS = INPUTS + ["1", "2.5", "'t'", "undefined_name"]
+
+
+def random_operand(rnd, fields):
+    return rnd.choice(ATOMS + fields)
+
+
+def fill(rnd, template, fields):
+    return template.format(
+        a=random_operand(rnd, fields),
+        b=random_operand(rnd, fields),
+        n=rnd.choice(INPUTS + fields),
+    )
+
+
+def random_configuration(rnd):
+    configuration = []
+    for _ in range(rnd.randint(1, 12)):
+        # Fields may be configured more than once and may be inputs:
+        name = rnd.choice(FIELDS + INPUTS[:1])
+        fields = [cf["name"] for cf in configuration]
+        if rnd.random() < 0.1:
+            configuration.append({"name": name, "statement": fill(rnd, rnd.choice(STATEMENTS), fields)})
+            continue
+        cf = {"name": name, "expression": fill(rnd, rnd.choice(EXPRESSIONS), fields)}
+        if rnd.random() < 0.3:
+            cf["guard"] = fill(rnd, rnd.choice(GUARDS), fields)
+        if rnd.random() < 0.3:
+            cf["fallback"] = fill(rnd, rnd.choice(FALLBACKS), fields)
+        if rnd.random() < 0.3:
+            cf["write_mode"] = rnd.choice(["replace_only", "new_only"])
+        if rnd.random() < 0.1:
+            cf["aggregate"] = rnd.choice(["daily", "total"])
+        configuration.append(cf)
+    return configuration
+
+
+def random_values(rnd):
+    # Values named like a function (´min`) hide the function.
+    values = {}
+    for name in INPUTS + FIELDS + ["min"]:
+        if name in INPUTS and rnd.random() < 0.8 or rnd.random() < 0.2:
+            values[name] = rnd.choice(INPUT_VALUES)
+    return values
+
+
+ADDRESS = re.compile(r" at 0x[0-9a-f]+")
+
+
+def normalize(text):
+    # Objects (e.g. functions) are shown with their address, which differs
+    # between the FieldPostProcessors.
+    return ADDRESS.sub("", text)
+
+
+class Recorder(logging.Handler):
+    # Collects the messages logged.
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(normalize(record.getMessage()))
+
+    def take(self):
+        messages = self.messages
+        self.messages = []
+        return messages
+
+
+def describe(values):
+    return {name: (type(value).__name__, normalize(repr(value))) for name, value in values.items()}
+
+
+def statistics(processor):
+    # The statistics without the times taken.
+    return [
+        {key: normalize(str(value)) for key, value in s.items() if key not in ("total_time", "max_time")}
+        for s in processor.get_statistics()
+    ]
+
+
+def state(processor):
+    # The state without the time of the last update of aggregated fields,
+    # which is taken from the clock.
+    return {
+        key: {name: value for name, value in entry.items() if name != "last_update"}
+        for key, entry in processor.get_state().items()
+    }
+
+
+def check(configuration, rnd, rounds, recorder):
+    # Return None if both ways calculate the same, otherwise a description of
+    # the first difference.
+    logging.disable(logging.ERROR)
+    generated = FieldPostProcessor(copy.deepcopy(configuration))
+    one_by_one = FieldPostProcessor(copy.deepcopy(configuration))
+    logging.disable(logging.NOTSET)
+    if generated._function is None:
+        return "no code generated"
+    recorder.take()
+    values = random_values(rnd)
+    for i in range(rounds):
+        # Repeated values are not evaluated again:
+        if rnd.random() < 0.6:
+            values = random_values(rnd)
+        now = 1700000000 + 10 * i
+        generated_values = dict(values)
+        generated.evaluate(generated_values, now=now)
+        generated_messages = recorder.take()
+        one_by_one_values = dict(values)
+        one_by_one.evaluate_one_by_one(one_by_one_values, now=now)
+        one_by_one_messages = recorder.take()
+        if describe(generated_values) != describe(one_by_one_values):
+            return f"values differ in round {i} for {values}:\n  {describe(generated_values)}\n  {describe(one_by_one_values)}"
+        if generated_messages != one_by_one_messages:
+            return f"messages differ in round {i} for {values}:\n  {generated_messages}\n  {one_by_one_messages}"
+        if statistics(generated) != statistics(one_by_one):
+            return f"statistics differ in round {i} for {values}:\n  {statistics(generated)}\n  {statistics(one_by_one)}"
+    if state(generated) != state(one_by_one):
+        return f"state differs:\n  {state(generated)}\n  {state(one_by_one)}"
+    return None
+
+
+def benchmark(fields, registers, rounds):
+    # Print the mean time of an evaluation of the fields, all inputs change
+    # with every evaluation.
+    configuration = [
+        {
+            "name": f"field_{i}",
+            "expression": f"(x * {i} + y) / 1000 if x > 0 else 0",
+            "guard": "y >= 0",
+            "fallback": "0",
+        }
+        for i in range(fields)
+    ]
+    values = {f"register_{i}": i for i in range(registers)}
+    logging.disable(logging.WARNING)
+    for label, evaluate in [
+        ("generated function", FieldPostProcessor(configuration).evaluate),
+        ("one by one", FieldPostProcessor(configuration).evaluate_one_by_one),
+    ]:
+        start = time.perf_counter()
+        for i in range(rounds):
+            evaluate({**values, "x": i + 1, "y": i % 7})
+        duration = (time.perf_counter() - start) / rounds
+        print(f"{label:20} {duration * 1000:8.3f} ms per evaluation")
+    logging.disable(logging.NOTSET)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the code generated for custom fields against evaluating them one by one.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--configurations", type=int, default=300)
+    parser.add_argument("--rounds", type=int, default=None, help="evaluations per configuration, default 40 (1000 with --benchmark)")
+    parser.add_argument("--benchmark", action="store_true", help="measure the time of evaluating instead")
+    parser.add_argument("--fields", type=int, default=50, help="guarded fields of the benchmark")
+    parser.add_argument("--registers", type=int, default=400, help="values of the benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(f"{args.fields} guarded fields, {args.registers} values:")
+        benchmark(args.fields, args.registers, args.rounds or 1000)
+        return 0
+    rounds = args.rounds or 40
+
+    # The messages logged are compared, not shown:
+    recorder = Recorder()
+    logging.getLogger().handlers = [recorder]
+    logging.getLogger().setLevel(logging.WARNING)
+    # E.g. ´[1, 2][2.5]`, which fails when evaluated:
+    warnings.filterwarnings("ignore", category=SyntaxWarning)
+
+    rnd = random.Random(args.seed)
+    for n in range(args.configurations):
+        configuration = random_configuration(rnd)
+        difference = check(configuration, rnd, rounds, recorder)
+        if difference is not None:
+            print(f"Configuration {n} (seed {args.seed}): {difference}")
+            print("Custom fields:")
+            for cf in configuration:
+                print(f"  {cf}")
+            return 1
+    print(f"{args.configurations} configurations evaluated {rounds} times each, no differences.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
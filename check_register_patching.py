@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+# Benchmark of the configuration of registers with a large synthetic register
+# catalog, checking the results against the straightforward (unindexed) way.
+#
+# The registers file is extended by synthetic registers and scan ranges (like
+# generated yearly and monthly series would), then patched with plain name
+# and regular expression patches. Patching (FieldConfigurator) and the
+# selection of scan ranges (SungrowClient.build_range_list()) are timed and
+# compared with patching by matching every patch attribute against every
+# register and selecting scan ranges by checking every register:
+#
+#   python3 check_register_patching.py [--registers N] [--patches N] [--seed N]
+#
+# The exit code is 1 if the results differ.
+
+import argparse
+import copy
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+SUNGATHER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SunGather")
+sys.path.insert(0, SUNGATHER_DIR)
+
+from FieldConfigurator import FieldConfigurator  # noqa: E402
+from SungrowClient import SungrowClient  # noqa: E402
+
+REGISTERS_FILENAME = os.path.join(SUNGATHER_DIR, "registers-sungrow.yaml")
+
+# Synthetic registers start at this address, two addresses each:
+FIRST_ADDRESS = 40000
+SCAN_RANGE = 100
+
+INVERTER_CONFIG = {
+    "host": "localhost",
+    "port": 502,
+    "timeout": 1,
+    "retries": 1,
+    "slave": 1,
+    "scan_interval": 30,
+    "connection": "modbus",
+    "model": "SH10RT",
+    "serial_number": "A0000000000",
+    "smart_meter": True,
+    "use_local_time": False,
+    "level": 1,
+}
+
+
+def load_catalog(count, rnd):
+    # Return the registers file extended by count synthetic read registers
+    # and the scan ranges covering them.
+    configurator = FieldConfigurator(REGISTERS_FILENAME)
+    configurator._load_registers()
+    catalog = configurator.registers
+    for i in range(count):
+        catalog["registers"][0]["read"].append(
+            {
+                "name": f"synthetic_{i}",
+                "level": rnd.choice([1, 2, 3]),
+                "address": FIRST_ADDRESS + 2 * i,
+                "datatype": "U16",
+                "unit": "kWh",
+                "accuracy": 0.1,
+            }
+        )
+    for start in range(FIRST_ADDRESS, FIRST_ADDRESS + 2 * count, SCAN_RANGE):
+        catalog["scan"][0]["read"].append({"start": start, "range": SCAN_RANGE})
+    # Ranges ending or starting exactly at the address of a register (odd
+    # addresses are not used):
+    for i in range(0, count, 50):
+        catalog["scan"][0]["read"].append({"start": FIRST_ADDRESS + 2 * i - 1, "range": 1})
+        catalog["scan"][0]["read"].append({"start": FIRST_ADDRESS + 2 * i + 2, "range": 1})
+    return catalog
+
+
+def create_patches(count, registers, rnd):
+    # Return count patches: changing attributes of existing registers by
+    # name, adding new registers, renaming registers (renamed registers are
+    # patched again later) and patches with regular expressions.
+    patches = []
+    renamed = []
+    for i in range(count):
+        kind = rnd.random()
+        if kind < 0.7:
+            name = rnd.choice(renamed) if renamed and rnd.random() < 0.2 else f"synthetic_{rnd.randrange(registers)}"
+            patches.append({"name": name, "unit": "Wh", "accuracy": 1.0, "level": rnd.choice([1, 2])})
+        elif kind < 0.8:
+            patches.append(
+                {
+                    "name": f"added_{i}",
+                    "type": "read",
+                    "level": 1,
+                    "address": FIRST_ADDRESS + 2 * registers + 2 * i,
+                    "datatype": "U16",
+                }
+            )
+        elif kind < 0.9:
+            new_name = f"renamed_{i}"
+            patches.append({"name": f"synthetic_{rnd.randrange(registers)}", "change_name_to": new_name})
+            renamed.append(new_name)
+        else:
+            digit = rnd.randrange(10)
+            patches.append({"name": f"synthetic_\\d*{digit}{digit}", "level": 1, "unit": "MWh"})
+    # Invalid values and regular expressions are rejected the same way:
+    patches.append({"name": "synthetic_(", "level": 1})
+    patches.append({"name": "synthetic_1", "level": "high", "unit": "Wh"})
+    return patches
+
+
+def patch_unindexed(configurator, patches):
+    # Patch the registers of configurator by matching every attribute of
+    # every patch against all registers, compiling the regular expression
+    # each time.
+    allregs = [
+        *configurator.registers["registers"][0]["read"],
+        *configurator.registers["registers"][1]["hold"],
+    ]
+    for patch in patches:
+        reg_name = patch.get("name")
+        for attribute_name, attribute_value in patch.items():
+            if attribute_name == "name":
+                continue
+            if not configurator._check_patch_value(attribute_name, attribute_value):
+                continue
+            try:
+                p = re.compile(reg_name)
+            except re.error:
+                continue
+            pattern_did_match = False
+            for reg in allregs:
+                if p.fullmatch(reg.get("name")):
+                    pattern_did_match = True
+                    configurator._patch_register(reg, attribute_name, attribute_value)
+            if not pattern_did_match:
+                newreg = {"name": reg_name}
+                configurator._patch_register(newreg, attribute_name, attribute_value)
+                allregs.append(newreg)
+    for reg in allregs:
+        if reg.get("type") == "read":
+            configurator.registers["registers"][0]["read"].append(reg)
+        elif reg.get("type") == "hold":
+            configurator.registers["registers"][1]["hold"].append(reg)
+
+
+def select_ranges_unindexed(registers, registersfile):
+    # Return the scan ranges containing at least one of the registers,
+    # checking every register for every range.
+    ranges = []
+    for reg_type, scan in (("read", registersfile["scan"][0]["read"]), ("hold", registersfile["scan"][1]["hold"])):
+        for reg_range in scan:
+            range_start = reg_range.get("start")
+            range_end = range_start + reg_range.get("range")
+            for register in registers:
+                if register.get("type") == reg_type and range_start <= register.get("address") <= range_end:
+                    ranges.append({**reg_range, "type": reg_type})
+                    break
+    return ranges
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark patching registers and selecting scan ranges with a synthetic register catalog.")
+    parser.add_argument("--registers", type=int, default=10000, help="synthetic registers added to the registers file")
+    parser.add_argument("--patches", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    rnd = random.Random(args.seed)
+    catalog = load_catalog(args.registers, rnd)
+    patches = create_patches(args.patches, args.registers, rnd)
+    registers = len(catalog["registers"][0]["read"]) + len(catalog["registers"][1]["hold"])
+    print(f"{registers} registers, {len(patches)} patches, {len(catalog['scan'][0]['read'])} read scan ranges:")
+
+    indexed = FieldConfigurator(REGISTERS_FILENAME, register_patch_config=copy.deepcopy(patches))
+    indexed.registers = copy.deepcopy(catalog)
+    _, indexed_time = timed(indexed._patch_registers)
+    unindexed = FieldConfigurator(REGISTERS_FILENAME, register_patch_config=copy.deepcopy(patches))
+    unindexed.registers = copy.deepcopy(catalog)
+    _, unindexed_time = timed(patch_unindexed, unindexed, patches)
+    print(f"  patching       indexed {indexed_time * 1000:9.1f} ms, unindexed {unindexed_time * 1000:9.1f} ms")
+    if indexed.registers != unindexed.registers:
+        print("Patched registers differ!")
+        return 1
+
+    client = SungrowClient(dict(INVERTER_CONFIG))
+    client.build_register_list(indexed.registers)
+    _, indexed_time = timed(client.build_range_list, indexed.registers)
+    selected = [dict(reg_range) for reg_range in client.register_ranges]
+    expected, unindexed_time = timed(select_ranges_unindexed, client.registers, indexed.registers)
+    print(f"  scan ranges    indexed {indexed_time * 1000:9.1f} ms, unindexed {unindexed_time * 1000:9.1f} ms")
+    if selected != expected:
+        print("Selected scan ranges differ!")
+        return 1
+    print(f"  {len(client.registers)} registers selected at level {INVERTER_CONFIG['level']}, {len(selected)} scan ranges, no differences.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())